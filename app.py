@@ -1,13 +1,29 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, Response, has_app_context
+from flask import before_render_template, template_rendered
 import sqlite3
 import secrets
 import qrcode
+import logging
+from cache import create_cache
+from log_config import configure_logging
+import jobs
+import maintenance
+import metrics
+import query_plans
+import profiler
+import snapshots
+import tracing
 from io import BytesIO
 import base64
 from datetime import datetime
 import os
+import random
 import sys
+import time
+import signal
+import socket
+import threading
 
 # Fix Windows encoding issues
 if sys.platform == 'win32':
@@ -23,6 +39,117 @@ if sys.platform == 'win32':
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
 
+# Leveled logging through a background queue (see log_config.py for LOG_LEVEL etc.)
+configure_logging()
+log = logging.getLogger('qr_app')
+db_log = logging.getLogger('qr_app.db')
+network_log = logging.getLogger('qr_app.network')
+catalog_log = logging.getLogger('qr_app.catalog')
+checkout_log = logging.getLogger('qr_app.checkout')
+admin_log = logging.getLogger('qr_app.admin')
+approval_log = logging.getLogger('qr_app.approval')
+scan_log = logging.getLogger('qr_app.scan')
+
+# Request metrics - latency, status codes, in-flight requests and response sizes per endpoint
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.request_metrics_recorded = False
+    metrics.registry.add_gauge('http_requests_in_flight', {}, 1)
+
+def _record_request_metrics(status, response_size):
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    labels = {'endpoint': endpoint, 'method': request.method}
+    metrics.registry.inc('http_requests_total', dict(labels, status=str(status)))
+    metrics.registry.observe('http_request_duration_seconds', labels, time.perf_counter() - g.request_start)
+    if response_size is not None:
+        metrics.registry.observe('http_response_size_bytes', labels, response_size, metrics.SIZE_BUCKETS)
+    g.request_metrics_recorded = True
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        _record_request_metrics(response.status_code, response.calculate_content_length())
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'request_start' not in g:
+        return
+    # after_request is skipped when a view raises - count those as 500s
+    if not g.request_metrics_recorded:
+        _record_request_metrics(500, None)
+    metrics.registry.add_gauge('http_requests_in_flight', {}, -1)
+    metrics.registry.flush()
+
+# Opt-in request profiling (see profiler.py) - admins send X-Profile-Request: 1,
+# PROFILE_SAMPLE_RATE profiles a random share of all requests
+@app.before_request
+def start_request_profile():
+    requested = request.headers.get(profiler.PROFILE_HEADER) == '1' and session.get('user_type') == 'admin'
+    if requested or (profiler.PROFILE_SAMPLE_RATE > 0 and random.random() < profiler.PROFILE_SAMPLE_RATE):
+        g.profile_sampler = profiler.start()
+
+def _save_request_profile():
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return None
+    try:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        name = profiler.save(sampler.stop(), endpoint)
+        log.info("Request profile captured", extra={'capture': name, 'samples': sampler.samples})
+        return name
+    except OSError as e:
+        log.warning("Could not save request profile: %s", e)
+        return None
+
+@app.after_request
+def finish_request_profile(response):
+    name = _save_request_profile()
+    if name:
+        response.headers['X-Profile-Capture'] = name
+    return response
+
+@app.teardown_request
+def abort_request_profile(exc):
+    # after_request is skipped when a view raises - keep the profile of the failed request
+    _save_request_profile()
+
+# Request tracing (see tracing.py) - spans for DB access, QR rendering, templates and
+# socket calls, trace id returned in X-Trace-Id / traceparent
+@app.before_request
+def start_request_trace():
+    if not tracing.TRACING:
+        return
+    trace_id, parent_id = tracing.parse_trace_header(request.headers)
+    if trace_id or random.random() < tracing.TRACE_SAMPLE_RATE:
+        g.trace = tracing.start_trace(trace_id, parent_id)
+        tracing.start_span('http.request', method=request.method, path=request.path,
+                           endpoint=request.url_rule.endpoint if request.url_rule else 'unmatched')
+
+@app.after_request
+def add_trace_headers(response):
+    trace = g.get('trace')
+    if trace is not None and trace.stack:
+        root = trace.stack[0]
+        root.attrs['status'] = response.status_code
+        response.headers['X-Trace-Id'] = trace.trace_id
+        response.headers['traceparent'] = f'00-{trace.trace_id}-{root.span_id}-01'
+    return response
+
+@app.teardown_request
+def finish_request_trace(exc):
+    if g.pop('trace', None) is not None:
+        tracing.finish_trace(**({'error': type(exc).__name__} if exc else {}))
+
+@before_render_template.connect_via(app)
+def start_template_span(sender, template, context, **extra):
+    tracing.start_span('template.render', template=template.name)
+
+@template_rendered.connect_via(app)
+def end_template_span(sender, template, context, **extra):
+    tracing.end_span()
+
 # SQLite Database Configuration
 # For serverless (Vercel): use /tmp directory
 # For traditional hosting (Railway, Render, etc): use current directory
@@ -36,6 +163,238 @@ else:
     # Use persistent storage for traditional hosting
     DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_app.db')
 
+# Per-worker metric snapshots go to a directory keyed by the database path
+metrics.configure(DATABASE)
+
+# Network base URL used in scan QR payloads
+# Detecting the network IP needs a UDP socket, so it is resolved once at startup
+# and refreshed in the background (or on SIGHUP) instead of on every request.
+BASE_URL_REFRESH_SECONDS = int(os.environ.get('BASE_URL_REFRESH_SECONDS', '300'))
+
+_base_url_lock = threading.Lock()
+_base_url_state = {
+    'server_url': None,
+    'is_railway': False,
+    'network_ip': None,
+    'resolved_at': None
+}
+_base_url_refresher_started = False
+_base_url_refresh_event = threading.Event()
+
+def detect_network_ip():
+    """Detect the network IP used for mobile access, or None if there is no network"""
+    with tracing.span('socket.detect_network_ip'):
+        return _detect_network_ip()
+
+def _detect_network_ip():
+    try:
+        # Connecting a UDP socket sends no packets, it only picks the outbound interface
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.settimeout(1.0)
+            s.connect(("8.8.8.8", 80))  # Google DNS
+            return s.getsockname()[0]
+        finally:
+            s.close()
+    except OSError:
+        pass
+    
+    # No route to the internet - fall back to the hostname lookup (LAN-only setups)
+    try:
+        local_ip = socket.gethostbyname(socket.gethostname())
+        if local_ip and not local_ip.startswith('127.'):
+            return local_ip
+    except OSError:
+        pass
+    return None
+
+def refresh_base_url():
+    """Re-read the server URL environment variables and re-detect the network IP"""
+    server_url = os.environ.get('SERVER_URL')
+    is_railway = bool(os.environ.get('RAILWAY_ENVIRONMENT') or os.environ.get('RAILWAY_SERVICE_NAME'))
+    # Detected even with a public URL - /test/network, the order QR page and the
+    # startup banner show it; get_scan_base_url only falls back to it
+    network_ip = detect_network_ip()
+    
+    with _base_url_lock:
+        _base_url_state['server_url'] = server_url.rstrip('/') if server_url else None
+        _base_url_state['is_railway'] = is_railway
+        _base_url_state['network_ip'] = network_ip
+        _base_url_state['resolved_at'] = datetime.now()
+    
+    network_log.info("Base URL resolved", extra={'server_url': server_url or '-', 'railway': is_railway, 'network_ip': network_ip or 'not detected'})
+    return network_ip
+
+def get_network_ip():
+    """Cached network IP (None if it could not be detected)"""
+    if _base_url_state['resolved_at'] is None:
+        refresh_base_url()
+    return _base_url_state['network_ip']
+
+def get_scan_base_url(req):
+    """Public base URL for scan QR codes - custom SERVER_URL, Railway URL or network IP"""
+    if _base_url_state['resolved_at'] is None:
+        refresh_base_url()
+    
+    with _base_url_lock:
+        server_url = _base_url_state['server_url']
+        is_railway = _base_url_state['is_railway']
+        local_ip = _base_url_state['network_ip']
+    
+    if server_url:
+        # Use custom server URL if provided (for production or specific network setup)
+        return server_url
+    
+    if is_railway:
+        # On Railway, use the public Railway URL from request
+        base_url = req.url_root.rstrip('/')
+        # Remove any port numbers as Railway handles that
+        return base_url.replace(':5000', '')
+    
+    # Local development - use request URL but replace localhost/127.0.0.1 with actual network IP
+    base_url = req.host_url.rstrip('/')
+    if not local_ip:
+        # Mobile devices may not be able to access the scan URL - set SERVER_URL to fix this
+        return base_url
+    
+    if 'localhost' in base_url or '127.0.0.1' in base_url:
+        return base_url.replace('localhost', local_ip).replace('127.0.0.1', local_ip)
+    
+    # Even if accessed via IP, use the detected network IP to ensure consistency
+    port = ':5000' if ':5000' in base_url else ''
+    return f"http://{local_ip}{port}"
+
+def _base_url_refresh_loop():
+    # Wakes up on the refresh interval, or early when SIGHUP sets the event
+    timeout = BASE_URL_REFRESH_SECONDS if BASE_URL_REFRESH_SECONDS > 0 else None
+    while True:
+        _base_url_refresh_event.wait(timeout)
+        _base_url_refresh_event.clear()
+        try:
+            refresh_base_url()
+        except Exception as e:
+            network_log.warning("Base URL refresh failed: %s", e)
+
+def start_base_url_resolver():
+    """Resolve the base URL now, then refresh it on a timer and on SIGHUP"""
+    global _base_url_refresher_started
+    
+    refresh_base_url()
+    if _base_url_refresher_started:
+        return
+    _base_url_refresher_started = True
+    
+    # Serverless instances are short-lived, a background thread is not worth it there
+    if os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL'):
+        return
+    threading.Thread(target=_base_url_refresh_loop, name='base-url-refresh', daemon=True).start()
+    
+    # SIGHUP does not exist on Windows, and handlers can only be set from the main thread.
+    # The handler only wakes the refresh thread so it never blocks the interrupted request.
+    if hasattr(signal, 'SIGHUP'):
+        try:
+            signal.signal(signal.SIGHUP, lambda signum, frame: _base_url_refresh_event.set())
+        except ValueError:
+            pass
+
+# SQL instrumentation
+# Every statement run through a connection from get_db() is counted and timed per
+# request (g.db_statements / g.db_time). Statements slower than SLOW_QUERY_MS are
+# logged with their EXPLAIN QUERY PLAN. In debug mode (or with SERVER_TIMING=1) the
+# totals are sent back in a Server-Timing header.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+# Statements kept per request for query traces (see g.db_trace)
+DB_TRACE_LIMIT = 200
+
+def _explain_query_plan(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN details for a statement, run on a plain (uninstrumented) cursor"""
+    try:
+        cursor = sqlite3.Cursor(conn)
+        sqlite3.Cursor.execute(cursor, 'EXPLAIN QUERY PLAN ' + sql, parameters)
+        plan = ' | '.join(row[-1] for row in sqlite3.Cursor.fetchall(cursor))
+        cursor.close()
+        return plan
+    except sqlite3.Error as e:
+        return f'unavailable ({e})'
+
+def _record_statement(conn, sql, parameters, duration, fetch=False):
+    if fetch:
+        # Rows fetched after execute() only add time, they are not a new statement
+        if has_app_context() and 'db_time' in g:
+            g.db_time += duration
+        return
+    
+    operation = sql.split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    metrics.registry.observe('db_query_duration_seconds', {'operation': operation}, duration)
+    tracing.record_span('db.execute', duration, operation=operation, sql=' '.join(sql.split())[:200])
+    
+    if has_app_context() and 'db_statements' in g:
+        g.db_statements += 1
+        g.db_time += duration
+        if len(g.db_trace) < DB_TRACE_LIMIT:
+            g.db_trace.append((' '.join(sql.split()), duration))
+    
+    if duration * 1000 >= SLOW_QUERY_MS and operation in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+        db_log.warning("Slow query", extra={
+            'ms': round(duration * 1000, 1),
+            'sql': ' '.join(sql.split())[:300],
+            'plan': _explain_query_plan(conn, sql, parameters)
+        })
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement count and time to the current request"""
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(self.connection, sql, parameters, time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_statement(self.connection, sql, (), time.perf_counter() - start)
+    
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record_statement(self.connection, '', (), time.perf_counter() - start, fetch=True)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute) are instrumented"""
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+@app.before_request
+def start_db_instrumentation():
+    g.db_statements = 0
+    g.db_time = 0.0
+    g.db_trace = []
+
+@app.after_request
+def add_server_timing(response):
+    if 'db_statements' not in g:
+        return response
+    if app.debug or SERVER_TIMING:
+        timings = [f'db;dur={g.db_time * 1000:.1f};desc="{g.db_statements} queries"']
+        if 'request_start' in g:
+            timings.append(f'total;dur={(time.perf_counter() - g.request_start) * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        response.headers['X-DB-Queries'] = str(g.db_statements)
+    db_log.debug("Request DB usage", extra={'path': request.path, 'queries': g.db_statements, 'db_ms': round(g.db_time * 1000, 1)})
+    return response
+
 # Helper function to get database connection
 def get_db():
     """Get database connection with error handling to prevent function crashes"""
@@ -46,38 +405,40 @@ def get_db():
             os.makedirs(db_dir, exist_ok=True)
         
         # Add timeout to prevent hanging on locked database
-        conn = sqlite3.connect(DATABASE, timeout=10.0)
+        with tracing.span('db.connect'):
+            conn = sqlite3.connect(DATABASE, timeout=10.0, factory=InstrumentedConnection)
         conn.row_factory = sqlite3.Row  # This makes rows behave like dicts
         return conn
     except sqlite3.Error as e:
-        print(f"[ERROR] Database connection error: {e}")
-        print(f"Database path: {DATABASE}")
+        db_log.error("Database connection error: %s", e, extra={'database': DATABASE})
         # Re-raise to be caught by route handlers
         raise
     except Exception as e:
-        print(f"[ERROR] Unexpected error connecting to database: {e}")
-        print(f"Database path: {DATABASE}")
+        db_log.error("Unexpected error connecting to database: %s", e, extra={'database': DATABASE})
         raise
 
 # Helper function to execute queries and return dict-like results
 def query_db(query, args=(), one=False):
     """Execute database query with error handling"""
+    with tracing.span('db.query_db'):
+        return _query_db(query, args, one)
+
+def _query_db(query, args, one, connect=get_db):
     conn = None
     try:
-        conn = get_db()
+        conn = connect()
         cur = conn.execute(query, args)
         rv = cur.fetchall()
         conn.commit()
         cur.close()
         return (rv[0] if rv else None) if one else rv
     except sqlite3.Error as e:
-        print(f"[ERROR] Database query error: {e}")
-        print(f"Query: {query[:100]}...")  # Log first 100 chars of query
+        db_log.error("Database query error: %s", e, extra={'query': query[:100]})  # Log first 100 chars of query
         if conn:
             conn.rollback()
         raise  # Re-raise to be caught by route handlers
     except Exception as e:
-        print(f"[ERROR] Unexpected error in query_db: {e}")
+        db_log.error("Unexpected error in query_db: %s", e)
         if conn:
             conn.rollback()
         raise
@@ -85,6 +446,122 @@ def query_db(query, args=(), one=False):
         if conn:
             conn.close()
 
+# Reporting reads
+# Dashboards and the admin order/item listings read through get_report_db, so a long
+# report never holds up the scanners and checkout:
+#   readonly - a query_only connection to the live database; in WAL mode readers
+#              never block writers (default)
+#   snapshot - a copy of the database made with the backup API, refreshed when it is
+#              older than REPORT_SNAPSHOT_SECONDS; reports never touch the live file
+#   off      - the normal connection
+# Pages show how fresh their data is (templates/_report_freshness.html).
+REPORTING_MODE = os.environ.get('REPORTING_MODE', 'readonly')
+REPORT_SNAPSHOT_SECONDS = float(os.environ.get('REPORT_SNAPSHOT_SECONDS', '60'))
+_report_refresh_lock = threading.Lock()
+
+def report_database_path():
+    """Path of the snapshot copy - next to DATABASE, read at call time like get_db does"""
+    return DATABASE + '.report'
+
+def refresh_report_snapshot(force=False):
+    """Copy the live database to report_database_path() if the copy is missing or stale"""
+    report_database = report_database_path()
+    try:
+        taken = os.path.getmtime(report_database)
+    except OSError:
+        taken = 0.0
+    if not force and time.time() - taken < REPORT_SNAPSHOT_SECONDS:
+        return
+    # One refresh per process at a time; others keep reading the current copy if there is one
+    if not _report_refresh_lock.acquire(blocking=not taken):
+        return
+    try:
+        if not taken and os.path.exists(report_database):
+            return  # Made by the thread we waited for
+        started = time.perf_counter()
+        tmp = f'{report_database}.{os.getpid()}.tmp'
+        src = sqlite3.connect(DATABASE, timeout=10.0)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst, pages=snapshots.BACKUP_STEP_PAGES, sleep=snapshots.BACKUP_STEP_SLEEP)
+            dst.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            dst.close()
+            src.close()
+        # Open report connections keep reading the old copy
+        os.replace(tmp, report_database)
+        metrics.registry.observe('report_snapshot_refresh_seconds', {}, time.perf_counter() - started)
+    finally:
+        _report_refresh_lock.release()
+
+def get_report_db():
+    """Read-only connection for reporting pages (see REPORTING_MODE)"""
+    if REPORTING_MODE == 'snapshot':
+        refresh_report_snapshot()
+        path = report_database_path()
+        as_of = os.path.getmtime(path)
+    elif REPORTING_MODE == 'readonly':
+        path = DATABASE
+        as_of = time.time()
+    else:
+        return get_db()
+    conn = sqlite3.connect(path, timeout=10.0, factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    # Plain Connection.execute - setup statements do not count as page queries
+    sqlite3.Connection.execute(conn, 'PRAGMA query_only = 1')
+    if has_app_context():
+        # The oldest data a page used
+        g.report_as_of = min(g.get('report_as_of', as_of), as_of)
+    return conn
+
+def query_report(query, args=(), one=False):
+    """query_db for reporting pages - reads through get_report_db"""
+    with tracing.span('db.query_report'):
+        return _query_db(query, args, one, connect=get_report_db)
+
+@app.context_processor
+def inject_report_freshness():
+    if 'report_as_of' not in g:
+        return {}
+    age = max(0, round(time.time() - g.report_as_of))
+    return {'report_freshness': {
+        'mode': REPORTING_MODE,
+        'as_of': datetime.fromtimestamp(g.report_as_of).strftime('%Y-%m-%d %H:%M:%S'),
+        'age_seconds': age,
+    }}
+
+# QR code settings used by the different pages
+QR_PROFILES = {
+    # Product and single item QR pages
+    'product': (qrcode.constants.ERROR_CORRECT_M, 10, 5),
+    'item': (qrcode.constants.ERROR_CORRECT_M, 10, 5),
+    # Grid of all item QR codes of a product
+    'item_grid': (qrcode.constants.ERROR_CORRECT_M, 8, 4),
+    # Full scan URLs - higher error correction and larger boxes for mobile scanning
+    'scan_url': (qrcode.constants.ERROR_CORRECT_H, 12, 4),
+}
+
+def render_qr_base64(data, profile):
+    """Render data as a QR code PNG using one of QR_PROFILES and return it base64 encoded"""
+    error_correction, box_size, border = QR_PROFILES[profile]
+    with metrics.timed('qr_render_duration_seconds', profile=profile):
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=error_correction,
+            box_size=box_size,
+            border=border
+        )
+        qr.add_data(data)
+        with tracing.span('qr.make', profile=profile):
+            qr.make(fit=True)
+        
+        with tracing.span('qr.make_image', profile=profile, version=qr.version):
+            img = qr.make_image(fill_color="black", back_color="white")
+        with tracing.span('qr.save', profile=profile):
+            img_buffer = BytesIO()
+            img.save(img_buffer, format='PNG')
+        return base64.b64encode(img_buffer.getvalue()).decode()
+
 def generate_unique_item_qr_code(cursor):
     """Generate unique QR code for individual item"""
     qr_code = secrets.token_urlsafe(16)
@@ -113,14 +590,764 @@ def generate_unique_item_qr_code(cursor):
     
     return qr_code
 
-def get_product_stock(product_id):
-    """Get available stock count from items table (only validated items)"""
-    count = query_db(
-        'SELECT COUNT(*) as count FROM items WHERE product_id = ? AND status = ? AND validated = 1',
-        (product_id, 'available'),
-        one=True
+# Hot queries are registered in query_plans so their plans can be checked for full
+# table scans (tests and /admin/diagnostics/query_plans)
+SQL_STOCK_BY_PRODUCT = query_plans.register('stock_by_product', '''
+    SELECT COUNT(*) as count FROM items WHERE product_id = ? AND status = ? AND validated = 1
+''', (1, 'available'))
+
+def get_product_stock(product_id, use_cache=True):
+    """Get available stock count from items table (only validated items)
+    
+    Display paths use the cached count; paths that sell stock pass use_cache=False.
+    """
+    def load():
+        count = query_db(SQL_STOCK_BY_PRODUCT, (product_id, 'available'), one=True)
+        return dict(count)['count'] if count else 0
+    
+    if not use_cache:
+        return load()
+    return catalog_cache_get('stock', str(product_id), load)
+
+# Product catalog read cache
+# Customer browsing (categories, products per category, image URLs, stock counts) is
+# served from the cache backend in cache.py (CACHE_BACKEND=lru|mmap|socket). Entries
+# expire after CATALOG_CACHE_TTL seconds and are invalidated in every gunicorn worker
+# whenever products, items or stock change.
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', '60'))
+
+catalog_cache = create_cache(instance=DATABASE)
+
+def catalog_cache_get(namespace, key, loader):
+    """Return the cached value for key, calling loader() on a miss or expiry"""
+    return catalog_cache.get_or_load(namespace, key, loader, CATALOG_CACHE_TTL)
+
+def invalidate_catalog_cache(reason=''):
+    """Drop all cached catalog data and stock counts (called after product, item or stock changes)"""
+    for namespace in ('categories', 'products', 'stock'):
+        catalog_cache.invalidate(namespace)
+    catalog_log.debug("Catalog cache invalidated", extra={'reason': reason})
+
+def get_categories():
+    """Categories shown on the homepage (cached)"""
+    def load():
+        # Get categories that have products with items (validated or not)
+        # This shows all categories, and products page will filter by validated items
+        categories_result = query_db('''
+            SELECT DISTINCT p.category
+            FROM products p
+            INNER JOIN items i ON p.id = i.product_id
+            WHERE i.status = 'available'
+            ORDER BY p.category
+        ''')
+        categories = [dict(row) for row in categories_result] if categories_result else []
+        
+        # If no categories with items, show categories that have products (in case items haven't been created yet)
+        if not categories:
+            categories_result = query_db('''
+                SELECT DISTINCT category
+                FROM products
+                ORDER BY category
+            ''')
+            categories = [dict(row) for row in categories_result] if categories_result else []
+        return categories
+    
+    return [dict(category) for category in catalog_cache_get('categories', 'all', load)]
+
+SQL_CATEGORY_PRODUCTS = query_plans.register('category_products', '''
+    SELECT p.*,
+           SUM(CASE WHEN i.validated = 1 THEN 1 ELSE 0 END) as validated_stock,
+           COUNT(i.id) as total_available
+    FROM products p
+    JOIN items i ON i.product_id = p.id AND i.status = 'available'
+    WHERE p.category = ?
+    GROUP BY p.id
+    ORDER BY p.color, p.size
+''', ('T-Shirt',))
+
+def get_category_products(category):
+    """Products of a category that have available items, with stock counts (cached)"""
+    def load():
+        # Stock counts for all products of the category in one grouped query:
+        # validated available items (for purchasing) and all available items (for display).
+        # The inner join keeps only products with available items (validated or not).
+        products_list = query_db(SQL_CATEGORY_PRODUCTS, (category,))
+        
+        filtered_products = []
+        for row in products_list:
+            product = dict(row)
+            product['stock'] = product.pop('validated_stock')  # Validated stock for purchasing
+            # Items are validated when created by admin, so no validation needed
+            product['needs_validation'] = False
+            filtered_products.append(product)
+        
+        # Ensure all products have image URLs based on category
+        for product in filtered_products:
+            if not product.get('image_url'):
+                product['image_url'] = get_product_image_url(product['category'], product['color'])
+        return filtered_products
+    
+    # Copies, so request handlers can't modify the cached entries
+    return [dict(product) for product in catalog_cache_get('products', category, load)]
+
+def group_items_by_order(item_rows):
+    """Item rows (with an order_id column) grouped per order id
+    
+    Order listings load the items of all listed orders in one query and attach
+    them with this, instead of running one items query per order.
+    """
+    grouped = {}
+    for row in item_rows:
+        item = dict(row)
+        grouped.setdefault(item.pop('order_id'), []).append(item)
+    return grouped
+
+# Columns of an order listing row that belong to the order line (see group_order_lines)
+ORDER_LINE_COLUMNS = ('line_id', 'product_id', 'quantity', 'category', 'size', 'color')
+
+def group_order_lines(rows):
+    """Order listing rows (one per order line) folded into one dict per order
+    
+    Each order gets a 'lines' list with its products and the total 'quantity'.
+    Orders keep the order of the rows.
+    """
+    orders = {}
+    for row in rows:
+        row = dict(row)
+        order = orders.get(row['id'])
+        if order is None:
+            order = {k: v for k, v in row.items() if k not in ORDER_LINE_COLUMNS}
+            order['lines'] = []
+            order['quantity'] = 0
+            orders[row['id']] = order
+        order['lines'].append({k: row[k] for k in ORDER_LINE_COLUMNS})
+        order['quantity'] += row['quantity']
+    return list(orders.values())
+
+def refresh_order_product_stock(cursor, order_id):
+    """Recount products.stock for every product of an order"""
+    cursor.execute('''
+        UPDATE products 
+        SET stock = (SELECT COUNT(*) FROM items WHERE product_id = products.id AND status = 'available')
+        WHERE id IN (SELECT product_id FROM order_lines WHERE order_id = ?)
+    ''', (order_id,))
+
+SQL_CART_ITEMS = query_plans.register('cart_items', '''
+    SELECT c.id, c.quantity, p.id as product_id, p.category, p.size, p.color,
+           (SELECT COUNT(*) FROM items i
+            WHERE i.product_id = p.id AND i.status = 'available' AND i.validated = 1) as stock
+    FROM cart c
+    JOIN products p ON c.product_id = p.id
+    WHERE c.user_id = ?
+''', (1,))
+
+def get_cart_items(user_id):
+    """Cart lines of a customer with product details and validated available stock (one query)"""
+    cart_items = query_db(SQL_CART_ITEMS, (user_id,))
+    return [dict(row) for row in cart_items]
+
+# Soft cart holds (CART_HOLDS=1)
+# Adding to the cart holds a stock count (not specific items) for CART_HOLD_TTL
+# seconds. Stock offered to other customers is the validated available count minus
+# their unexpired holds, and checkout turns a customer's own holds into reservations
+# without counting items again. Holds live in the cart_holds table so every worker
+# sees them; expired rows are ignored and deleted by the reservation sweeper.
+CART_HOLDS = os.environ.get('CART_HOLDS', '').lower() in ('1', 'true', 'yes')
+CART_HOLD_TTL = int(os.environ.get('CART_HOLD_TTL', '900'))
+
+SQL_FREE_STOCK = query_plans.register('free_stock', '''
+    SELECT (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available' AND validated = 1)
+         - (SELECT COALESCE(SUM(quantity), 0) FROM cart_holds
+            WHERE product_id = ? AND user_id != ? AND expires_at > ?) as free
+''', (1, 1, 1, 0))
+
+def place_cart_hold(conn, user_id, product_id, quantity):
+    """Hold quantity of a product for a customer, replacing their previous hold
+    
+    Call inside a BEGIN IMMEDIATE transaction so no other worker can hold the same
+    stock in between. Returns (held, free) - free is the stock this customer can hold.
+    """
+    now = time.time()
+    free = conn.execute(SQL_FREE_STOCK, (product_id, product_id, user_id, now)).fetchone()['free']
+    if quantity > free:
+        return False, max(free, 0)
+    conn.execute('''
+        INSERT INTO cart_holds (user_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at
+    ''', (user_id, product_id, quantity, now + CART_HOLD_TTL))
+    return True, free
+
+# Background jobs
+# Slow admin work (restocks, rendering all item QR codes, deleting a product) is
+# queued in the jobs table and run by worker threads (see jobs.py). The admin pages
+# poll /admin/jobs/<id> for progress.
+job_queue = jobs.JobQueue(get_db)
+# Items written per transaction by restock jobs (progress is committed with each batch)
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '200'))
+# Products with up to this many items get their QR grid rendered in the request
+JOB_INLINE_ITEMS = int(os.environ.get('JOB_INLINE_ITEMS', '50'))
+# A rendered QR grid is reused for this long instead of queueing another render
+QR_GRID_REUSE_SECONDS = int(os.environ.get('QR_GRID_REUSE_SECONDS', '600'))
+# Grid QR images go to their own cache (so a large grid does not evict catalog entries),
+# keyed by the item's QR code - the render job fills it and the grid page reads it
+ITEM_QR_CACHE_ENTRIES = int(os.environ.get('ITEM_QR_CACHE_ENTRIES', '4096'))
+item_qr_cache = create_cache(instance=DATABASE, name='item_qr', max_entries=ITEM_QR_CACHE_ENTRIES)
+
+def render_item_grid_qr(qr_code):
+    """Grid QR image of an item (PNG base64), rendered on a cache miss"""
+    return item_qr_cache.get_or_load('item_grid', qr_code, lambda: render_qr_base64(qr_code, 'item_grid'),
+                                     QR_GRID_REUSE_SECONDS)
+
+def start_job_workers():
+    """Start this process's job worker threads (not on serverless - jobs run inline there)"""
+    if os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL'):
+        return
+    job_queue.start()
+
+# Reservation sweeper
+# Checkout reserves items for a pending order. Orders that are never scanned or
+# approved, and cancelled orders, would keep those items reserved forever, so a
+# background thread returns them to stock every RESERVATION_SWEEP_SECONDS:
+# reservations of open orders older than RESERVATION_TTL_HOURS (the order is
+# cancelled) and reservations of cancelled orders. It also deletes expired cart holds.
+RESERVATION_TTL_HOURS = float(os.environ.get('RESERVATION_TTL_HOURS', '48'))
+RESERVATION_SWEEP_SECONDS = float(os.environ.get('RESERVATION_SWEEP_SECONDS', '300'))
+_reservation_sweeper_started = False
+_last_reservation_sweep = 0.0
+
+SQL_STALE_RESERVATIONS = query_plans.register('stale_reservations', '''
+    SELECT i.id, i.product_id, i.order_id, o.status as order_status
+    FROM orders o
+    JOIN items i ON i.order_id = o.id
+    WHERE i.status = 'reserved'
+      AND (o.status = 'cancelled' OR (o.status IN ('pending', 'approved') AND o.created_at < ?))
+    LIMIT ?
+''', ('2000-01-01 00:00:00', 100))
+
+def sweep_expired_reservations(ttl_hours=None, batch_size=None, max_batches=None):
+    """Return stale reserved items to stock; returns {'expired': n, 'cancelled': n, 'orders_expired': n, 'more': bool}
+    
+    Each batch is its own IMMEDIATE transaction, so checkouts are only blocked
+    briefly and workers sweeping at the same time never release an item twice.
+    With max_batches the sweep stops early and 'more' says whether it did.
+    """
+    ttl_hours = RESERVATION_TTL_HOURS if ttl_hours is None else ttl_hours
+    batch_size = batch_size or JOB_BATCH_SIZE
+    started = time.perf_counter()
+    released = {'expired': 0, 'cancelled': 0, 'orders_expired': 0, 'more': False}
+    expired_orders = set()
+    batches = 0
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # Same format as CURRENT_TIMESTAMP (UTC), so the comparison can use idx_orders_status
+        cursor.execute("SELECT datetime('now', ?)", (f'-{int(ttl_hours * 3600)} seconds',))
+        cutoff = cursor.fetchone()[0]
+        cursor.execute('DELETE FROM cart_holds WHERE expires_at <= ?', (time.time(),))
+        conn.commit()
+        while True:
+            if max_batches is not None and batches >= max_batches:
+                released['more'] = True
+                break
+            batches += 1
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(SQL_STALE_RESERVATIONS, (cutoff, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.commit()
+                break
+            
+            # Orders past the TTL can no longer be fulfilled - cancel them with their reservation
+            new_expired = {row['order_id'] for row in rows if row['order_status'] != 'cancelled'}
+            cursor.executemany("UPDATE orders SET status = 'cancelled' WHERE id = ? AND status IN ('pending', 'approved')",
+                               [(order_id,) for order_id in new_expired])
+            expired_orders |= new_expired
+            
+            # Only validated items were reserved, so they go back as sellable stock
+            cursor.executemany('''
+                UPDATE items
+                SET status = 'available', order_id = NULL, order_line_id = NULL, validated = 1, validated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'reserved'
+            ''', [(row['id'],) for row in rows])
+            
+            # Update product stock count from available items
+            cursor.executemany('''
+                UPDATE products 
+                SET stock = (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available')
+                WHERE id = ?
+            ''', [(product_id, product_id) for product_id in {row['product_id'] for row in rows}])
+            conn.commit()
+            
+            # (an order expired by an earlier batch of this sweep shows up as cancelled)
+            for row in rows:
+                released['expired' if row['order_id'] in expired_orders else 'cancelled'] += 1
+            if len(rows) < batch_size:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    released['orders_expired'] = len(expired_orders)
+    
+    for reason in ('expired', 'cancelled'):
+        if released[reason]:
+            metrics.registry.inc('reservations_released_total', {'reason': reason}, released[reason])
+    if released['orders_expired']:
+        metrics.registry.inc('reservation_orders_expired_total', {}, released['orders_expired'])
+    metrics.registry.observe('reservation_sweep_duration_seconds', {}, time.perf_counter() - started)
+    metrics.registry.flush()
+    
+    if released['expired'] or released['cancelled']:
+        invalidate_catalog_cache('reservations released')
+        checkout_log.info("Released stale reservations", extra=dict(released, batches=batches, ms=round((time.perf_counter() - started) * 1000)))
+    return released
+
+def _reservation_sweep_loop():
+    while True:
+        # Spread the workers' sweeps out instead of running them all at once
+        time.sleep(RESERVATION_SWEEP_SECONDS * random.uniform(0.8, 1.2))
+        try:
+            sweep_expired_reservations()
+        except Exception as e:
+            checkout_log.warning("Reservation sweep failed: %s", e)
+
+def start_reservation_sweeper():
+    """Sweep stale reservations on a timer (on serverless requests trigger it, see below)"""
+    global _reservation_sweeper_started
+    if _reservation_sweeper_started or RESERVATION_SWEEP_SECONDS <= 0:
+        return
+    if os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL'):
+        return
+    _reservation_sweeper_started = True
+    threading.Thread(target=_reservation_sweep_loop, name='reservation-sweeper', daemon=True).start()
+
+@app.teardown_request
+def sweep_reservations_if_due(exc):
+    """Without a sweeper thread (serverless), the first request after the interval sweeps
+    
+    Teardown runs before the response is sent, so the request waits for the
+    sweep: it releases one batch, and while there is more to release the
+    next request sweeps again instead of waiting for the interval.
+    """
+    global _last_reservation_sweep
+    if _reservation_sweeper_started or RESERVATION_SWEEP_SECONDS <= 0:
+        return
+    now = time.time()
+    if now - _last_reservation_sweep < RESERVATION_SWEEP_SECONDS:
+        return
+    _last_reservation_sweep = now
+    try:
+        if sweep_expired_reservations(max_batches=1)['more']:
+            _last_reservation_sweep = 0.0
+    except Exception as e:
+        checkout_log.warning("Reservation sweep failed: %s", e)
+
+# Database maintenance
+# Statistics, incremental vacuum and WAL checkpoints on a timer while the worker is
+# idle (see maintenance.py). One worker at a time runs it; results are on /status.
+maintenance_scheduler = maintenance.MaintenanceScheduler(get_db)
+_last_maintenance_check = 0.0
+
+@app.before_request
+def note_request_for_maintenance():
+    maintenance_scheduler.note_request()
+
+def start_maintenance_scheduler():
+    """Start the maintenance thread (on serverless requests trigger it, see below)"""
+    if os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL'):
+        return
+    maintenance_scheduler.start()
+
+@maintenance_scheduler.task('purge_jobs')
+def purge_finished_jobs(conn, deadline):
+    """Delete finished jobs (and their result blobs) older than JOB_RETENTION_DAYS"""
+    return {'deleted': job_queue.purge(conn)}
+
+@app.teardown_request
+def run_maintenance_if_due(exc):
+    """Without a scheduler thread (serverless), check once per poll interval after a request
+    
+    Same rules as the thread: the instance was idle before this request, the hour is
+    inside MAINTENANCE_WINDOW and the interval has passed. It runs before the response
+    is sent, so this request waits up to MAINTENANCE_BUDGET_SECONDS.
+    """
+    global _last_maintenance_check
+    if maintenance_scheduler.thread is not None or maintenance.MAINTENANCE_INTERVAL_SECONDS <= 0:
+        return
+    now = time.time()
+    if now - _last_maintenance_check < maintenance.MAINTENANCE_POLL_SECONDS:
+        return
+    _last_maintenance_check = now
+    try:
+        maintenance_scheduler.run_if_due(after_request=True)
+    except Exception as e:
+        db_log.warning("Maintenance run failed: %s", e)
+
+# Database snapshots
+# With SNAPSHOT_DIR set, the database is backed up into the snapshot store every
+# SNAPSHOT_INTERVAL_SECONDS, and an instance that starts without a database file
+# (a cold Vercel instance, /tmp is empty) restores the newest one (see snapshots.py).
+snapshot_store = snapshots.default_store()
+# Outcome of the restore attempt at startup, shown by /api/status
+snapshot_restore_report = None
+_snapshotter_started = False
+_last_snapshot_check = 0.0
+
+def restore_database_snapshot():
+    """Restore the newest snapshot if the database file does not exist yet"""
+    global snapshot_restore_report
+    if snapshot_store is None or os.path.exists(DATABASE):
+        return
+    report = snapshots.restore_latest(DATABASE, snapshot_store)
+    snapshot_restore_report = report
+    metrics.registry.observe('snapshot_restore_duration_seconds', {'restored': str(bool(report['restored'])).lower()},
+                             report['ms'] / 1000)
+    metrics.registry.flush()
+    print(f"Snapshot restore: {report['restored'] or 'none'} in {report['ms']} ms"
+          + (f" ({report['reason']})" if report['reason'] else ''))
+
+def snapshot_if_due(force=False):
+    """Take a snapshot when the newest one (from any worker or instance) is older than the interval"""
+    if snapshot_store is None:
+        return None
+    if not force:
+        age = snapshots.latest_snapshot_age(snapshot_store)
+        if age is not None and age < snapshots.SNAPSHOT_INTERVAL_SECONDS:
+            return None
+    info = snapshots.take_snapshot(DATABASE, snapshot_store)
+    metrics.registry.observe('snapshot_duration_seconds', {}, info['ms'] / 1000)
+    metrics.registry.observe('snapshot_size_bytes', {}, info['compressed_bytes'], metrics.SIZE_BUCKETS)
+    metrics.registry.flush()
+    return info
+
+@job_queue.handler('snapshot')
+def snapshot_job(job, payload):
+    return snapshot_if_due(force=True)
+
+def _snapshot_loop():
+    while True:
+        time.sleep(snapshots.SNAPSHOT_INTERVAL_SECONDS * random.uniform(0.8, 1.2))
+        try:
+            snapshot_if_due()
+        except Exception as e:
+            db_log.warning("Snapshot failed: %s", e)
+
+def start_snapshotter():
+    """Snapshot on a timer (on serverless requests trigger it, see below)"""
+    global _snapshotter_started
+    if _snapshotter_started or snapshot_store is None or snapshots.SNAPSHOT_INTERVAL_SECONDS <= 0:
+        return
+    if os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL'):
+        return
+    _snapshotter_started = True
+    threading.Thread(target=_snapshot_loop, name='db-snapshot', daemon=True).start()
+
+@app.teardown_request
+def snapshot_after_request_if_due(exc):
+    """Without a snapshot thread (serverless), the first request after the interval snapshots once it is answered"""
+    global _last_snapshot_check
+    if _snapshotter_started or snapshot_store is None or snapshots.SNAPSHOT_INTERVAL_SECONDS <= 0:
+        return
+    now = time.time()
+    if now - _last_snapshot_check < snapshots.SNAPSHOT_INTERVAL_SECONDS:
+        return
+    _last_snapshot_check = now
+    try:
+        snapshot_if_due()
+    except Exception as e:
+        db_log.warning("Snapshot failed: %s", e)
+
+# Order archive
+# Closed orders (confirmed or cancelled) older than ARCHIVE_AFTER_DAYS are moved,
+# with their order lines and items, to the archived_* tables in batches. The hot
+# orders/items tables then only hold open orders, recent history and stock, so
+# stock counts and status-filtered scans stay fast. Order history pages read both.
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+
+SQL_ARCHIVABLE_ORDERS = query_plans.register('archivable_orders', '''
+    SELECT o.id FROM orders o
+    WHERE o.status IN ('confirmed', 'cancelled') AND o.created_at < ?
+      AND NOT EXISTS (SELECT 1 FROM items i WHERE i.order_id = o.id AND i.status = 'reserved')
+    LIMIT ?
+''', ('2000-01-01 00:00:00', 100))
+
+# (hot table, archive table, columns, column the batch is selected by)
+ARCHIVE_TABLES = (
+    ('orders', 'archived_orders', 'id, user_id, qr_code, status, created_at', 'id'),
+    ('order_lines', 'archived_order_lines', 'id, order_id, product_id, quantity, created_at', 'order_id'),
+    ('items', 'archived_items', 'id, product_id, qr_code, status, validated, validated_at, validated_by, '
+                                'created_at, order_id, order_line_id', 'order_id'),
+)
+
+def init_archive_schema(cursor):
+    """Create the archive tables (called from init_db)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_orders (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            qr_code TEXT,
+            status TEXT NOT NULL,
+            created_at DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_order_lines (
+            id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            created_at DATETIME
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_items (
+            id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            qr_code TEXT NOT NULL,
+            status TEXT NOT NULL,
+            validated BOOLEAN,
+            validated_at DATETIME,
+            validated_by INTEGER,
+            created_at DATETIME,
+            order_id INTEGER,
+            order_line_id INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_orders_user ON archived_orders(user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_order_lines_order ON archived_order_lines(order_id, product_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_items_order ON archived_items(order_id)')
+
+def archive_closed_orders(days=None, batch_size=None, job=None):
+    """Move closed orders older than days, with their lines and items, to the archive tables
+    
+    Each batch is copied and deleted in one IMMEDIATE transaction. Orders that still
+    have reserved items are left until the reservation sweeper has released them.
+    Returns {'orders': n, 'order_lines': n, 'items': n}.
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    batch_size = min(batch_size or JOB_BATCH_SIZE, SQLITE_MAX_IN_PARAMS)
+    started = time.perf_counter()
+    archived = dict.fromkeys((table for table, _, _, _ in ARCHIVE_TABLES), 0)
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT datetime('now', ?)", (f'-{int(days * 86400)} seconds',))
+        cutoff = cursor.fetchone()[0]
+        if job:
+            cursor.execute(f'SELECT COUNT(*) FROM ({SQL_ARCHIVABLE_ORDERS})', (cutoff, -1))
+            job.progress(0, cursor.fetchone()[0], 'Archiving orders')
+        while True:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(SQL_ARCHIVABLE_ORDERS, (cutoff, batch_size))
+            order_ids = [row['id'] for row in cursor.fetchall()]
+            if not order_ids:
+                conn.commit()
+                break
+            placeholders = ','.join('?' * len(order_ids))
+            for table, archive_table, columns, key in ARCHIVE_TABLES:
+                cursor.execute(f'INSERT INTO {archive_table} ({columns}) SELECT {columns} FROM {table} WHERE {key} IN ({placeholders})',
+                               order_ids)
+                archived[table] += cursor.rowcount
+            # Children first, the copies above are already in the archive
+            for table, _, _, key in reversed(ARCHIVE_TABLES):
+                cursor.execute(f'DELETE FROM {table} WHERE {key} IN ({placeholders})', order_ids)
+            if job:
+                job.progress(archived['orders'], conn=conn)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    
+    for table, count in archived.items():
+        if count:
+            metrics.registry.inc('archived_rows_total', {'table': table}, count)
+    metrics.registry.observe('archive_run_duration_seconds', {}, time.perf_counter() - started)
+    metrics.registry.flush()
+    if archived['orders']:
+        admin_log.info("Archived closed orders", extra=dict(archived, days=days, ms=round((time.perf_counter() - started) * 1000)))
+    return archived
+
+@job_queue.handler('archive_orders')
+def archive_orders_job(job, payload):
+    return archive_closed_orders(days=payload.get('days'), job=job)
+
+# Analytics rollups
+# Reservations, sales, order item scans and cancellations are counted per product
+# per hour and per day in rollup_hourly / rollup_daily. Triggers keep them current
+# in the same transaction as the state change, whichever code path makes it
+# (checkout, scans, approvals, the reservation sweeper, product deletion), so the
+# dashboard reads a few rows per day instead of scanning orders and items.
+ROLLUP_METRICS = ('reserved', 'sold', 'scanned', 'cancelled')
+# Bucket expressions of a timestamp expression
+ROLLUP_TABLES = (
+    ('rollup_hourly', "strftime('%Y-%m-%d %H:00', {ts})"),
+    ('rollup_daily', "date({ts})"),
+)
+# Hourly rows older than this are deleted by database maintenance
+ROLLUP_HOURLY_DAYS = int(os.environ.get('ROLLUP_HOURLY_DAYS', '14'))
+
+# (trigger, event, condition, metric, rows as "SELECT/VALUES ts, product_id, count")
+ROLLUP_TRIGGERS = (
+    ('rollup_items_reserved', 'UPDATE OF status ON items', "OLD.status = 'available' AND NEW.status = 'reserved'",
+     'reserved', "VALUES ({bucket}, NEW.product_id, 1)"),
+    ('rollup_items_sold', 'UPDATE OF status ON items', "OLD.status = 'reserved' AND NEW.status = 'sold'",
+     'sold', "VALUES ({bucket}, NEW.product_id, 1)"),
+    # Scans of ordered items only - admins validating stock are not customer scans
+    ('rollup_items_scanned', 'UPDATE OF validated ON items', 'OLD.validated = 0 AND NEW.validated = 1 AND NEW.order_id IS NOT NULL',
+     'scanned', "VALUES ({bucket}, NEW.product_id, 1)"),
+    ('rollup_orders_cancelled', 'UPDATE OF status ON orders', "OLD.status != 'cancelled' AND NEW.status = 'cancelled'",
+     'cancelled', "SELECT {bucket}, product_id, quantity FROM order_lines WHERE order_id = NEW.id"),
+)
+
+# History from before the rollup tables existed: (metric, rows with ts, product_id, n)
+ROLLUP_BACKFILL = (
+    ('reserved', '''
+        SELECT created_at AS ts, product_id, quantity AS n FROM order_lines
+        UNION ALL SELECT created_at, product_id, quantity FROM archived_order_lines
+    '''),
+    # Orders have no confirmation time - sales are counted at the order time
+    ('sold', '''
+        SELECT o.created_at AS ts, l.product_id, l.quantity AS n
+        FROM orders o JOIN order_lines l ON l.order_id = o.id WHERE o.status = 'confirmed'
+        UNION ALL
+        SELECT o.created_at, l.product_id, l.quantity
+        FROM archived_orders o JOIN archived_order_lines l ON l.order_id = o.id WHERE o.status = 'confirmed'
+    '''),
+    ('cancelled', '''
+        SELECT o.created_at AS ts, l.product_id, l.quantity AS n
+        FROM orders o JOIN order_lines l ON l.order_id = o.id WHERE o.status = 'cancelled'
+        UNION ALL
+        SELECT o.created_at, l.product_id, l.quantity
+        FROM archived_orders o JOIN archived_order_lines l ON l.order_id = o.id WHERE o.status = 'cancelled'
+    '''),
+    ('scanned', '''
+        SELECT validated_at AS ts, product_id, 1 AS n FROM items WHERE order_id IS NOT NULL AND validated = 1
+        UNION ALL
+        SELECT validated_at, product_id, 1 FROM archived_items WHERE order_id IS NOT NULL AND validated = 1
+    '''),
+)
+
+def _rollup_upsert(table, metric, rows):
+    return f'''
+        INSERT INTO {table} (bucket, product_id, {metric}) {rows}
+        ON CONFLICT(bucket, product_id) DO UPDATE SET {metric} = {metric} + excluded.{metric}
+    '''
+
+def init_rollup_schema(cursor):
+    """Create the rollup tables and their triggers, backfilling them once (called from init_db after the archive tables)"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_daily'")
+    new_tables = cursor.fetchone() is None
+    counters = ', '.join(f'{metric} INTEGER NOT NULL DEFAULT 0' for metric in ROLLUP_METRICS)
+    for table, _ in ROLLUP_TABLES:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                {counters},
+                PRIMARY KEY (bucket, product_id)
+            ) WITHOUT ROWID
+        ''')
+    for name, event, condition, metric, rows in ROLLUP_TRIGGERS:
+        body = ';'.join(_rollup_upsert(table, metric, rows.format(bucket=bucket.format(ts="'now'")))
+                        for table, bucket in ROLLUP_TABLES)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event}
+            FOR EACH ROW WHEN {condition}
+            BEGIN {body}; END
+        ''')
+    if new_tables:
+        for metric, rows in ROLLUP_BACKFILL:
+            for table, bucket in ROLLUP_TABLES:
+                cursor.execute(_rollup_upsert(table, metric, f'''
+                    SELECT {bucket.format(ts='ts')}, product_id, SUM(n) FROM ({rows})
+                    WHERE ts IS NOT NULL GROUP BY 1, 2
+                '''))
+
+@maintenance_scheduler.task('purge_rollups')
+def purge_hourly_rollups(conn, deadline):
+    """Delete hourly rollup rows older than ROLLUP_HOURLY_DAYS (the daily rows are kept)"""
+    cursor = conn.execute("DELETE FROM rollup_hourly WHERE bucket < strftime('%Y-%m-%d %H:00', 'now', ?)",
+                          (f'-{ROLLUP_HOURLY_DAYS} days',))
+    conn.commit()
+    return {'deleted': cursor.rowcount}
+
+SQL_ROLLUP_DAILY = query_plans.register('rollup_daily', '''
+    SELECT bucket AS day, SUM(reserved) AS reserved, SUM(sold) AS sold,
+           SUM(scanned) AS scanned, SUM(cancelled) AS cancelled
+    FROM rollup_daily
+    WHERE bucket >= ?
+    GROUP BY bucket
+    ORDER BY bucket
+''', ('2000-01-01',))
+
+SQL_ROLLUP_HOURLY = query_plans.register('rollup_hourly', '''
+    SELECT bucket AS hour, SUM(reserved) AS reserved, SUM(sold) AS sold,
+           SUM(scanned) AS scanned, SUM(cancelled) AS cancelled
+    FROM rollup_hourly
+    WHERE bucket >= ?
+    GROUP BY bucket
+    ORDER BY bucket
+''', ('2000-01-01 00:00',))
+
+SQL_ROLLUP_TOP_PRODUCTS = query_plans.register('rollup_top_products', '''
+    SELECT r.product_id, p.category, p.size, p.color,
+           SUM(r.sold) AS sold, SUM(r.reserved) AS reserved, SUM(r.cancelled) AS cancelled
+    FROM rollup_daily r
+    JOIN products p ON p.id = r.product_id
+    WHERE r.bucket >= ?
+    GROUP BY r.product_id
+    ORDER BY sold DESC, reserved DESC
+    LIMIT ?
+''', ('2000-01-01', 10))
+
+SQL_CREATE_ORDERS = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        qr_code TEXT UNIQUE,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'approved', 'confirmed', 'cancelled')),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
     )
-    return dict(count)['count'] if count else 0
+'''
+
+def migrate_order_lines(cursor):
+    """Convert orders with product_id/quantity columns (one product per order) to order_lines
+    
+    Every old order becomes an order with one line and its items are linked to that
+    line. SQLite can't drop the product_id column (it has a foreign key), so the
+    orders table is rebuilt. Runs inside init_db's transaction. Returns True if it migrated.
+    """
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(orders)').fetchall()}
+    if 'product_id' not in columns:
+        return False
+    
+    print("Migrating orders to order_lines...")
+    cursor.execute('''
+        INSERT INTO order_lines (order_id, product_id, quantity, created_at)
+        SELECT id, product_id, quantity, created_at FROM orders ORDER BY id
+    ''')
+    cursor.execute('''
+        UPDATE items
+        SET order_line_id = (SELECT l.id FROM order_lines l WHERE l.order_id = items.order_id)
+        WHERE order_id IS NOT NULL
+    ''')
+    cursor.execute(SQL_CREATE_ORDERS.format(table='orders_migrated'))
+    cursor.execute('''
+        INSERT INTO orders_migrated (id, user_id, qr_code, status, created_at)
+        SELECT id, user_id, qr_code, status, created_at FROM orders
+    ''')
+    cursor.execute('DROP TABLE orders')
+    cursor.execute('ALTER TABLE orders_migrated RENAME TO orders')
+    migrated = cursor.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+    print(f"[OK] Migrated {migrated} orders to order_lines")
+    return True
 
 # Initialize database tables
 def init_db():
@@ -128,6 +1355,11 @@ def init_db():
         conn = get_db()
         cursor = conn.cursor()
         
+        # WAL lets readers carry on while a worker writes. Incremental auto_vacuum only
+        # takes effect on a new database (maintenance converts existing ones).
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
         # Users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -166,17 +1398,18 @@ def init_db():
         except:
             pass  # Column already exists
         
-        # Orders table
+        # Orders table - one order per checkout, its products are in order_lines
+        cursor.execute(SQL_CREATE_ORDERS.format(table='orders'))
+        
+        # Order lines - one per product of an order
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
+            CREATE TABLE IF NOT EXISTS order_lines (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
+                order_id INTEGER NOT NULL,
                 product_id INTEGER NOT NULL,
                 quantity INTEGER NOT NULL DEFAULT 1,
-                qr_code TEXT UNIQUE,
-                status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'approved', 'confirmed', 'cancelled')),
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (order_id) REFERENCES orders(id),
                 FOREIGN KEY (product_id) REFERENCES products(id)
             )
         ''')
@@ -206,8 +1439,10 @@ def init_db():
                 validated_by INTEGER NULL,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 order_id INTEGER NULL,
+                order_line_id INTEGER NULL,
                 FOREIGN KEY (product_id) REFERENCES products(id),
                 FOREIGN KEY (order_id) REFERENCES orders(id),
+                FOREIGN KEY (order_line_id) REFERENCES order_lines(id),
                 FOREIGN KEY (validated_by) REFERENCES users(id)
             )
         ''')
@@ -225,6 +1460,46 @@ def init_db():
             cursor.execute('ALTER TABLE items ADD COLUMN validated_by INTEGER NULL')
         except:
             pass
+        try:
+            cursor.execute('ALTER TABLE items ADD COLUMN order_line_id INTEGER NULL REFERENCES order_lines(id)')
+        except:
+            pass
+        
+        # Databases from before order_lines have one product per order row
+        migrate_order_lines(cursor)
+        
+        # Indexes for the hot queries (see query_plans.HOT_QUERIES)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_items_product_status ON items(product_id, status, validated)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_items_order ON items(order_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_user ON cart(user_id, product_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_lines_order ON order_lines(order_id, product_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_lines_product ON order_lines(product_id, order_id)')
+        
+        # Soft cart holds (only used with CART_HOLDS=1)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cart_holds (
+                user_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (user_id, product_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_holds_product ON cart_holds(product_id, expires_at)')
+        
+        # Archive of old closed orders
+        init_archive_schema(cursor)
+        
+        # Per product hourly/daily counters for the admin dashboard
+        init_rollup_schema(cursor)
+        
+        # Background jobs table
+        jobs.init_schema(cursor)
+        
+        # Maintenance run log and cross-worker lock
+        maintenance.init_schema(cursor)
         
         conn.commit()
         cursor.close()
@@ -309,25 +1584,7 @@ def homepage():
     if 'loggedin' not in session or session['user_type'] != 'customer':
         return redirect(url_for('login'))
     
-    # Get categories that have products with items (validated or not)
-    # This shows all categories, and products page will filter by validated items
-    categories_result = query_db('''
-        SELECT DISTINCT p.category
-        FROM products p
-        INNER JOIN items i ON p.id = i.product_id
-        WHERE i.status = 'available'
-        ORDER BY p.category
-    ''')
-    categories = [dict(row) for row in categories_result] if categories_result else []
-    
-    # If no categories with items, show categories that have products (in case items haven't been created yet)
-    if not categories:
-        categories_result = query_db('''
-            SELECT DISTINCT category
-            FROM products
-            ORDER BY category
-        ''')
-        categories = [dict(row) for row in categories_result] if categories_result else []
+    categories = get_categories()
     
     return render_template('homepage.html', categories=categories, username=session['username'])
 
@@ -337,40 +1594,7 @@ def products():
         return redirect(url_for('login'))
     
     category = request.args.get('category', 'T-Shirt')
-    products_list = query_db('''
-        SELECT * FROM products 
-        WHERE category = ?
-        ORDER BY color, size
-    ''', (category,))
-    products_list = [dict(row) for row in products_list]
-    
-    # Calculate available stock from items table (validated items only for purchasing)
-    # But show products even if they have unvalidated items
-    filtered_products = []
-    for product in products_list:
-        # Get validated available stock (for purchasing)
-        available_stock = get_product_stock(product['id'])
-        
-        # Get total available items (validated or not) - for display
-        total_available = query_db(
-            'SELECT COUNT(*) as count FROM items WHERE product_id = ? AND status = ?',
-            (product['id'], 'available'),
-            one=True
-        )
-        total_available_count = dict(total_available)['count'] if total_available else 0
-        
-        # Show product if it has any available items (validated or not)
-        if total_available_count > 0:
-            product['stock'] = available_stock  # Validated stock for purchasing
-            product['total_available'] = total_available_count  # Total items for display
-            # Items are validated when created by admin, so no validation needed
-            product['needs_validation'] = False
-            filtered_products.append(product)
-    
-    # Ensure all products have image URLs based on category
-    for product in filtered_products:
-        if not product.get('image_url') or product.get('image_url') == '' or product.get('image_url') is None:
-            product['image_url'] = get_product_image_url(product['category'], product['color'])
+    filtered_products = get_category_products(category)
     
     return render_template('products.html', products=filtered_products, category=category)
 
@@ -382,8 +1606,30 @@ def add_to_cart():
     product_id = request.form.get('product_id')
     quantity = int(request.form.get('quantity', 1))
     
+    if CART_HOLDS:
+        # One count in one transaction - the hold keeps the stock for checkout
+        conn = get_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cart_item = conn.execute('SELECT id, quantity FROM cart WHERE user_id = ? AND product_id = ?',
+                                     (session['id'], product_id)).fetchone()
+            new_quantity = (cart_item['quantity'] if cart_item else 0) + quantity
+            held, available = place_cart_hold(conn, session['id'], int(product_id), new_quantity)
+            if not held:
+                conn.rollback()
+                return jsonify({'success': False, 'message': f'Insufficient stock. Available: {available}'})
+            if cart_item:
+                conn.execute('UPDATE cart SET quantity = ? WHERE id = ?', (new_quantity, cart_item['id']))
+            else:
+                conn.execute('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)',
+                            (session['id'], product_id, quantity))
+            conn.commit()
+        finally:
+            conn.close()
+        return jsonify({'success': True, 'message': 'Added to cart successfully'})
+    
     # Check stock availability from items table
-    available_stock = get_product_stock(product_id)
+    available_stock = get_product_stock(product_id, use_cache=False)
     
     if available_stock < quantity:
         return jsonify({'success': False, 'message': f'Insufficient stock. Available: {available_stock}'})
@@ -396,7 +1642,7 @@ def add_to_cart():
     if cart_item:
         new_quantity = cart_item['quantity'] + quantity
         # Check available stock again
-        current_available = get_product_stock(product_id)
+        current_available = get_product_stock(product_id, use_cache=False)
         if new_quantity > current_available:
             conn.close()
             return jsonify({'success': False, 'message': f'Insufficient stock. Available: {current_available}'})
@@ -414,17 +1660,7 @@ def cart():
     if 'loggedin' not in session or session['user_type'] != 'customer':
         return redirect(url_for('login'))
     
-    cart_items = query_db('''
-        SELECT c.id, c.quantity, p.id as product_id, p.category, p.size, p.color
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id = ?
-    ''', (session['id'],))
-    cart_items = [dict(row) for row in cart_items]
-    
-    # Add available stock from items table
-    for item in cart_items:
-        item['stock'] = get_product_stock(item['product_id'])
+    cart_items = get_cart_items(session['id'])
     
     return render_template('cart.html', cart_items=cart_items)
 
@@ -433,6 +1669,11 @@ def remove_from_cart(cart_id):
     if 'loggedin' not in session or session['user_type'] != 'customer':
         return redirect(url_for('login'))
     
+    if CART_HOLDS:
+        query_db('''
+            DELETE FROM cart_holds
+            WHERE user_id = ? AND product_id = (SELECT product_id FROM cart WHERE id = ? AND user_id = ?)
+        ''', (session['id'], cart_id, session['id']))
     query_db('DELETE FROM cart WHERE id = ? AND user_id = ?', (cart_id, session['id']))
     
     return redirect(url_for('cart'))
@@ -459,8 +1700,23 @@ def update_cart_quantity():
     if not cart_item:
         return jsonify({'success': False, 'message': 'Cart item not found'})
     
+    if CART_HOLDS:
+        conn = get_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            held, available = place_cart_hold(conn, session['id'], cart_item['product_id'], new_quantity)
+            if not held:
+                conn.rollback()
+                return jsonify({'success': False, 'message': f'Insufficient stock. Available: {available}'})
+            conn.execute('UPDATE cart SET quantity = ? WHERE id = ? AND user_id = ?',
+                         (new_quantity, cart_id, session['id']))
+            conn.commit()
+        finally:
+            conn.close()
+        return jsonify({'success': True, 'message': 'Quantity updated successfully'})
+    
     # Check available stock
-    available_stock = get_product_stock(cart_item['product_id'])
+    available_stock = get_product_stock(cart_item['product_id'], use_cache=False)
     
     if new_quantity > available_stock:
         return jsonify({'success': False, 'message': f'Insufficient stock. Available: {available_stock}'})
@@ -474,6 +1730,140 @@ def update_cart_quantity():
     
     return jsonify({'success': True, 'message': 'Quantity updated successfully'})
 
+# Cart sync - the cart page sends all quantity changes and removals made in a short
+# time as one request instead of one POST per change
+CART_SYNC_MAX_CHANGES = 100
+
+@app.route('/api/cart/sync', methods=['POST'])
+def cart_sync():
+    """Apply a list of cart changes in one transaction, all or nothing
+    
+    Body: {"changes": [{"op": "add", "product_id": 3, "quantity": 2},
+                       {"op": "update", "cart_id": 5, "quantity": 4},
+                       {"op": "remove", "cart_id": 7}]}
+    Stock of every changed line is checked with one grouped query. On success the
+    whole cart is returned; if any line lacks stock nothing changes (409).
+    """
+    if 'loggedin' not in session or session['user_type'] != 'customer':
+        return jsonify({'success': False, 'message': 'Please login'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    changes = data.get('changes')
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'success': False, 'message': 'changes must be a non-empty list'}), 400
+    if len(changes) > CART_SYNC_MAX_CHANGES:
+        return jsonify({'success': False, 'message': f'Too many changes in one request (max {CART_SYNC_MAX_CHANGES})'}), 400
+    
+    user_id = session['id']
+    conn = None
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        # Stock checks and writes are one transaction, so no other checkout can slip in between
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT id, product_id, quantity FROM cart WHERE user_id = ?', (user_id,))
+        lines = {row['product_id']: dict(row) for row in cursor.fetchall()}
+        product_by_cart_id = {line['id']: product_id for product_id, line in lines.items()}
+        
+        # Target quantity per product after all changes, in order (0 removes the line)
+        targets = {product_id: line['quantity'] for product_id, line in lines.items()}
+        for change in changes:
+            try:
+                op = change['op']
+                if op == 'add':
+                    product_id = int(change['product_id'])
+                    quantity = int(change.get('quantity', 1))
+                    targets[product_id] = targets.get(product_id, 0) + quantity
+                else:
+                    product_id = product_by_cart_id.get(int(change['cart_id']))
+                    if product_id is None:
+                        raise KeyError('cart_id')
+                    if op == 'update':
+                        quantity = int(change['quantity'])
+                        targets[product_id] = quantity
+                    elif op == 'remove':
+                        quantity = 0
+                        targets[product_id] = 0
+                    else:
+                        raise ValueError(op)
+            except (KeyError, TypeError, ValueError):
+                conn.rollback()
+                return jsonify({'success': False, 'message': 'Invalid change', 'change': change}), 400
+            if op != 'remove' and quantity < 1:
+                conn.rollback()
+                return jsonify({'success': False, 'message': 'Quantity must be at least 1', 'change': change}), 400
+        
+        changed = [product_id for product_id, quantity in targets.items()
+                   if quantity != lines.get(product_id, {}).get('quantity', 0)]
+        wanted = [product_id for product_id in changed if targets[product_id] > 0]
+        
+        # Validated available stock of all changed lines in one grouped query
+        stock = dict.fromkeys(wanted, 0)
+        if wanted:
+            placeholders = ','.join('?' * len(wanted))
+            cursor.execute(f'''
+                SELECT product_id, COUNT(*) as count FROM items
+                WHERE product_id IN ({placeholders}) AND status = 'available' AND validated = 1
+                GROUP BY product_id
+            ''', wanted)
+            stock.update({row['product_id']: row['count'] for row in cursor.fetchall()})
+            if CART_HOLDS:
+                # Stock held by other customers is not available
+                cursor.execute(f'''
+                    SELECT product_id, SUM(quantity) as held FROM cart_holds
+                    WHERE product_id IN ({placeholders}) AND user_id != ? AND expires_at > ?
+                    GROUP BY product_id
+                ''', wanted + [user_id, time.time()])
+                for row in cursor.fetchall():
+                    stock[row['product_id']] = max(stock[row['product_id']] - row['held'], 0)
+        
+        shortages = [{'product_id': product_id, 'requested': targets[product_id], 'available': stock[product_id]}
+                     for product_id in wanted if targets[product_id] > stock[product_id]]
+        if shortages:
+            conn.rollback()
+            return jsonify({
+                'success': False,
+                'message': 'Insufficient stock. ' + ', '.join(f"Available: {s['available']}" for s in shortages),
+                'shortages': shortages
+            }), 409
+        
+        removed = [product_id for product_id in changed if targets[product_id] <= 0 and product_id in lines]
+        cursor.executemany('DELETE FROM cart WHERE user_id = ? AND product_id = ?',
+                           [(user_id, product_id) for product_id in removed])
+        cursor.executemany('UPDATE cart SET quantity = ? WHERE id = ?',
+                           [(targets[product_id], lines[product_id]['id']) for product_id in wanted if product_id in lines])
+        cursor.executemany('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)',
+                           [(user_id, product_id, targets[product_id]) for product_id in wanted if product_id not in lines])
+        if CART_HOLDS:
+            cursor.executemany('DELETE FROM cart_holds WHERE user_id = ? AND product_id = ?',
+                               [(user_id, product_id) for product_id in removed])
+            cursor.executemany('''
+                INSERT INTO cart_holds (user_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at
+            ''', [(user_id, product_id, targets[product_id], time.time() + CART_HOLD_TTL) for product_id in wanted])
+        conn.commit()
+        
+        cursor.execute(SQL_CART_ITEMS, (user_id,))
+        cart_items = [dict(row) for row in cursor.fetchall()]
+        cursor.close()
+    except Exception:
+        checkout_log.exception("Error in cart_sync")
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': 'Could not update cart, please retry'}), 500
+    finally:
+        if conn:
+            conn.close()
+    
+    checkout_log.debug("Cart synced", extra={'user_id': user_id, 'changes': len(changes), 'lines_changed': len(changed)})
+    return jsonify({'success': True, 'message': 'Cart updated', 'cart': cart_items})
+
+SQL_RESERVE_ITEMS = query_plans.register('reserve_items', '''
+    SELECT id FROM items 
+    WHERE product_id = ? AND status = 'available' AND validated = 1
+    LIMIT ?
+''', (1, 1))
+
 @app.route('/checkout', methods=['GET', 'POST'])
 def checkout():
     if 'loggedin' not in session or session['user_type'] != 'customer':
@@ -493,45 +1883,55 @@ def checkout():
             flash('Your cart is empty. Please add items to cart first.', 'error')
             return redirect(url_for('cart'))
         
-        # Validate stock from items table
-        for item in cart_items:
-            available_stock = get_product_stock(item['product_id'])
-            if item['quantity'] > available_stock:
-                flash(f'Insufficient stock. Available: {available_stock}, Requested: {item["quantity"]}', 'error')
-                return redirect(url_for('cart'))
+        # Validate stock from items table (held cart lines were checked when they were held)
+        if not CART_HOLDS:
+            for item in cart_items:
+                available_stock = get_product_stock(item['product_id'], use_cache=False)
+                if item['quantity'] > available_stock:
+                    flash(f'Insufficient stock. Available: {available_stock}, Requested: {item["quantity"]}', 'error')
+                    return redirect(url_for('cart'))
         
         # Create orders, reserve items, and generate QR codes
         conn = get_db()
         cursor = conn.cursor()
         
-        print(f"DEBUG: Creating orders for {len(cart_items)} items")
+        if CART_HOLDS:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT product_id, quantity FROM cart_holds WHERE user_id = ? AND expires_at > ?',
+                           (session['id'], time.time()))
+            holds = {row['product_id']: row['quantity'] for row in cursor.fetchall()}
+            for item in cart_items:
+                if holds.get(item['product_id'], 0) >= item['quantity']:
+                    continue
+                # Hold expired (or the cart predates CART_HOLDS) - hold it now or fail
+                held, available_stock = place_cart_hold(conn, session['id'], item['product_id'], item['quantity'])
+                if not held:
+                    conn.rollback()
+                    cursor.close()
+                    conn.close()
+                    flash(f'Insufficient stock. Available: {available_stock}, Requested: {item["quantity"]}', 'error')
+                    return redirect(url_for('cart'))
+        
+        checkout_log.debug("Creating orders", extra={'user_id': session['id'], 'cart_lines': len(cart_items)})
+        # Checked once so per-item logging costs nothing when DEBUG is off
+        debug_items = checkout_log.isEnabledFor(logging.DEBUG)
+        
+        # One order for the whole cart, with a line per product
+        # Insert order without QR code (only items have QR codes)
+        cursor.execute("INSERT INTO orders (user_id, status) VALUES (?, 'pending')", (session['id'],))
+        order_id = cursor.lastrowid
+        checkout_log.debug("Created order", extra={'order_id': order_id, 'status': 'pending'})
         
         for item in cart_items:
-            # Insert order without QR code (only items have QR codes)
-            cursor.execute('''
-                INSERT INTO orders (user_id, product_id, quantity, status)
-                VALUES (?, ?, ?, 'pending')
-            ''', (session['id'], item['product_id'], item['quantity']))
-            order_id = cursor.lastrowid
-            print(f"DEBUG: Created order {order_id} (status: pending)")
+            cursor.execute('INSERT INTO order_lines (order_id, product_id, quantity) VALUES (?, ?, ?)',
+                           (order_id, item['product_id'], item['quantity']))
+            line_id = cursor.lastrowid
             
             # Reserve items for this order - only validated items (change status from 'available' to 'reserved')
-            cursor.execute('''
-                SELECT id FROM items 
-                WHERE product_id = ? AND status = 'available' AND validated = 1
-                LIMIT ?
-            ''', (item['product_id'], item['quantity']))
+            cursor.execute(SQL_RESERVE_ITEMS, (item['product_id'], item['quantity']))
             available_items = cursor.fetchall()
             
             if len(available_items) < item['quantity']:
-                # Check if there are unvalidated items
-                cursor.execute('''
-                    SELECT COUNT(*) as count FROM items 
-                    WHERE product_id = ? AND status = 'available' AND validated = 0
-                ''', (item['product_id'],))
-                unvalidated_count = cursor.fetchone()
-                unvalidated = unvalidated_count[0] if unvalidated_count else 0
-                
                 # Rollback
                 conn.rollback()
                 cursor.close()
@@ -545,10 +1945,11 @@ def checkout():
                 item_id = item_row['id'] if isinstance(item_row, dict) else item_row[0]
                 cursor.execute('''
                     UPDATE items 
-                    SET status = ?, order_id = ?, validated = 0, validated_at = NULL
+                    SET status = ?, order_id = ?, order_line_id = ?, validated = 0, validated_at = NULL
                     WHERE id = ?
-                ''', ('reserved', order_id, item_id))
-                print(f"DEBUG: Reserved item {item_id} for order {order_id} - validated status reset to 0")
+                ''', ('reserved', order_id, line_id, item_id))
+                if debug_items:
+                    checkout_log.debug("Reserved item", extra={'item_id': item_id, 'order_id': order_id})
             
             # Update product stock count from available items
             cursor.execute('''
@@ -559,58 +1960,74 @@ def checkout():
         
         # Clear cart
         cursor.execute('DELETE FROM cart WHERE user_id = ?', (session['id'],))
+        if CART_HOLDS:
+            # The holds are reservations now
+            cursor.execute('DELETE FROM cart_holds WHERE user_id = ?', (session['id'],))
         conn.commit()
         cursor.close()
         conn.close()
+        invalidate_catalog_cache('checkout reserved items')
         
-        print(f"DEBUG: Order created successfully. Cart cleared.")
+        checkout_log.info("Order created, cart cleared", extra={'user_id': session['id'], 'order_id': order_id, 'cart_lines': len(cart_items)})
         flash('Order placed successfully! Waiting for approval.', 'success')
         return redirect(url_for('orders'))
     
     # GET request - show checkout page
-    cart_items = query_db('''
-        SELECT c.id, c.quantity, p.category, p.size, p.color, p.id as product_id
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id = ?
-    ''', (session['id'],))
-    cart_items = [dict(row) for row in cart_items]
-    
-    # Add available stock from items table
-    for item in cart_items:
-        item['stock'] = get_product_stock(item['product_id'])
+    cart_items = get_cart_items(session['id'])
     
     return render_template('checkout.html', cart_items=cart_items)
 
+# Order history includes archived orders (see archive_closed_orders)
+SQL_CUSTOMER_ORDERS = query_plans.register('customer_orders', '''
+    SELECT o.id as id, o.status, 
+           datetime(o.created_at) as created_at,
+           l.id as line_id, l.product_id, l.quantity, p.category, p.size, p.color
+    FROM orders o
+    JOIN order_lines l ON l.order_id = o.id
+    JOIN products p ON l.product_id = p.id
+    WHERE o.user_id = ?
+    UNION ALL
+    SELECT o.id as id, o.status, 
+           datetime(o.created_at) as created_at,
+           l.id as line_id, l.product_id, l.quantity, p.category, p.size, p.color
+    FROM archived_orders o
+    JOIN archived_order_lines l ON l.order_id = o.id
+    JOIN products p ON l.product_id = p.id
+    WHERE o.user_id = ?
+    ORDER BY created_at DESC, id, line_id
+''', (1, 1))
+
+SQL_CUSTOMER_ORDER_ITEMS = query_plans.register('customer_order_items', '''
+    SELECT i.order_id, i.qr_code, i.id as item_id
+    FROM items i
+    JOIN orders o ON i.order_id = o.id
+    WHERE o.user_id = ?
+    UNION ALL
+    SELECT i.order_id, i.qr_code, i.id as item_id
+    FROM archived_items i
+    JOIN archived_orders o ON i.order_id = o.id
+    WHERE o.user_id = ?
+    ORDER BY item_id
+''', (1, 1))
+
 @app.route('/orders')
 def orders():
     if 'loggedin' not in session or session['user_type'] != 'customer':
         return redirect(url_for('login'))
     
-    orders_result = query_db('''
-        SELECT o.id, o.quantity, o.status, 
-               datetime(o.created_at) as created_at,
-               p.category, p.size, p.color
-        FROM orders o
-        JOIN products p ON o.product_id = p.id
-        WHERE o.user_id = ?
-        ORDER BY o.created_at DESC
-    ''', (session['id'],))
+    orders_result = group_order_lines(query_db(SQL_CUSTOMER_ORDERS, (session['id'], session['id'])))
     orders_list = []
     
+    # Item QR codes of all the customer's orders in one query
+    order_items = group_items_by_order(query_db(SQL_CUSTOMER_ORDER_ITEMS, (session['id'], session['id'])))
+    
     # Check for newly confirmed orders and show notification
     has_confirmed_orders = False
     confirmed_count = 0
     
-    # Convert to dicts and get item QR codes for each order
-    for row in orders_result:
-        order = dict(row)  # Convert sqlite3.Row to dict to avoid .items() method conflict
-        items = query_db('''
-            SELECT i.qr_code, i.id as item_id
-            FROM items i
-            WHERE i.order_id = ?
-        ''', (order['id'],))
-        order['items'] = [dict(item) for item in items] if items else []
+    # Attach item QR codes to each order
+    for order in orders_result:
+        order['items'] = order_items.get(order['id'], [])
         
         # Check if order is confirmed
         if order['status'] == 'confirmed':
@@ -645,116 +2062,107 @@ def admin_dashboard():
     if 'loggedin' not in session or session['user_type'] != 'admin':
         return redirect(url_for('login'))
     
-    total_products = query_db('SELECT COUNT(*) as total FROM products', one=True)['total']
-    total_orders = query_db('SELECT COUNT(*) as total FROM orders', one=True)['total']
+    total_products = query_report('SELECT COUNT(*) as total FROM products', one=True)['total']
+    total_orders = query_report('SELECT (SELECT COUNT(*) FROM orders) + (SELECT COUNT(*) FROM archived_orders) as total',
+                                one=True)['total']
     
     return render_template('admin/dashboard.html', 
                          total_products=total_products, 
                          total_orders=total_orders,
                          username=session['username'])
 
-@app.route('/admin/products', methods=['GET', 'POST'])
-def admin_products():
+@app.route('/admin/dashboard/data')
+def admin_dashboard_data():
+    """Sales over time and top products from the rollup tables as JSON (?days=30)"""
     if 'loggedin' not in session or session['user_type'] != 'admin':
-        return redirect(url_for('login'))
+        return jsonify({'error': 'Admin login required'}), 401
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
     
-    if request.method == 'POST':
-        category = request.form['category']
-        size = request.form['size']
-        color = request.form['color']
-        stock = int(request.form['stock'])
-        
-        conn = get_db()
-        cursor = conn.cursor()
+    since = datetime.utcfromtimestamp(time.time() - (days - 1) * 86400).strftime('%Y-%m-%d')
+    since_hour = datetime.utcfromtimestamp(time.time() - 23 * 3600).strftime('%Y-%m-%d %H:00')
+    daily = query_report(SQL_ROLLUP_DAILY, (since,))
+    hourly = query_report(SQL_ROLLUP_HOURLY, (since_hour,))
+    top_products = query_report(SQL_ROLLUP_TOP_PRODUCTS, (since, 10))
+    
+    return jsonify({
+        'days': days,
+        'daily': [dict(row) for row in daily],
+        'hourly': [dict(row) for row in hourly],
+        'top_products': [dict(row) for row in top_products],
+        'as_of': g.get('report_as_of'),
+    })
+
+def create_product(cursor, category, size, color):
+    """Insert a new product (items are added separately) and return its id"""
+    # Generate unique QR code for new product - check BOTH products and orders tables
+    admin_log.debug("Generating unique QR code for new product %s %s %s", category, size, color)
+    qr_code = secrets.token_urlsafe(16)
+    max_attempts = 50
+    attempts = 0
+    is_duplicate = True
+    
+    # Keep generating until we find a unique QR code
+    while is_duplicate and attempts < max_attempts:
+        # Check in products table
+        cursor.execute('SELECT id FROM products WHERE qr_code = ?', (qr_code,))
+        dup_in_products = cursor.fetchone()
         
-        # Check if product exists
-        cursor.execute('SELECT id, stock, qr_code FROM products WHERE category = ? AND size = ? AND color = ?',
-                      (category, size, color))
-        existing = cursor.fetchone()
+        # Check in items table
+        cursor.execute('SELECT id FROM items WHERE qr_code = ?', (qr_code,))
+        dup_in_items = cursor.fetchone()
         
-        if existing:
-            # Product exists - create new items with unique QR codes
-            product_id = existing['id']
-            items_created = 0
-            
-            for i in range(stock):
-                try:
-                    item_qr_code = generate_unique_item_qr_code(cursor)
-                    # Items are validated when created by admin - ready for customer orders
-                    cursor.execute(
-                        'INSERT INTO items (product_id, qr_code, status, validated, validated_at) VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)',
-                        (product_id, item_qr_code, 'available')
-                    )
-                    items_created += 1
-                except Exception as e:
-                    print(f"Error creating item {i+1}: {e}")
-            
-            # Update product stock count from items
-            cursor.execute('''
-                UPDATE products 
-                SET stock = (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available')
-                WHERE id = ?
-            ''', (product_id, product_id))
-            
-            if items_created > 0:
-                print(f"DEBUG: Created {items_created} items with unique QR codes for existing product {product_id}")
-        else:
-            # Generate unique QR code for new product - check BOTH products and orders tables
-            print(f"DEBUG: Generating unique QR code for new product: {category} {size} {color}")
+        if dup_in_products or dup_in_items:
+            # Duplicate found, generate new one
+            admin_log.debug("Duplicate QR code found (attempt %d), generating new one", attempts + 1)
             qr_code = secrets.token_urlsafe(16)
-            max_attempts = 50
-            attempts = 0
-            is_duplicate = True
-            
-            # Keep generating until we find a unique QR code
-            while is_duplicate and attempts < max_attempts:
-                # Check in products table
-                cursor.execute('SELECT id FROM products WHERE qr_code = ?', (qr_code,))
-                dup_in_products = cursor.fetchone()
-                
-                # Check in items table
-                cursor.execute('SELECT id FROM items WHERE qr_code = ?', (qr_code,))
-                dup_in_items = cursor.fetchone()
-                
-                if dup_in_products or dup_in_items:
-                    # Duplicate found, generate new one
-                    print(f"DEBUG: Duplicate QR code found (attempt {attempts + 1}), generating new one...")
-                    qr_code = secrets.token_urlsafe(16)
-                    attempts += 1
-                else:
-                    # Unique QR code found
-                    is_duplicate = False
-                    print(f"DEBUG: Unique QR code generated: {qr_code[:20]}... (after {attempts} attempts)")
-            
-            if attempts >= max_attempts:
-                flash('Error generating unique QR code. Please try again.', 'error')
-                conn.rollback()
-                cursor.close()
-                conn.close()
-                return redirect(url_for('admin_products'))
-            
-            # Generate image URL based on category and color
-            image_url = get_product_image_url(category, color)
-            
-            # Insert new product (without QR code - items have QR codes now)
-            cursor.execute('INSERT INTO products (category, size, color, stock, image_url) VALUES (?, ?, ?, 0, ?)',
-                          (category, size, color, image_url))
-            product_id = cursor.lastrowid
-            
-            # Create individual items with unique QR codes
-            # Items start as unvalidated - only validated when scanned via mobile
-            items_created = 0
-            for i in range(stock):
-                try:
-                    item_qr_code = generate_unique_item_qr_code(cursor)
-                    # Items are validated when created by admin - ready for customer orders
-                    cursor.execute(
-                        'INSERT INTO items (product_id, qr_code, status, validated, validated_at) VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)',
-                        (product_id, item_qr_code, 'available')
-                    )
-                    items_created += 1
-                except Exception as e:
-                    print(f"Error creating item {i+1}: {e}")
+            attempts += 1
+        else:
+            # Unique QR code found
+            is_duplicate = False
+            admin_log.debug("Unique QR code generated after %d attempts", attempts)
+    
+    if attempts >= max_attempts:
+        raise Exception('Error generating unique QR code. Please try again.')
+    
+    # Generate image URL based on category and color
+    image_url = get_product_image_url(category, color)
+    
+    # Insert new product (without QR code - items have QR codes now)
+    cursor.execute('INSERT INTO products (category, size, color, stock, image_url) VALUES (?, ?, ?, 0, ?)',
+                  (category, size, color, image_url))
+    return cursor.lastrowid
+
+@job_queue.handler('restock')
+def restock_job(job, payload):
+    """Add payload['stock'] items to a product, creating the product if it does not exist
+    
+    Items are committed in batches of JOB_BATCH_SIZE together with the job progress,
+    so a retried job continues after the last committed batch.
+    """
+    category, size, color, stock = payload['category'], payload['size'], payload['color'], payload['stock']
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # Check if product exists (a retried job finds the product its first attempt created)
+        cursor.execute('SELECT id FROM products WHERE category = ? AND size = ? AND color = ?',
+                      (category, size, color))
+        existing = cursor.fetchone()
+        created = existing is None
+        product_id = existing['id'] if existing else create_product(cursor, category, size, color)
+        
+        items_created = job.done
+        job.progress(items_created, stock, 'Creating items', conn=conn)
+        conn.commit()
+        while items_created < stock:
+            batch = min(JOB_BATCH_SIZE, stock - items_created)
+            for i in range(batch):
+                item_qr_code = generate_unique_item_qr_code(cursor)
+                # Items are validated when created by admin - ready for customer orders
+                cursor.execute(
+                    'INSERT INTO items (product_id, qr_code, status, validated, validated_at) VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)',
+                    (product_id, item_qr_code, 'available')
+                )
+            items_created += batch
             
             # Update product stock count from items
             cursor.execute('''
@@ -762,15 +2170,45 @@ def admin_products():
                 SET stock = (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available')
                 WHERE id = ?
             ''', (product_id, product_id))
-            
-            print(f"DEBUG: Product {product_id} created with {items_created} items, each with unique QR code")
-        
-        conn.commit()
+            job.progress(items_created, stock, 'Creating items', conn=conn)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cursor.close()
         conn.close()
-        
-        flash('Product added/updated successfully!', 'success')
-        return redirect(url_for('admin_products'))
+        # Also after a failure - the batches committed so far are visible
+        invalidate_catalog_cache('product added/restocked')
+    
+    admin_log.info("Product created" if created else "Restocked product",
+                   extra={'product_id': product_id, 'items_created': items_created, 'job_id': job.id})
+    return {'product_id': product_id, 'items_created': items_created, 'created': created}
+
+@app.route('/admin/products', methods=['GET', 'POST'])
+def admin_products():
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+    
+    if request.method == 'POST':
+        payload = {
+            'category': request.form['category'],
+            'size': request.form['size'],
+            'color': request.form['color'],
+            'stock': int(request.form['stock']),
+        }
+        
+        # Creating thousands of items takes a while - a job worker does it
+        job_id = job_queue.enqueue('restock', payload, created_by=session['id'])
+        job = job_queue.get(job_id)
+        if job['status'] == 'done':
+            flash('Product added/updated successfully!', 'success')
+            return redirect(url_for('admin_products'))
+        if job['status'] == 'failed':
+            flash(f'Error adding product: {job["error"]}', 'error')
+            return redirect(url_for('admin_products'))
+        flash(f'Adding {payload["stock"]} item(s) to {payload["category"]} {payload["size"]} {payload["color"]} in the background.', 'success')
+        return redirect(url_for('admin_products', job=job_id))
     
     products = query_db('SELECT * FROM products ORDER BY category, color, size')
     products = [dict(row) for row in products]
@@ -780,7 +2218,11 @@ def admin_products():
         if not product.get('image_url') or product.get('image_url') == '' or product.get('image_url') is None:
             product['image_url'] = get_product_image_url(product['category'], product['color'])
     
-    return render_template('admin/products.html', products=products)
+    # Progress of a restock job started by the form
+    job_id = request.args.get('job', type=int)
+    job = job_queue.get(job_id) if job_id else None
+    
+    return render_template('admin/products.html', products=products, job=job)
 
 @app.route('/admin/products/edit/<int:product_id>', methods=['GET', 'POST'])
 def edit_product(product_id):
@@ -798,6 +2240,7 @@ def edit_product(product_id):
             SET category = ?, size = ?, color = ?, stock = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (category, size, color, stock, product_id))
+        invalidate_catalog_cache('product edited')
         
         flash('Product updated successfully!', 'success')
         return redirect(url_for('admin_products'))
@@ -811,6 +2254,82 @@ def edit_product(product_id):
     
     return render_template('admin/edit_product.html', product=product)
 
+@job_queue.handler('delete_product')
+def delete_product_job(job, payload):
+    """Take the product out of its pending and confirmed orders, then delete the product
+    
+    An order that only has this product is cancelled. Other orders only lose the
+    product's line: its reserved items go back to stock and the rest of the order
+    stays as it is (and is confirmed if all of its remaining items are scanned).
+    """
+    product_id = payload['product_id']
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # Find all orders with this product (pending and confirmed)
+        cursor.execute('''
+            SELECT DISTINCT o.id FROM order_lines l
+            JOIN orders o ON l.order_id = o.id
+            WHERE l.product_id = ? AND o.status IN ('pending', 'confirmed')
+        ''', (product_id,))
+        order_ids = [row['id'] for row in cursor.fetchall()]
+        # Orders handled by an earlier attempt no longer have a line of this product, or are cancelled
+        done = job.done
+        cancelled_count = lines_removed = 0
+        total = done + len(order_ids)
+        
+        # A batch of orders per transaction
+        for start in range(0, len(order_ids), JOB_BATCH_SIZE):
+            batch = order_ids[start:start + JOB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f'''
+                SELECT l.id, l.order_id,
+                       (SELECT COUNT(*) FROM order_lines other
+                        WHERE other.order_id = l.order_id AND other.product_id != l.product_id) as other_lines
+                FROM order_lines l
+                WHERE l.product_id = ? AND l.order_id IN ({placeholders})
+            ''', (product_id, *batch))
+            lines = cursor.fetchall()
+            
+            # Orders of this product alone are cancelled
+            cancel_ids = {line['order_id'] for line in lines if not line['other_lines']}
+            cursor.executemany('UPDATE orders SET status = ? WHERE id = ?', [('cancelled', order_id) for order_id in cancel_ids])
+            cancelled_count += len(cancel_ids)
+            
+            # Mixed orders keep their other lines
+            removed = [line for line in lines if line['other_lines']]
+            cursor.executemany('''
+                UPDATE items
+                SET status = CASE WHEN status = 'reserved' THEN 'available' ELSE status END,
+                    order_id = NULL, order_line_id = NULL
+                WHERE order_line_id = ?
+            ''', [(line['id'],) for line in removed])
+            cursor.executemany('DELETE FROM order_lines WHERE id = ?', [(line['id'],) for line in removed])
+            lines_removed += len(removed)
+            for order_id in {line['order_id'] for line in removed}:
+                confirm_order_if_complete(cursor, order_id)
+            
+            done += len(batch)
+            job.progress(done, total, 'Updating orders', conn=conn)
+            conn.commit()
+            admin_log.debug("Updated orders due to product deletion", extra={
+                'orders_cancelled': len(cancel_ids), 'lines_removed': len(removed), 'product_id': product_id})
+        
+        # Delete the product
+        cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    invalidate_catalog_cache('product deleted')
+    
+    admin_log.info("Product deleted", extra={'product_id': product_id, 'orders_cancelled': cancelled_count,
+                                             'order_lines_removed': lines_removed, 'job_id': job.id})
+    return {'product_id': product_id, 'orders_cancelled': cancelled_count, 'order_lines_removed': lines_removed}
+
 @app.route('/admin/products/delete/<int:product_id>')
 def delete_product(product_id):
     if 'loggedin' not in session or session['user_type'] != 'admin':
@@ -824,40 +2343,29 @@ def delete_product(product_id):
             flash('Product not found', 'error')
             return redirect(url_for('admin_products'))
         
-        # Find all orders for this product (pending and confirmed)
-        orders = query_db('''
-            SELECT id, user_id, status 
-            FROM orders 
-            WHERE product_id = ? AND status IN ('pending', 'confirmed')
-        ''', (product_id,))
-        orders = [dict(row) for row in orders]
-        
-        # Cancel all pending and confirmed orders for this product
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cancelled_count = 0
-        for order in orders:
-            # Update order status to cancelled
-            cursor.execute('UPDATE orders SET status = ? WHERE id = ?', ('cancelled', order['id']))
-            cancelled_count += 1
-            print(f"DEBUG: Cancelled order {order['id']} due to product {product_id} deletion")
-        
-        # Delete the product
-        cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        # Products with many orders take a while to cancel - a job worker does it
+        job_id = job_queue.enqueue('delete_product', {'product_id': product_id}, created_by=session['id'])
+        job = job_queue.get(job_id, include_result=True)
+        if job['status'] == 'failed':
+            flash(f'Error deleting product: {job["error"]}', 'error')
+            return redirect(url_for('admin_products'))
+        if job['status'] != 'done':
+            flash(f'Deleting {product["category"]} {product["size"]} {product["color"]} in the background. '
+                  'Orders of only this product will be cancelled, other orders lose this product.', 'success')
+            return redirect(url_for('admin_products', job=job_id))
         
+        cancelled_count = job['result']['orders_cancelled']
+        lines_removed = job['result'].get('order_lines_removed', 0)
         if cancelled_count > 0:
             flash(f'Product deleted successfully! {cancelled_count} order(s) have been cancelled. Customers will see a message to contact support: 1234567890', 'success')
-        else:
+        if lines_removed > 0:
+            flash(f'The product was removed from {lines_removed} order(s) that also contain other products.', 'success')
+        if not cancelled_count and not lines_removed:
             flash('Product deleted successfully!', 'success')
         
         return redirect(url_for('admin_products'))
     except Exception as e:
-        print(f"ERROR in delete_product: {e}")
+        admin_log.exception("Error in delete_product")
         flash(f'Error deleting product: {str(e)}', 'error')
         return redirect(url_for('admin_products'))
 
@@ -874,7 +2382,7 @@ def generate_qr_product(product_id):
     
     # If product doesn't have QR code, generate one
     if not product['qr_code']:
-        print(f"DEBUG: Product {product_id} doesn't have QR code, generating unique one...")
+        admin_log.debug("Product has no QR code, generating unique one", extra={'product_id': product_id})
         conn = get_db()
         cursor = conn.cursor()
         qr_code = secrets.token_urlsafe(16)
@@ -891,13 +2399,13 @@ def generate_qr_product(product_id):
             # Note: Orders no longer have QR codes, only products and items have QR codes
             if dup_in_products:
                 # Duplicate found, generate new one
-                print(f"DEBUG: Duplicate QR code found (attempt {attempts + 1}), generating new one...")
+                admin_log.debug("Duplicate QR code found (attempt %d), generating new one", attempts + 1)
                 qr_code = secrets.token_urlsafe(16)
                 attempts += 1
             else:
                 # Unique QR code found
                 is_duplicate = False
-                print(f"DEBUG: Unique QR code generated: {qr_code[:20]}... (after {attempts} attempts)")
+                admin_log.debug("Unique QR code generated after %d attempts", attempts)
         
         if attempts >= max_attempts:
             flash('Error generating unique QR code. Please try again.', 'error')
@@ -911,25 +2419,13 @@ def generate_qr_product(product_id):
         cursor.close()
         conn.close()
         
-        print(f"DEBUG: Product {product_id} updated with unique QR code: {qr_code}")
+        admin_log.info("Product QR code generated", extra={'product_id': product_id})
         
         # Reload product with new QR code
         product = query_db('SELECT qr_code, category, size, color FROM products WHERE id = ?', (product_id,), one=True)
     
     # Generate QR code image with error correction for better scanning
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=10,
-        border=5
-    )
-    qr.add_data(product['qr_code'])
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    img_buffer = BytesIO()
-    img.save(img_buffer, format='PNG')
-    img_str = base64.b64encode(img_buffer.getvalue()).decode()
+    img_str = render_qr_base64(product['qr_code'], 'product')
     
     product_info = f"{product['category']} - Size: {product['size']}, Color: {product['color']}"
     
@@ -945,13 +2441,13 @@ def admin_items(product_id):
     if 'loggedin' not in session or session['user_type'] != 'admin':
         return redirect(url_for('login'))
     
-    product = query_db('SELECT * FROM products WHERE id = ?', (product_id,), one=True)
+    product = query_report('SELECT * FROM products WHERE id = ?', (product_id,), one=True)
     if not product:
         flash('Product not found', 'error')
         return redirect(url_for('admin_products'))
     
     # Get all items for this product
-    items_result = query_db('''
+    items_result = query_report('''
         SELECT i.*, o.status as order_status
         FROM items i
         LEFT JOIN orders o ON i.order_id = o.id
@@ -998,10 +2494,24 @@ def validate_items_bulk(product_id):
     conn.commit()
     cursor.close()
     conn.close()
+    invalidate_catalog_cache('items validated')
     
     flash(f'Successfully validated {updated_count} items!', 'success')
     return redirect(url_for('admin_items', product_id=product_id))
 
+@job_queue.handler('render_item_qrs')
+def render_item_qrs_job(job, payload):
+    """Render the grid QR code of every item of a product into item_qr_cache; the result lists the item ids"""
+    conn = get_db()
+    try:
+        rows = conn.execute('SELECT id, qr_code FROM items WHERE product_id = ?', (payload['product_id'],)).fetchall()
+    finally:
+        conn.close()
+    for n, row in enumerate(rows, 1):
+        render_item_grid_qr(row['qr_code'])
+        job.progress(n, len(rows), 'Rendering QR codes')
+    return {'product_id': payload['product_id'], 'item_ids': [row['id'] for row in rows]}
+
 @app.route('/admin/product_items_qr/<int:product_id>')
 def product_items_qr(product_id):
     """View all item QR codes for a product in a grid layout"""
@@ -1025,21 +2535,25 @@ def product_items_qr(product_id):
     ''', (product_id,))
     items = [dict(row) for row in items_result] if items_result else []
     
+    # Large grids are rendered into item_qr_cache by a job worker while the page shows its progress
+    job_id = request.args.get('job', type=int)
+    if job_id is None and len(items) > JOB_INLINE_ITEMS:
+        # Reuse a render that is under way or recent - its images are still cached
+        job_id = (job_queue.find('render_item_qrs', {'product_id': product_id}, QR_GRID_REUSE_SECONDS)
+                  or job_queue.enqueue('render_item_qrs', {'product_id': product_id}, created_by=session['id']))
+    if job_id is not None:
+        job = job_queue.get(job_id)
+        if job and job['kind'] == 'render_item_qrs' and job['payload'].get('product_id') == product_id:
+            if job['status'] in ('queued', 'running'):
+                return render_template('admin/job_progress.html', job=job,
+                                       title=f'Item QR Codes: {product["category"]} {product["size"]} {product["color"]}',
+                                       done_url=url_for('product_items_qr', product_id=product_id, job=job_id),
+                                       back_url=url_for('admin_products'))
+    
     # Generate QR code images for all items with error correction
+    # (cache misses: items added after the job ran, a failed job, or small products)
     for item in items:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_M,
-            box_size=8,
-            border=4
-        )
-        qr.add_data(item['qr_code'])
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        img_buffer = BytesIO()
-        img.save(img_buffer, format='PNG')
-        item['qr_image'] = base64.b64encode(img_buffer.getvalue()).decode()
+        item['qr_image'] = render_item_grid_qr(item['qr_code'])
     
     # Count items by status
     status_counts = {
@@ -1071,19 +2585,7 @@ def generate_item_qr(item_id):
     item = dict(item) if item else None
     
     # Generate QR code image with error correction for better scanning
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=10,
-        border=5
-    )
-    qr.add_data(item['qr_code'])
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    img_buffer = BytesIO()
-    img.save(img_buffer, format='PNG')
-    img_str = base64.b64encode(img_buffer.getvalue()).decode()
+    img_str = render_qr_base64(item['qr_code'], 'item')
     
     item_info = f"{item['category']} {item['size']} {item['color']} - Item #{item['id']} (Status: {item['status']})"
     
@@ -1094,43 +2596,86 @@ def generate_item_qr(item_id):
                          item_info=item_info)
 
 
+# The admin listing shows every order, reading all of orders is intended
+SQL_ALL_ORDERS = query_plans.register('all_orders', '''
+    SELECT o.id as id, o.status, 
+           datetime(o.created_at) as created_at,
+           l.id as line_id, l.product_id, l.quantity, p.category, p.size, p.color, u.username
+    FROM orders o
+    JOIN order_lines l ON l.order_id = o.id
+    JOIN products p ON l.product_id = p.id
+    JOIN users u ON o.user_id = u.id
+    UNION ALL
+    SELECT o.id as id, o.status, 
+           datetime(o.created_at) as created_at,
+           l.id as line_id, l.product_id, l.quantity, p.category, p.size, p.color, u.username
+    FROM archived_orders o
+    JOIN archived_order_lines l ON l.order_id = o.id
+    JOIN products p ON l.product_id = p.id
+    JOIN users u ON o.user_id = u.id
+    ORDER BY created_at DESC, id, line_id
+''', allow_scan=('orders',))
+
+SQL_ALL_ORDER_ITEMS = query_plans.register('all_order_items', '''
+    SELECT i.order_id, i.qr_code, i.id as item_id, i.status as item_status, i.validated
+    FROM items i
+    WHERE i.order_id IS NOT NULL
+    UNION ALL
+    SELECT i.order_id, i.qr_code, i.id as item_id, i.status as item_status, i.validated
+    FROM archived_items i
+    ORDER BY order_id, item_id
+''')
+
 @app.route('/admin/orders')
 def admin_orders():
     if 'loggedin' not in session or session['user_type'] != 'admin':
         return redirect(url_for('login'))
     
-    orders_result = query_db('''
-        SELECT o.id, o.quantity, o.status, 
-               datetime(o.created_at) as created_at,
-               p.category, p.size, p.color, u.username
-        FROM orders o
-        JOIN products p ON o.product_id = p.id
-        JOIN users u ON o.user_id = u.id
-        ORDER BY o.created_at DESC
-    ''')
+    orders_result = group_order_lines(query_report(SQL_ALL_ORDERS))
     orders_list = []
     
-    # Convert to dicts and get item QR codes for each order
-    for row in orders_result:
-        order = dict(row)  # Convert sqlite3.Row to dict
-        items = query_db('''
-            SELECT i.qr_code, i.id as item_id, i.status as item_status, i.validated
-            FROM items i
-            WHERE i.order_id = ?
-        ''', (order['id'],))
-        order['items'] = [dict(item) for item in items] if items else []
+    # Items of all orders in one query
+    order_items = group_items_by_order(query_report(SQL_ALL_ORDER_ITEMS))
+    
+    # Attach item QR codes to each order
+    for order in orders_result:
+        order['items'] = order_items.get(order['id'], [])
         orders_list.append(order)
     
     return render_template('admin/orders.html', orders=orders_list)
 
 # Approval Admin Routes
 
+SQL_ORDER_COUNT_BY_STATUS = query_plans.register('order_count_by_status', '''
+    SELECT COUNT(*) as total FROM orders WHERE status = ?
+''', ('pending',))
+
+SQL_ORDERS_BY_STATUS = query_plans.register('orders_by_status', '''
+    SELECT o.id, o.status, 
+           datetime(o.created_at) as created_at,
+           l.id as line_id, l.product_id, l.quantity, p.category, p.size, p.color, u.username
+    FROM orders o
+    JOIN order_lines l ON l.order_id = o.id
+    JOIN products p ON l.product_id = p.id
+    JOIN users u ON o.user_id = u.id
+    WHERE o.status = ?
+    ORDER BY o.created_at ASC, o.id, l.id
+''', ('pending',))
+
+SQL_ORDER_ITEMS_BY_STATUS = query_plans.register('order_items_by_status', '''
+    SELECT i.order_id, i.qr_code, i.id as item_id, i.status as item_status, i.validated
+    FROM items i
+    JOIN orders o ON i.order_id = o.id
+    WHERE o.status = ?
+    ORDER BY i.id
+''', ('pending',))
+
 @app.route('/approval/dashboard')
 def approval_dashboard():
     if 'loggedin' not in session or session['user_type'] != 'approval_admin':
         return redirect(url_for('login'))
     
-    pending_orders = query_db('SELECT COUNT(*) as total FROM orders WHERE status = ?', ('pending',), one=True)['total']
+    pending_orders = query_report(SQL_ORDER_COUNT_BY_STATUS, ('pending',), one=True)['total']
     
     return render_template('approval/dashboard.html', 
                          pending_orders=pending_orders,
@@ -1141,64 +2686,59 @@ def approval_orders():
     if 'loggedin' not in session or session['user_type'] != 'approval_admin':
         return redirect(url_for('login'))
     
-    orders_result = query_db('''
-        SELECT o.id, o.quantity, o.status, 
-               datetime(o.created_at) as created_at,
-               p.category, p.size, p.color, u.username
-        FROM orders o
-        JOIN products p ON o.product_id = p.id
-        JOIN users u ON o.user_id = u.id
-        WHERE o.status = ?
-        ORDER BY o.created_at ASC
-    ''', ('pending',))
+    orders_result = group_order_lines(query_db(SQL_ORDERS_BY_STATUS, ('pending',)))
     orders_list = []
     
-    # Convert to dicts and get item QR codes for each order
-    for row in orders_result:
-        order = dict(row)  # Convert sqlite3.Row to dict
-        items = query_db('''
-            SELECT i.qr_code, i.id as item_id, i.status as item_status, i.validated
-            FROM items i
-            WHERE i.order_id = ?
-        ''', (order['id'],))
-        order['items'] = [dict(item) for item in items] if items else []
+    # Items of all pending orders in one query
+    order_items = group_items_by_order(query_db(SQL_ORDER_ITEMS_BY_STATUS, ('pending',)))
+    
+    # Attach item QR codes to each order
+    for order in orders_result:
+        order['items'] = order_items.get(order['id'], [])
         orders_list.append(order)
     
-    print(f"DEBUG: Approval orders page - Found {len(orders_list)} pending orders")
-    for order in orders_list:
-        print(f"  Order {order['id']}: {order['username']} - {order['category']} {order['size']} {order['color']}")
+    approval_log.debug("Approval orders page", extra={'pending_orders': len(orders_list)})
+    if approval_log.isEnabledFor(logging.DEBUG):
+        for order in orders_list:
+            approval_log.debug("Pending order %s: %s - %s", order['id'], order['username'],
+                               ', '.join(f"{line['quantity']} x {line['category']} {line['size']} {line['color']}" for line in order['lines']))
     
     return render_template('approval/orders.html', orders=orders_list)
 
+SQL_ORDER_ITEMS = query_plans.register('order_items', '''
+    SELECT i.id, i.qr_code, i.status, i.validated, p.category, p.size, p.color
+    FROM items i
+    JOIN products p ON i.product_id = p.id
+    WHERE i.order_id = ?
+    ORDER BY i.id
+''', (1,))
+
 @app.route('/approval/scan_order_qr/<int:order_id>')
 def scan_order_qr(order_id):
     """Display QR codes for all items in an order for scanning"""
     if 'loggedin' not in session or session['user_type'] != 'approval_admin':
         return redirect(url_for('login'))
     
-    # Get order details
-    order_result = query_db('''
-        SELECT o.id, o.quantity, o.status,
+    # Get order details with all of its products
+    order_result = group_order_lines(query_db('''
+        SELECT o.id, o.status, l.id as line_id, l.product_id, l.quantity,
                p.category, p.size, p.color, u.username
         FROM orders o
-        JOIN products p ON o.product_id = p.id
+        JOIN order_lines l ON l.order_id = o.id
+        JOIN products p ON l.product_id = p.id
         JOIN users u ON o.user_id = u.id
         WHERE o.id = ?
-    ''', (order_id,), one=True)
+        ORDER BY l.id
+    ''', (order_id,)))
     
     if not order_result:
         flash('Order not found', 'error')
         return redirect(url_for('approval_orders'))
     
-    order = dict(order_result)
+    order = order_result[0]
     
     # Get all items for this order
-    items_result = query_db('''
-        SELECT i.id, i.qr_code, i.status, i.validated
-        FROM items i
-        WHERE i.order_id = ?
-        ORDER BY i.id
-    ''', (order_id,))
+    items_result = query_db(SQL_ORDER_ITEMS, (order_id,))
     items = [dict(row) for row in items_result] if items_result else []
     
     if not items:
@@ -1206,86 +2746,19 @@ def scan_order_qr(order_id):
         return redirect(url_for('approval_orders'))
     
     # Generate QR code images with scan URLs
-    # Get the actual server URL - prioritize Railway/public URL over local IP
-    # Check if running on Railway (has RAILWAY_ENVIRONMENT or PORT env var)
-    is_railway = os.environ.get('RAILWAY_ENVIRONMENT') or os.environ.get('RAILWAY_SERVICE_NAME')
-    
-    # Check for custom server URL first (highest priority)
-    server_url = os.environ.get('SERVER_URL')
-    
-    if server_url:
-        # Use custom server URL if provided (for production or specific network setup)
-        base_url = server_url.rstrip('/')
-        print(f"DEBUG: Using custom SERVER_URL: {base_url}")
-    elif is_railway:
-        # On Railway, use the public Railway URL from request
-        base_url = request.url_root.rstrip('/')
-        # Remove any port numbers as Railway handles that
-        if ':5000' in base_url:
-            base_url = base_url.replace(':5000', '')
-        print(f"DEBUG: Using Railway URL: {base_url}")
-    else:
-        # Local development - use request URL but replace localhost/127.0.0.1 with actual network IP
-        base_url = request.host_url.rstrip('/')
-        
-        # Always detect and use the network IP for mobile access (even if accessed via IP)
-        import socket
-        try:
-            # Connect to a remote address to get the local IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))  # Google DNS
-            local_ip = s.getsockname()[0]
-            s.close()
-            
-            # Always use the detected network IP for QR codes (for mobile access)
-            # Replace any localhost/127.0.0.1 or even if accessed via different IP
-            if 'localhost' in base_url or '127.0.0.1' in base_url:
-                base_url = base_url.replace('localhost', local_ip).replace('127.0.0.1', local_ip)
-            else:
-                # Even if accessed via IP, use the detected network IP to ensure consistency
-                # Extract port if present
-                port = ':5000' if ':5000' in base_url else ''
-                base_url = f"http://{local_ip}{port}"
-            
-            print(f"DEBUG: Using network IP for QR codes: {base_url}")
-            print(f"DEBUG: Detected network IP: {local_ip}")
-        except Exception as e:
-            print(f"WARNING: Could not detect network IP: {e}")
-            print("NOTE: Mobile devices may not be able to access the scan URL.")
-            print("TIP: Set SERVER_URL environment variable or use your computer's IP address manually.")
+    # The base URL and network IP are resolved at startup, not per request
+    base_url = get_scan_base_url(request)
+    network_ip = get_network_ip()
     
     from urllib.parse import quote
     
-    # Get network IP for display
-    network_ip = None
-    try:
-        import socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        network_ip = s.getsockname()[0]
-        s.close()
-    except:
-        pass
-    
     for item in items:
         # Create scan URL that mobile will access - properly encode QR code
         qr_code_encoded = quote(item['qr_code'], safe='')
         scan_url = f"{base_url}/scan/item/{qr_code_encoded}"
         
         # Generate QR code image with proper error correction for mobile scanning
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,  # Higher error correction for mobile
-            box_size=12,  # Larger size for easier mobile scanning
-            border=4
-        )
-        qr.add_data(scan_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        img_buffer = BytesIO()
-        img.save(img_buffer, format='PNG')
-        item['qr_image'] = base64.b64encode(img_buffer.getvalue()).decode()
+        item['qr_image'] = render_qr_base64(scan_url, 'scan_url')
         item['scan_url'] = scan_url
     
     return render_template('approval/scan_order_qr.html', 
@@ -1362,6 +2835,22 @@ def status_page():
                          environment=environment,
                          debug_mode=debug_mode)
 
+def maintenance_status():
+    try:
+        return maintenance_scheduler.status()
+    except sqlite3.Error as e:
+        return {'error': str(e)}
+
+def snapshot_status():
+    if snapshot_store is None:
+        return {'enabled': False}
+    try:
+        age = snapshots.latest_snapshot_age(snapshot_store)
+    except OSError as e:
+        return {'enabled': True, 'error': str(e)}
+    return {'enabled': True, 'latest_age_seconds': round(age) if age is not None else None,
+            'restore': snapshot_restore_report}
+
 @app.route('/api/status')
 def api_status():
     """API endpoint for status check"""
@@ -1376,9 +2865,118 @@ def api_status():
     return jsonify({
         'status': 'online',
         'database': db_status,
+        'cache': catalog_cache.stats(),
+        'item_qr_cache': item_qr_cache.stats(),
+        'maintenance': maintenance_status(),
+        'snapshots': snapshot_status(),
         'timestamp': time.time()
     })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text metrics merged across all gunicorn workers"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/diagnostics/query_plans')
+def query_plans_diagnostics():
+    """EXPLAIN QUERY PLAN of every registered hot query, flagging full scans on items/orders"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+
+    conn = get_db()
+    try:
+        report = query_plans.check_query_plans(conn)
+    finally:
+        conn.close()
+    if not report['ok']:
+        db_log.warning("Hot queries with full table scans", extra={'queries': ','.join(report['failures'])})
+    if request.args.get('format') == 'text':
+        return Response(query_plans.format_report(report), mimetype='text/plain')
+    return jsonify(report)
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    """Recent request profile captures"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+
+    return render_template('admin/profiles.html',
+                         captures=profiler.list_captures(),
+                         profile_dir=profiler.PROFILE_DIR,
+                         sample_rate=profiler.PROFILE_SAMPLE_RATE,
+                         header=profiler.PROFILE_HEADER)
+
+@app.route('/admin/profiles/<name>')
+def admin_profile_download(name):
+    """One capture in collapsed stack format (for flamegraph.pl, speedscope, inferno)"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+
+    path = profiler.capture_path(name)
+    if not path:
+        flash('Profile capture not found', 'error')
+        return redirect(url_for('admin_profiles'))
+    with open(path, encoding='utf-8') as f:
+        return Response(f.read(), mimetype='text/plain',
+                        headers={'Content-Disposition': f'attachment; filename={name}'})
+
+SQL_CONFIRMED_ORDER_COUNT = query_plans.register('confirmed_order_count', '''
+    SELECT COUNT(*) as count
+    FROM orders
+    WHERE user_id = ? AND status = 'confirmed'
+''', (1,))
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    """Recent background jobs"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+    return render_template('admin/jobs.html', jobs=job_queue.recent(), workers=len(job_queue.threads),
+                           archive_after_days=ARCHIVE_AFTER_DAYS, snapshots_enabled=snapshot_store is not None)
+
+@app.route('/admin/snapshot', methods=['POST'])
+def take_database_snapshot():
+    """Queue a database snapshot now"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+    if snapshot_store is None:
+        flash('Snapshots are off - set SNAPSHOT_DIR to enable them.', 'error')
+        return redirect(url_for('admin_jobs'))
+    job_id = job_queue.enqueue('snapshot', {}, created_by=session['id'])
+    job = job_queue.get(job_id, include_result=True)
+    if job['status'] == 'done':
+        flash(f"Snapshot {job['result']['name']} saved ({job['result']['compressed_bytes'] // 1024} KB).", 'success')
+    elif job['status'] == 'failed':
+        flash(f"Snapshot failed: {job['error']}", 'error')
+    else:
+        flash(f'Taking a snapshot in background job #{job_id}.', 'info')
+    return redirect(url_for('admin_jobs'))
+
+@app.route('/admin/archive', methods=['POST'])
+def archive_orders():
+    """Queue a run of the order archive (closed orders older than ARCHIVE_AFTER_DAYS)"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return redirect(url_for('login'))
+    job_id = job_queue.enqueue('archive_orders', {}, created_by=session['id'])
+    job = job_queue.get(job_id, include_result=True)
+    if job['status'] == 'done':
+        flash(f"Archived {job['result']['orders']} closed orders with {job['result']['items']} items.", 'success')
+    elif job['status'] == 'failed':
+        flash(f"Archiving failed: {job['error']}", 'error')
+    else:
+        flash(f'Archiving closed orders in background job #{job_id}.', 'info')
+    return redirect(url_for('admin_jobs'))
+
+@app.route('/admin/jobs/<int:job_id>')
+def admin_job_status(job_id):
+    """Status and progress of one job as JSON (polled by the admin pages)"""
+    if 'loggedin' not in session or session['user_type'] != 'admin':
+        return jsonify({'error': 'Admin login required'}), 401
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/api/check_order_updates')
 def check_order_updates():
     """API endpoint to check if customer has any order status updates"""
@@ -1387,11 +2985,7 @@ def check_order_updates():
     
     try:
         # Check if user has any confirmed orders
-        confirmed_orders = query_db('''
-            SELECT COUNT(*) as count
-            FROM orders
-            WHERE user_id = ? AND status = 'confirmed'
-        ''', (session['id'],), one=True)
+        confirmed_orders = query_db(SQL_CONFIRMED_ORDER_COUNT, (session['id'],), one=True)
         
         has_confirmed = confirmed_orders and dict(confirmed_orders).get('count', 0) > 0
         
@@ -1400,18 +2994,16 @@ def check_order_updates():
             'confirmed_count': dict(confirmed_orders).get('count', 0) if confirmed_orders else 0
         })
     except Exception as e:
-        print(f"ERROR in check_order_updates: {e}")
+        log.error("Error in check_order_updates: %s", e)
         return jsonify({'has_updates': False, 'error': str(e)})
 
 @app.route('/test/network')
 def test_network():
     """Test endpoint to verify network connectivity - Mobile Friendly"""
-    import socket
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
+        local_ip = get_network_ip()
+        if not local_ip:
+            raise OSError("no network interface with a route was found")
         return f'''
         <!DOCTYPE html>
         <html>
@@ -1577,59 +3169,113 @@ def test_network():
         </html>
         '''
 
+def get_qr_code_candidates(qr_code):
+    """Possible stored QR codes for a scanned value (raw, URL-decoded, cleaned up)"""
+    from urllib.parse import unquote
+    
+    # Clean up the QR code (remove any URL encoding or extra characters)
+    qr_code = qr_code.strip()
+    
+    # Order scan QR codes contain the full scan URL - keep only the code part
+    if '/scan/item/' in qr_code:
+        qr_code = qr_code.split('/scan/item/', 1)[1]
+    
+    # Try multiple decoding strategies
+    search_codes = [qr_code]  # Start with original
+    
+    # Try URL-decoded version
+    decoded_qr = unquote(qr_code)
+    if decoded_qr != qr_code:
+        search_codes.append(decoded_qr)
+    
+    # Try double-decoded (in case of double encoding)
+    double_decoded = unquote(decoded_qr)
+    if double_decoded != decoded_qr and double_decoded not in search_codes:
+        search_codes.append(double_decoded)
+    
+    # Try removing any trailing slashes or extra path components
+    clean_qr = qr_code.split('/')[0].split('?')[0].split('#')[0]
+    if clean_qr not in search_codes:
+        search_codes.append(clean_qr)
+    
+    return search_codes
+
+SQL_ORDER_SCAN_PROGRESS = query_plans.register('order_scan_progress', '''
+    SELECT COUNT(*) as total, 
+           SUM(CASE WHEN validated = 1 THEN 1 ELSE 0 END) as validated_count
+    FROM items 
+    WHERE order_id = ?
+''', (1,))
+
+def confirm_order_if_complete(cursor, order_id):
+    """Auto-confirm an order once all of its items are scanned and validated.
+    
+    Runs on the caller's cursor so it is part of the caller's transaction.
+    Returns (validated_count, total_items, confirmed).
+    """
+    cursor.execute(SQL_ORDER_SCAN_PROGRESS, (order_id,))
+    order_check = cursor.fetchone()
+    total_items = order_check[0] if order_check else 0
+    validated_count = (order_check[1] if order_check else 0) or 0
+    
+    cursor.execute('SELECT status FROM orders WHERE id = ?', (order_id,))
+    order = cursor.fetchone()
+    if not order:
+        return validated_count, total_items, False
+    if order['status'] == 'confirmed':
+        return validated_count, total_items, True
+    
+    # Only open orders are confirmed - a cancelled order stays cancelled
+    if total_items == 0 or validated_count != total_items or order['status'] not in ('pending', 'approved'):
+        return validated_count, total_items, False
+    
+    # Update order status to confirmed
+    cursor.execute('UPDATE orders SET status = ? WHERE id = ?', ('confirmed', order_id))
+    
+    # Mark reserved items as sold
+    cursor.execute('''
+        UPDATE items 
+        SET status = 'sold' 
+        WHERE order_id = ? AND status = 'reserved'
+    ''', (order_id,))
+    
+    # Update product stock
+    refresh_order_product_stock(cursor, order_id)
+    
+    return validated_count, total_items, True
+
 @app.route('/scan/item/<path:qr_code>')
 def scan_item_mobile(qr_code):
     """Mobile endpoint - shows product details when QR code is scanned"""
     try:
-        from urllib.parse import unquote
-        
         # Clean up the QR code (remove any URL encoding or extra characters)
         qr_code = qr_code.strip()
-        print(f"DEBUG: Scanning QR code (raw): {qr_code}")
+        scan_log.debug("Scanning QR code", extra={'qr_code': qr_code})
         
         # Try multiple decoding strategies
-        search_codes = [qr_code]  # Start with original
-        
-        # Try URL-decoded version
-        decoded_qr = unquote(qr_code)
-        if decoded_qr != qr_code:
-            search_codes.append(decoded_qr)
-            print(f"DEBUG: Added URL-decoded QR code: {decoded_qr}")
-        
-        # Try double-decoded (in case of double encoding)
-        double_decoded = unquote(decoded_qr)
-        if double_decoded != decoded_qr and double_decoded not in search_codes:
-            search_codes.append(double_decoded)
-            print(f"DEBUG: Added double-decoded QR code: {double_decoded}")
-        
-        # Try removing any trailing slashes or extra path components
-        clean_qr = qr_code.split('/')[0].split('?')[0].split('#')[0]
-        if clean_qr not in search_codes:
-            search_codes.append(clean_qr)
-            print(f"DEBUG: Added cleaned QR code: {clean_qr}")
-        
-        # Find item by QR code - try all variations
+        search_codes = get_qr_code_candidates(qr_code)
+        scan_log.debug("QR code variations to try: %s", search_codes)
+        
+        # Find item by QR code - all variations in one query, the first variation that matches wins
+        placeholders = ','.join('?' * len(search_codes))
+        matches = query_db(f'''
+            SELECT i.*, p.category, p.size, p.color,
+                   o.id as order_id, o.status as order_status
+            FROM items i
+            JOIN products p ON i.product_id = p.id
+            LEFT JOIN orders o ON i.order_id = o.id
+            WHERE i.qr_code IN ({placeholders})
+        ''', search_codes)
+        matches_by_code = {row['qr_code']: row for row in matches}
         item_result = None
         for search_code in search_codes:
-            print(f"DEBUG: Trying to find QR code: {search_code}")
-            item_result = query_db('''
-                SELECT i.*, p.category, p.size, p.color,
-                       o.id as order_id, o.status as order_status
-                FROM items i
-                JOIN products p ON i.product_id = p.id
-                LEFT JOIN orders o ON i.order_id = o.id
-                WHERE i.qr_code = ?
-            ''', (search_code,), one=True)
-            
-            if item_result:
-                print(f"DEBUG: Found item with QR code: {search_code}")
+            if search_code in matches_by_code:
+                item_result = matches_by_code[search_code]
                 qr_code = search_code  # Use the matched code
                 break
         
-        print(f"DEBUG: Query result: {item_result}")
-        
         if not item_result:
-            print(f"DEBUG: QR code not found in database: {qr_code}")
+            scan_log.info("QR code not found", extra={'qr_code': qr_code})
             # Show helpful error with all available QR codes for debugging
             all_qr_codes = query_db('SELECT qr_code FROM items LIMIT 5')
             qr_list = [dict(r)['qr_code'] for r in all_qr_codes] if all_qr_codes else []
@@ -1637,12 +3283,11 @@ def scan_item_mobile(qr_code):
         
         item = dict(item_result)
         
-        # Debug: Print item data
-        print(f"DEBUG: Item found - ID: {item.get('id')}, Category: {item.get('category')}, QR: {qr_code}")
+        scan_log.debug("Item found", extra={'item_id': item.get('id'), 'category': item.get('category'), 'qr_code': qr_code})
         
         # Ensure all required fields are present
         if not item.get('category'):
-            print(f"WARNING: Item missing category field. Item data: {item}")
+            scan_log.warning("Item missing category field", extra={'item_id': item.get('id')})
         
         # Mark item as scanned and validated
         try:
@@ -1658,70 +3303,18 @@ def scan_item_mobile(qr_code):
             
             # Check if this item belongs to an order
             if item.get('order_id'):
-                # Check if all items in this order are now validated
-                cursor.execute('''
-                    SELECT COUNT(*) as total, 
-                           SUM(CASE WHEN validated = 1 THEN 1 ELSE 0 END) as validated_count
-                    FROM items 
-                    WHERE order_id = ?
-                ''', (item['order_id'],))
-                order_check = cursor.fetchone()
-                
-                if order_check:
-                    total_items = order_check[0] if isinstance(order_check, tuple) else order_check['total']
-                    validated_count = order_check[1] if isinstance(order_check, tuple) else order_check['validated_count']
-                    
-                    # If all items are validated, auto-confirm the order and notify customer
-                    if validated_count == total_items:
-                        print(f"DEBUG: All items scanned! Order {item['order_id']}: {validated_count}/{total_items} items validated")
-                        # Auto-confirm order
-                        try:
-                            # Get order details for customer notification
-                            order_details = query_db('''
-                                SELECT o.*, u.username, u.email, p.category, p.size, p.color
-                                FROM orders o
-                                JOIN users u ON o.user_id = u.id
-                                JOIN products p ON o.product_id = p.id
-                                WHERE o.id = ?
-                            ''', (item['order_id'],), one=True)
-                            
-                            if order_details:
-                                order_details = dict(order_details)
-                                # Update order status to confirmed
-                                cursor.execute('UPDATE orders SET status = ? WHERE id = ?', ('confirmed', item['order_id']))
-                                
-                                # Mark reserved items as sold
-                                cursor.execute('''
-                                    UPDATE items 
-                                    SET status = 'sold' 
-                                    WHERE order_id = ? AND status = 'reserved'
-                                ''', (item['order_id'],))
-                                
-                                # Update product stock
-                                cursor.execute('''
-                                    UPDATE products 
-                                    SET stock = (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available')
-                                    WHERE id = ?
-                                ''', (order_details['product_id'], order_details['product_id']))
-                                
-                                conn.commit()
-                                
-                                print(f"DEBUG: [SUCCESS] Order {item['order_id']} auto-confirmed! Customer: {order_details.get('username', 'N/A')}")
-                                print(f"DEBUG: [NOTIFICATION] Customer notification: Order confirmed for {order_details.get('category', '')} {order_details.get('size', '')} {order_details.get('color', '')}")
-                        except Exception as e:
-                            print(f"ERROR auto-confirming order: {e}")
-                            import traceback
-                            traceback.print_exc()
-                    else:
-                        print(f"DEBUG: Item {item.get('id')} scanned. Order {item['order_id']}: {validated_count}/{total_items} items validated")
+                # If all items are validated, auto-confirm the order and notify customer
+                validated_count, total_items, confirmed = confirm_order_if_complete(cursor, item['order_id'])
+                if confirmed:
+                    scan_log.info("All items scanned, order auto-confirmed", extra={'order_id': item['order_id'], 'validated': validated_count, 'total': total_items})
+                else:
+                    scan_log.debug("Item scanned", extra={'item_id': item.get('id'), 'order_id': item['order_id'], 'validated': validated_count, 'total': total_items})
             
             conn.commit()
             cursor.close()
             conn.close()
-        except Exception as e:
-            print(f"ERROR updating item validation: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            scan_log.exception("Error updating item validation")
             # Continue even if validation update fails
         
         # Ensure item has all required fields with defaults
@@ -1734,14 +3327,10 @@ def scan_item_mobile(qr_code):
         item.setdefault('price', None)
         item.setdefault('qr_code', qr_code)  # Ensure QR code is in item dict
         
-        print(f"DEBUG: Rendering template with item: {item}")
-        
         try:
             return render_template('scan/item_details.html', item=item)
-        except Exception as template_error:
-            print(f"ERROR rendering template: {template_error}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            scan_log.exception("Error rendering scan template")
             # Return a simple HTML page with item data
             return f'''
             <!DOCTYPE html>
@@ -1779,18 +3368,8 @@ def scan_item_mobile(qr_code):
         except:
             error_msg_safe = "An error occurred while processing your scan"
         
-        # Print error safely
-        try:
-            print(f"ERROR in scan_item_mobile: {error_msg_safe}")
-        except:
-            print("ERROR in scan_item_mobile: Encoding error occurred")
-        
-        # Print traceback safely
-        try:
-            import traceback
-            traceback.print_exc()
-        except UnicodeEncodeError:
-            print("ERROR: Could not print traceback due to encoding issue")
+        # Log the error with traceback (written by the log thread, encoding-safe)
+        scan_log.exception("Error in scan_item_mobile: %s", error_msg_safe)
         
         # Return a simple error page
         return f'''
@@ -1818,6 +3397,128 @@ def scan_item_mobile(qr_code):
         </html>
         ''', 500
 
+# Batch scanning - warehouse phones collect codes offline and send them in one request
+SCAN_BATCH_MAX_CODES = 1000
+SQLITE_MAX_IN_PARAMS = 500  # Stay well below SQLite's bound parameter limit
+
+@app.route('/scan/batch')
+def scan_batch_page():
+    """Lightweight mobile scanner page - queues scans locally and syncs them in batches"""
+    return render_template('scan/batch_scanner.html', max_codes=SCAN_BATCH_MAX_CODES)
+
+@app.route('/api/scan/batch', methods=['POST'])
+def scan_batch():
+    """Validate a list of scanned QR codes in one transaction and auto-confirm completed orders"""
+    data = request.get_json(silent=True) or {}
+    codes = data.get('codes')
+    
+    if not isinstance(codes, list) or not codes:
+        return jsonify({'success': False, 'message': 'codes must be a non-empty list of QR codes'}), 400
+    if len(codes) > SCAN_BATCH_MAX_CODES:
+        return jsonify({'success': False, 'message': f'Too many codes in one batch (max {SCAN_BATCH_MAX_CODES})'}), 400
+    
+    codes = [str(code) for code in codes]
+    candidates = {code: get_qr_code_candidates(code) for code in codes}
+    lookup_codes = list({c for variations in candidates.values() for c in variations})
+    
+    conn = None
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # Find all scanned items with one query per chunk instead of one per code
+        items_by_code = {}
+        for start in range(0, len(lookup_codes), SQLITE_MAX_IN_PARAMS):
+            chunk = lookup_codes[start:start + SQLITE_MAX_IN_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+                SELECT i.id, i.qr_code, i.status, i.validated, i.order_id,
+                       p.category, p.size, p.color
+                FROM items i
+                JOIN products p ON i.product_id = p.id
+                WHERE i.qr_code IN ({placeholders})
+            ''', chunk)
+            for row in cursor.fetchall():
+                items_by_code[row['qr_code']] = dict(row)
+        
+        results = []
+        seen_item_ids = set()
+        to_validate = []
+        affected_orders = []
+        for code in codes:
+            item = next((items_by_code[c] for c in candidates[code] if c in items_by_code), None)
+            if not item:
+                results.append({'code': code, 'status': 'not_found'})
+                continue
+            
+            result = {
+                'code': code,
+                'item_id': item['id'],
+                'order_id': item['order_id'],
+                'product_info': f"{item['category']} {item['size']} {item['color']}"
+            }
+            if item['id'] in seen_item_ids:
+                result['status'] = 'duplicate'
+            elif item['validated']:
+                result['status'] = 'already_validated'
+            else:
+                result['status'] = 'validated'
+                to_validate.append(item['id'])
+            seen_item_ids.add(item['id'])
+            
+            if item['order_id'] and item['order_id'] not in affected_orders:
+                affected_orders.append(item['order_id'])
+            results.append(result)
+        
+        # Mark all newly scanned items as validated
+        for start in range(0, len(to_validate), SQLITE_MAX_IN_PARAMS):
+            chunk = to_validate[start:start + SQLITE_MAX_IN_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+                UPDATE items 
+                SET validated = 1, validated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders}) AND validated = 0
+            ''', chunk)
+        
+        # Auto-confirm every order whose items are now all scanned
+        orders_summary = []
+        for order_id in affected_orders:
+            validated_count, total_items, confirmed = confirm_order_if_complete(cursor, order_id)
+            orders_summary.append({
+                'order_id': order_id,
+                'scanned_items': validated_count,
+                'total_items': total_items,
+                'order_confirmed': confirmed
+            })
+        
+        conn.commit()
+        cursor.close()
+    except Exception as e:
+        scan_log.exception("Error in scan_batch")
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': 'Could not process scan batch, please retry'}), 500
+    finally:
+        if conn:
+            conn.close()
+    
+    scan_log.info("Batch scan processed", extra={'codes': len(codes), 'validated': len(to_validate), 'orders': len(affected_orders)})
+    
+    return jsonify({
+        'success': True,
+        'validated': len(to_validate),
+        'not_found': sum(1 for r in results if r['status'] == 'not_found'),
+        'results': results,
+        'orders': orders_summary
+    })
+
+SQL_ORDER_SCAN_STATUS = query_plans.register('order_scan_status', '''
+    SELECT i.id, i.qr_code, i.validated, i.validated_at
+    FROM items i
+    WHERE i.order_id = ?
+    ORDER BY i.id
+''', (1,))
+
 @app.route('/approval/check_scan_status/<int:order_id>')
 def check_scan_status(order_id):
     """API endpoint to check if all items in order are scanned"""
@@ -1825,12 +3526,7 @@ def check_scan_status(order_id):
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
     
     # Get all items for this order with validation timestamp
-    items_result = query_db('''
-        SELECT i.id, i.qr_code, i.validated, i.validated_at
-        FROM items i
-        WHERE i.order_id = ?
-        ORDER BY i.id
-    ''', (order_id,))
+    items_result = query_db(SQL_ORDER_SCAN_STATUS, (order_id,))
     items = [dict(row) for row in items_result] if items_result else []
     
     if not items:
@@ -1883,7 +3579,7 @@ def check_order_complete(order_id):
             'message': 'Order confirmed! You will receive a confirmation message.' if order_confirmed else 'Scanning in progress...'
         })
     except Exception as e:
-        print(f"ERROR in check_order_complete: {e}")
+        approval_log.error("Error in check_order_complete: %s", e)
         return jsonify({'success': False, 'message': str(e)})
 
 @app.route('/approval/validate_qr_scanner')
@@ -1974,12 +3670,10 @@ def validate_qr():
 
 @app.route('/approval/approve_order/<int:order_id>', methods=['POST'])
 def approve_order(order_id):
-    print(f"=== APPROVE ORDER ROUTE CALLED ===")
-    print(f"Order ID: {order_id}")
-    print(f"Session: loggedin={session.get('loggedin')}, user_type={session.get('user_type')}")
+    approval_log.debug("Approve order called", extra={'order_id': order_id, 'user_type': session.get('user_type')})
     
     if 'loggedin' not in session or session['user_type'] != 'approval_admin':
-        print("ERROR: Not logged in as approval admin")
+        approval_log.warning("Approve order rejected - not logged in as approval admin", extra={'order_id': order_id})
         return redirect(url_for('login'))
     
     try:
@@ -1990,16 +3684,6 @@ def approve_order(order_id):
             flash('Order not found', 'error')
             return redirect(url_for('approval_orders'))
         
-        print(f"DEBUG: Approving order {order_id}")
-        
-        # Get order details
-        order_details = query_db('SELECT product_id, quantity FROM orders WHERE id = ?', (order_id,), one=True)
-        order_details = dict(order_details) if order_details else None
-        
-        if not order_details:
-            flash('Order details not found', 'error')
-            return redirect(url_for('approval_orders'))
-        
         # Get all item QR codes for this order to validate uniqueness
         order_items = query_db('''
             SELECT i.qr_code, i.id
@@ -2028,12 +3712,12 @@ def approve_order(order_id):
             
             if dup_item or dup_product:
                 duplicate_found = True
-                print(f"DEBUG: Duplicate QR code found: {qr_code[:20]}...")
+                approval_log.debug("Duplicate QR code found", extra={'order_id': order_id, 'item_id': item['id']})
                 break
         
         if duplicate_found:
             # Duplicate item QR code found - cancel order
-            print(f"DEBUG: [DUPLICATE] DUPLICATE ITEM QR CODE DETECTED")
+            approval_log.warning("Duplicate item QR code detected, order cancelled", extra={'order_id': order_id})
             cursor.execute('UPDATE orders SET status = ? WHERE id = ?', ('cancelled', order_id))
             conn.commit()
             cursor.close()
@@ -2048,7 +3732,7 @@ def approve_order(order_id):
                 })
         else:
             # All item QR codes are unique - confirm order
-            print(f"DEBUG: [SUCCESS] All item QR codes are unique - confirming order {order_id}")
+            approval_log.info("All item QR codes unique, order confirmed", extra={'order_id': order_id})
             
             # Update order status to confirmed
             cursor.execute('UPDATE orders SET status = ? WHERE id = ?', ('confirmed', order_id))
@@ -2061,11 +3745,7 @@ def approve_order(order_id):
             ''', (order_id,))
             
             # Update product stock count from available items
-            cursor.execute('''
-                UPDATE products 
-                SET stock = (SELECT COUNT(*) FROM items WHERE product_id = ? AND status = 'available')
-                WHERE id = ?
-            ''', (order_details['product_id'], order_details['product_id']))
+            refresh_order_product_stock(cursor, order_id)
             
             conn.commit()
             cursor.close()
@@ -2083,37 +3763,34 @@ def approve_order(order_id):
         
         return redirect(url_for('approval_orders'))
     except Exception as e:
-        print(f"ERROR in approve_order: {e}")
+        approval_log.exception("Error in approve_order")
         flash(f'Error processing order: {str(e)}', 'error')
         return redirect(url_for('approval_orders'))
 
 @app.route('/approval/cancel_order/<int:order_id>', methods=['POST'])
 def cancel_order(order_id):
-    print(f"=== CANCEL ORDER ROUTE CALLED ===")
-    print(f"Order ID: {order_id}")
-    print(f"Session: loggedin={session.get('loggedin')}, user_type={session.get('user_type')}")
+    approval_log.debug("Cancel order called", extra={'order_id': order_id, 'user_type': session.get('user_type')})
     
     if 'loggedin' not in session or session['user_type'] != 'approval_admin':
-        print("ERROR: Not logged in as approval admin")
+        approval_log.warning("Cancel order rejected - not logged in as approval admin", extra={'order_id': order_id})
         return redirect(url_for('login'))
     
     try:
         # Get order details
-        order = query_db('SELECT id, user_id, product_id, quantity FROM orders WHERE id = ?', (order_id,), one=True)
+        order = query_db('SELECT id, user_id FROM orders WHERE id = ?', (order_id,), one=True)
         
         if not order:
             flash('Order not found', 'error')
             return redirect(url_for('approval_orders'))
         
         # Update order status to cancelled
-        print(f"DEBUG: Cancelling order {order_id}")
         query_db('UPDATE orders SET status = ? WHERE id = ?', ('cancelled', order_id))
         
-        print(f"DEBUG: Order {order_id} cancelled successfully")
+        approval_log.info("Order cancelled", extra={'order_id': order_id})
         flash(f'Order #{order_id} has been cancelled. Customer will see a message to contact support: 1234567890', 'success')
         return redirect(url_for('approval_orders'))
     except Exception as e:
-        print(f"ERROR in cancel_order: {e}")
+        approval_log.exception("Error in cancel_order")
         flash(f'Error cancelling order: {str(e)}', 'error')
         return redirect(url_for('approval_orders'))
 
@@ -2132,12 +3809,15 @@ def get_product_image_url(category, color):
     # Single sample T-shirt image URL for all products
     # Using local image from static folder
     # Return relative path that works both in Flask context and outside
-    try:
-        # Try to use url_for if in Flask context
-        return url_for('static', filename='images/tshirt.png')
-    except RuntimeError:
-        # If outside Flask context, return relative path
-        return '/static/images/tshirt.png'
+    def load():
+        try:
+            # Try to use url_for if in Flask context
+            return url_for('static', filename='images/tshirt.png')
+        except RuntimeError:
+            # If outside Flask context, return relative path
+            return '/static/images/tshirt.png'
+    
+    return catalog_cache_get('image_url', (category, color), load)
 
 # Database will be initialized on first request or when running locally
 # This prevents import-time errors in serverless environments
@@ -2157,6 +3837,7 @@ def ensure_db_initialized():
         try:
             print("Initializing database...")
             print(f"Database path: {DATABASE}")
+            restore_database_snapshot()
             init_db()
             _db_init_success = True
             print("[OK] Database initialized successfully")
@@ -2177,6 +3858,36 @@ if not (os.environ.get('VERCEL_ENV') or os.environ.get('VERCEL')):
     except Exception as e:
         print(f"[WARNING] Database init on startup failed, will retry on first request: {e}")
 
+# Resolve the scan base URL once at startup (refreshed in the background afterwards)
+try:
+    start_base_url_resolver()
+except Exception as e:
+    print(f"[WARNING] Base URL resolution on startup failed, will retry on first request: {e}")
+
+# Every gunicorn worker runs its own job worker threads
+try:
+    start_job_workers()
+except Exception as e:
+    print(f"[WARNING] Job workers could not be started, jobs will run inline: {e}")
+
+# Return items of abandoned and cancelled orders to stock on a timer
+try:
+    start_reservation_sweeper()
+except Exception as e:
+    print(f"[WARNING] Reservation sweeper could not be started: {e}")
+
+# Back the database up to SNAPSHOT_DIR on a timer
+try:
+    start_snapshotter()
+except Exception as e:
+    print(f"[WARNING] Snapshot thread could not be started: {e}")
+
+# Refresh statistics, reclaim free pages and checkpoint the WAL while idle
+try:
+    start_maintenance_scheduler()
+except Exception as e:
+    print(f"[WARNING] Database maintenance scheduler could not be started: {e}")
+
 # Initialize database when running locally
 if __name__ == '__main__':
     print("Starting QR App (SQLite Version)...")
@@ -2190,8 +3901,6 @@ if __name__ == '__main__':
     print("=" * 50)
     # Bind to 0.0.0.0 to allow access from mobile devices on the same network
     # Print network information for mobile access
-    import socket
-    
     print("\n" + "="*70)
     print("STARTING FLASK SERVER")
     print("="*70)
@@ -2211,12 +3920,8 @@ if __name__ == '__main__':
     else:
         print(f"[OK] Port {port} is available")
     
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-        
+    local_ip = get_network_ip()
+    if local_ip:
         print(f"\n[SUCCESS] Server will be accessible at:")
         print(f"  Local:    http://127.0.0.1:{port}")
         print(f"  Network:  http://{local_ip}:{port}")
@@ -2234,8 +3939,8 @@ if __name__ == '__main__':
         print("  2. Or create rule for port 5000")
         print("  3. See NETWORK_TROUBLESHOOTING.md for details")
         print("="*70 + "\n")
-    except Exception as e:
-        print(f"[WARNING] Could not detect network IP: {e}")
+    else:
+        print(f"[WARNING] Could not detect network IP")
         print(f"  Local access: http://127.0.0.1:{port}")
         print(f"  Network access may not work")
         print("="*70 + "\n")
@@ -2248,13 +3953,9 @@ if __name__ == '__main__':
             f.write(f"{'='*70}\n")
             f.write(f"Port: {port}\n")
             f.write(f"Local URL: http://127.0.0.1:{port}\n")
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.connect(("8.8.8.8", 80))
-                local_ip = s.getsockname()[0]
-                s.close()
+            if local_ip:
                 f.write(f"Network URL: http://{local_ip}:{port}\n")
-            except:
+            else:
                 f.write(f"Network URL: Could not detect\n")
             f.write(f"{'='*70}\n\n")
     except Exception as e:
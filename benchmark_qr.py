@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+QR rendering micro-benchmark for the QR_PROFILES used by the app
+
+Every profile is rendered for a range of payload lengths (22 characters is
+an item token, ~60 a full scan URL). Each render is split into the stages
+render_qr_base64 goes through:
+    fit      - add_data + best_fit (version fitting)
+    matrix   - best_mask_pattern + makeImpl (module matrix build)
+    image    - make_image (PIL image creation)
+    png      - PNG encoding
+    base64   - base64 encoding of the PNG
+and the output size (PNG and base64 bytes) is recorded.
+
+Examples:
+    python benchmark_qr.py --save qr_baseline.json
+    python benchmark_qr.py --compare qr_baseline.json --threshold 0.25
+"""
+import argparse
+import base64
+import json
+import platform
+import random
+import statistics
+import string
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+import PIL
+import qrcode
+
+STAGES = ('fit', 'matrix', 'image', 'png', 'base64')
+DEFAULT_LENGTHS = '22,60,128,256'
+SCAN_URL_PREFIX = 'http://192.168.1.100:5000/scan/item/'
+TOKEN_CHARS = string.ascii_letters + string.digits + '-_'
+
+
+def make_payload(length, seed):
+    """Deterministic payload of the given length - a bare token or a scan URL with a long token"""
+    rng = random.Random(seed * 1000 + length)
+    if length <= len(SCAN_URL_PREFIX):
+        return ''.join(rng.choice(TOKEN_CHARS) for _ in range(length))
+    return SCAN_URL_PREFIX + ''.join(rng.choice(TOKEN_CHARS) for _ in range(length - len(SCAN_URL_PREFIX)))
+
+
+def render_stages(data, error_correction, box_size, border):
+    """Render data the same way render_qr_base64 does, timing each stage"""
+    timings = {}
+
+    start = time.perf_counter()
+    qr = qrcode.QRCode(version=1, error_correction=error_correction, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.best_fit(start=qr.version)
+    timings['fit'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    qr.makeImpl(False, qr.best_mask_pattern())
+    timings['matrix'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img = qr.make_image(fill_color="black", back_color="white")
+    timings['image'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img_buffer = BytesIO()
+    img.save(img_buffer, format='PNG')
+    png = img_buffer.getvalue()
+    timings['png'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = base64.b64encode(png).decode()
+    timings['base64'] = time.perf_counter() - start
+
+    sizes = {'version': qr.version, 'modules': qr.modules_count, 'pixels': img.size[0],
+             'png_bytes': len(png), 'base64_bytes': len(encoded)}
+    return timings, sizes
+
+
+def run_case(profile, settings, length, iterations, warmup, seed):
+    data = make_payload(length, seed)
+    for _ in range(warmup):
+        render_stages(data, *settings)
+    samples = {stage: [] for stage in STAGES + ('total',)}
+    for _ in range(iterations):
+        timings, sizes = render_stages(data, *settings)
+        for stage in STAGES:
+            samples[stage].append(timings[stage])
+        samples['total'].append(sum(timings.values()))
+
+    result = {'profile': profile, 'length': length, **sizes, 'stages': {}}
+    for stage, values in samples.items():
+        values.sort()
+        result['stages'][stage] = {
+            'median_ms': statistics.median(values) * 1000,
+            'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+        }
+    return result
+
+
+def case_key(result):
+    return f"{result['profile']}/{result['length']}"
+
+
+def print_results(results):
+    print("=" * 112)
+    print(f"{'case':<18}{'ver':>4}{'px':>6}" + ''.join(f"{stage + ' ms':>11}" for stage in STAGES + ('total',))
+          + f"{'png B':>9}{'b64 B':>9}")
+    print("-" * 112)
+    for r in results:
+        print(f"{case_key(r):<18}{r['version']:>4}{r['pixels']:>6}"
+              + ''.join(f"{r['stages'][stage]['median_ms']:>11.3f}" for stage in STAGES + ('total',))
+              + f"{r['png_bytes']:>9}{r['base64_bytes']:>9}")
+    print("=" * 112)
+    print("(median times)")
+
+
+def compare(results, baseline, threshold, min_ms):
+    """Regressions against a saved baseline: slower stages and bigger outputs"""
+    previous = {case_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get(case_key(r))
+        if old is None:
+            continue
+        for stage in STAGES + ('total',):
+            new_ms = r['stages'][stage]['median_ms']
+            old_ms = old['stages'][stage]['median_ms']
+            # Ignore sub-threshold noise on stages that only take microseconds
+            if new_ms - old_ms >= min_ms and new_ms > old_ms * (1 + threshold):
+                regressions.append(f"{case_key(r)} {stage}: {old_ms:.3f} ms -> {new_ms:.3f} ms "
+                                   f"(+{(new_ms / old_ms - 1) * 100 if old_ms else 100:.0f}%)")
+        for field in ('png_bytes', 'base64_bytes'):
+            if r[field] > old[field] * (1 + threshold):
+                regressions.append(f"{case_key(r)} {field}: {old[field]} -> {r[field]}")
+        if r['version'] != old['version']:
+            regressions.append(f"{case_key(r)} version: {old['version']} -> {r['version']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark QR rendering for every QR profile and payload length')
+    parser.add_argument('--profiles', help='comma separated QR_PROFILES names (default: all)')
+    parser.add_argument('--lengths', default=DEFAULT_LENGTHS, help=f'payload lengths (default: {DEFAULT_LENGTHS})')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='FILE', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a baseline and exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown/growth ratio (default: 0.25)')
+    parser.add_argument('--min-ms', type=float, default=0.05, help='ignore slowdowns smaller than this (default: 0.05)')
+    args = parser.parse_args()
+
+    from app import QR_PROFILES
+
+    profiles = args.profiles.split(',') if args.profiles else list(QR_PROFILES)
+    unknown = [p for p in profiles if p not in QR_PROFILES]
+    if unknown:
+        parser.error(f"unknown profile(s): {', '.join(unknown)} - choose from {', '.join(QR_PROFILES)}")
+    lengths = [int(length) for length in args.lengths.split(',')]
+
+    results = []
+    for profile in profiles:
+        for length in lengths:
+            results.append(run_case(profile, QR_PROFILES[profile], length, args.iterations, args.warmup, args.seed))
+    print_results(results)
+
+    if args.save:
+        baseline = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'qrcode': getattr(qrcode, '__version__', None) or _package_version('qrcode'),
+            'pillow': PIL.__version__,
+            'iterations': args.iterations,
+            'results': results,
+        }
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"[OK] Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_ms)
+        if regressions:
+            print(f"[REGRESSION] {len(regressions)} regression(s) against {args.compare} (created {baseline.get('created')}):")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print(f"[OK] No regressions against {args.compare}")
+    return 0
+
+
+def _package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
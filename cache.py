@@ -0,0 +1,404 @@
+"""Pluggable cache backends shared by the gunicorn workers
+
+Backends (selected with the CACHE_BACKEND environment variable):
+    lru     - in-process LRU (default)
+    mmap    - shared-memory cache in a memory-mapped file, shared by all workers on the host
+    socket  - client for a local cache server (stand-in for memcached/redis),
+              start it with: python cache.py serve --port 11311
+
+Every backend stores entries under a namespace generation kept in a small
+memory-mapped file, so invalidating a namespace in one worker makes the
+entries unreachable in all of them. The shared files live in CACHE_DIR, by
+default a temp directory keyed by the app's database path, so two
+deployments on one host never share generations or entries.
+"""
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import blake2b
+
+import tracing
+
+try:
+    import fcntl  # Cross-process file locks (not available on Windows)
+except ImportError:
+    fcntl = None
+
+CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'qr_app_cache')
+
+_MISSING = object()
+
+
+class _FileLock:
+    """Exclusive lock on a file region - cross-process where fcntl exists, thread-only otherwise
+
+    fcntl locks belong to the process, so the thread lock is what keeps two
+    threads of the same worker apart.
+    """
+    def __init__(self, fd, thread_lock, offset=0, length=0):
+        self.fd = fd
+        self.thread_lock = thread_lock
+        self.offset = offset
+        self.length = length
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.length, self.offset)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.length, self.offset)
+        self.thread_lock.release()
+
+
+class GenerationTable:
+    """Namespace generation counters in a memory-mapped file shared by all workers"""
+    SLOTS = 256
+    SLOT = struct.Struct('<Q')
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.SLOTS * self.SLOT.size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = _FileLock(self.fd, threading.Lock())
+
+    def _offset(self, namespace):
+        # Namespaces sharing a slot just get invalidated together
+        return (zlib.crc32(namespace.encode('utf-8')) % self.SLOTS) * self.SLOT.size
+
+    def get(self, namespace):
+        return self.SLOT.unpack_from(self.map, self._offset(namespace))[0]
+
+    def bump(self, namespace):
+        offset = self._offset(namespace)
+        with self.lock:
+            generation = self.SLOT.unpack_from(self.map, offset)[0] + 1
+            self.SLOT.pack_into(self.map, offset, generation)
+        return generation
+
+
+class LocalGenerations:
+    """In-process generation counters - used when the shared file can't be created"""
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, namespace):
+        return self.counters.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self.lock:
+            self.counters[namespace] = self.counters.get(namespace, 0) + 1
+            return self.counters[namespace]
+
+
+class CacheBackend:
+    """Base class - subclasses implement _get/_set/_drop on fully qualified keys"""
+    name = 'base'
+
+    def __init__(self, generations=None):
+        self.generations = generations or GenerationTable(os.path.join(CACHE_DIR, 'generations.bin'))
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _key(self, namespace, key):
+        return f"{namespace}:{self.generations.get(namespace)}:{key!r}"
+
+    def _count(self, namespace, field):
+        with self._stats_lock:
+            counters = self._stats.setdefault(namespace, {'hits': 0, 'misses': 0, 'sets': 0, 'invalidations': 0})
+            counters[field] += 1
+
+    def get(self, namespace, key, default=None):
+        """Cached value, or default on a miss"""
+        value = self._lookup(namespace, self._key(namespace, key))
+        return default if value is _MISSING else value
+
+    def _lookup(self, namespace, full_key):
+        value = self._get(full_key)
+        self._count(namespace, 'misses' if value is _MISSING else 'hits')
+        return value
+
+    def set(self, namespace, key, value, ttl):
+        """Store value for ttl seconds"""
+        self._count(namespace, 'sets')
+        self._set(self._key(namespace, key), value, ttl)
+
+    def get_or_load(self, namespace, key, loader, ttl):
+        """Cached value, calling loader() and storing the result on a miss"""
+        # The key is qualified once, so a result loaded while another worker
+        # invalidates the namespace is stored under the old generation
+        full_key = self._key(namespace, key)
+        value = self._lookup(namespace, full_key)
+        if value is _MISSING:
+            value = loader()
+            self._count(namespace, 'sets')
+            self._set(full_key, value, ttl)
+        return value
+
+    def invalidate(self, namespace):
+        """Drop every entry of a namespace, in all workers"""
+        self._count(namespace, 'invalidations')
+        self.generations.bump(namespace)
+        self._drop(namespace)
+
+    def stats(self):
+        """Per-namespace counters and hit ratio for this worker"""
+        with self._stats_lock:
+            report = {}
+            for namespace, counters in self._stats.items():
+                lookups = counters['hits'] + counters['misses']
+                report[namespace] = dict(counters, hit_ratio=round(counters['hits'] / lookups, 4) if lookups else None)
+        return {'backend': self.name, 'pid': os.getpid(), 'namespaces': report}
+
+    def _get(self, full_key):
+        raise NotImplementedError
+
+    def _set(self, full_key, value, ttl):
+        raise NotImplementedError
+
+    def _drop(self, namespace):
+        # Old generations are unreachable already, backends may free them early
+        pass
+
+
+class LRUCache(CacheBackend):
+    """In-process LRU with per-entry expiry"""
+    name = 'lru'
+
+    def __init__(self, max_entries=2048, generations=None):
+        super().__init__(generations)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, full_key):
+        with self.lock:
+            entry = self.entries.get(full_key)
+            if entry is None:
+                return _MISSING
+            if entry[0] <= time.monotonic():
+                del self.entries[full_key]
+                return _MISSING
+            self.entries.move_to_end(full_key)
+            return entry[1]
+
+    def _set(self, full_key, value, ttl):
+        with self.lock:
+            self.entries[full_key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(full_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _drop(self, namespace):
+        prefix = namespace + ':'
+        with self.lock:
+            for full_key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[full_key]
+
+
+class SharedMemoryCache(CacheBackend):
+    """Fixed-size hash table of JSON entries in a memory-mapped file shared by all workers
+
+    Each slot holds one entry: key digest, expiry, payload length and CRC, then
+    the payload. A colliding key simply replaces the slot. Values larger than a
+    slot are not cached.
+    """
+    name = 'mmap'
+    HEADER = struct.Struct('<16sdII')
+
+    def __init__(self, path=None, slots=256, slot_size=65536, generations=None):
+        super().__init__(generations)
+        path = path or os.path.join(CACHE_DIR, 'cache.bin')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * slot_size
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.write_lock = threading.Lock()
+
+    def _slot(self, full_key):
+        digest = blake2b(full_key.encode('utf-8'), digest_size=16).digest()
+        return digest, (int.from_bytes(digest[:8], 'little') % self.slots) * self.slot_size
+
+    def _get(self, full_key):
+        digest, offset = self._slot(full_key)
+        stored_digest, expires_at, length, crc = self.HEADER.unpack_from(self.map, offset)
+        if stored_digest != digest or expires_at <= time.time():
+            return _MISSING
+        start = offset + self.HEADER.size
+        payload = self.map[start:start + length]
+        # Readers don't lock - a torn read from a concurrent write fails the CRC check
+        if zlib.crc32(payload) != crc:
+            return _MISSING
+        return json.loads(payload)
+
+    def _set(self, full_key, value, ttl):
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(payload) > self.slot_size - self.HEADER.size:
+            return
+        digest, offset = self._slot(full_key)
+        with _FileLock(self.fd, self.write_lock, offset, self.slot_size):
+            # Clear the digest first so readers never match a half-written entry
+            self.HEADER.pack_into(self.map, offset, b'\0' * 16, 0.0, 0, 0)
+            start = offset + self.HEADER.size
+            self.map[start:start + len(payload)] = payload
+            self.HEADER.pack_into(self.map, offset, digest, time.time() + ttl, len(payload), zlib.crc32(payload))
+
+
+class SocketCache(CacheBackend):
+    """Client for the local cache server (newline-delimited JSON over TCP)"""
+    name = 'socket'
+
+    def __init__(self, host='127.0.0.1', port=11311, timeout=0.25, generations=None):
+        super().__init__(generations)
+        self.address = (host, port)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _request(self, message):
+        with tracing.span('socket.cache', op=message.get('op')):
+            return self._send(message)
+
+    def _send(self, message):
+        # One connection per thread; any socket error is treated as a cache miss
+        try:
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                sock = socket.create_connection(self.address, timeout=self.timeout)
+                conn = self.local.conn = (sock, sock.makefile('rb'))
+            sock, reader = conn
+            sock.sendall(json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n')
+            line = reader.readline()
+            if not line:
+                raise OSError('cache server closed the connection')
+            return json.loads(line)
+        except (OSError, ValueError):
+            conn = getattr(self.local, 'conn', None)
+            if conn:
+                conn[0].close()
+                self.local.conn = None
+            return None
+
+    def _get(self, full_key):
+        reply = self._request({'op': 'get', 'key': full_key})
+        if not reply or not reply.get('hit'):
+            return _MISSING
+        return reply['value']
+
+    def _set(self, full_key, value, ttl):
+        self._request({'op': 'set', 'key': full_key, 'value': value, 'ttl': ttl})
+
+    def _drop(self, namespace):
+        self._request({'op': 'drop', 'namespace': namespace})
+
+
+def serve(host='127.0.0.1', port=11311, max_entries=100000):
+    """Run the local cache server used by SocketCache"""
+    import socketserver
+
+    store = LRUCache(max_entries=max_entries, generations=LocalGenerations())
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    op = message.get('op')
+                    if op == 'get':
+                        value = store._get(message['key'])
+                        reply = {'hit': False} if value is _MISSING else {'hit': True, 'value': value}
+                    elif op == 'set':
+                        store._set(message['key'], message['value'], float(message['ttl']))
+                        reply = {'ok': True}
+                    elif op == 'drop':
+                        store._drop(message['namespace'])
+                        reply = {'ok': True}
+                    else:
+                        reply = {'error': f'unknown op {op}'}
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {'error': str(e)}
+                self.wfile.write(json.dumps(reply, separators=(',', ':')).encode('utf-8') + b'\n')
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    with Server((host, port), Handler) as server:
+        print(f"[INFO] Cache server listening on {host}:{port}")
+        server.serve_forever()
+
+
+def cache_dir(instance=None):
+    """CACHE_DIR if set, otherwise a temp directory keyed by instance (the database path)"""
+    if os.environ.get('CACHE_DIR') or not instance:
+        return CACHE_DIR
+    digest = blake2b(os.path.abspath(instance).encode('utf-8'), digest_size=6).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f'qr_app_cache-{digest}')
+
+
+def create_cache(backend=None, instance=None, name='cache', max_entries=None):
+    """Create the cache backend configured by CACHE_BACKEND (lru, mmap or socket)
+
+    Caches with another name get their own mmap file, and max_entries sizes their
+    LRU or mmap slots, so a bulky cache does not evict the entries of another one.
+    """
+    backend = (backend or os.environ.get('CACHE_BACKEND', 'lru')).lower()
+    try:
+        return _create_cache(backend, cache_dir(instance), name, max_entries)
+    except OSError as e:
+        # Read-only or missing temp directory - cache per process only
+        print(f"[WARNING] Could not create shared {backend} cache ({e}), using in-process cache")
+        return LRUCache(max_entries=max_entries or 2048, generations=LocalGenerations())
+
+
+def _create_cache(backend, directory, name='cache', max_entries=None):
+    generations = GenerationTable(os.path.join(directory, 'generations.bin'))
+    if backend == 'mmap':
+        return SharedMemoryCache(
+            path=os.path.join(directory, f'{name}.bin'),
+            slots=max_entries or int(os.environ.get('CACHE_MMAP_SLOTS', '256')),
+            slot_size=int(os.environ.get('CACHE_MMAP_SLOT_SIZE', '65536')),
+            generations=generations
+        )
+    if backend == 'socket':
+        return SocketCache(
+            host=os.environ.get('CACHE_SOCKET_HOST', '127.0.0.1'),
+            port=int(os.environ.get('CACHE_SOCKET_PORT', '11311')),
+            generations=generations
+        )
+    return LRUCache(max_entries=max_entries or int(os.environ.get('CACHE_LRU_MAX_ENTRIES', '2048')), generations=generations)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='QR App cache tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the local cache server')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=int(os.environ.get('CACHE_SOCKET_PORT', '11311')))
+    serve_parser.add_argument('--max-entries', type=int, default=100000)
+    args = parser.parse_args()
+
+    try:
+        serve(args.host, args.port, args.max_entries)
+    except KeyboardInterrupt:
+        print("\n[INFO] Cache server stopped")
+        sys.exit(0)
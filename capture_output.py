@@ -1,40 +1,177 @@
-"""Capture and display server output"""
-import sys
+"""Capture and display server output
+
+stdout/stderr are still written to the console right away. The copy for
+server_output.log is buffered and written by a background thread, so a
+print() on a request thread never waits for the disk. The log file is
+rotated by size or age and rotated files are gzip compressed.
+
+Environment variables:
+    OUTPUT_LOG_MAX_MB      - rotate when the log is bigger than this (default 10)
+    OUTPUT_LOG_MAX_HOURS   - rotate when the log is older than this (default 24)
+    OUTPUT_LOG_BACKUPS     - compressed logs to keep (default 5)
+    OUTPUT_LOG_FLUSH_KB    - write once this much output is buffered (default 64)
+    OUTPUT_LOG_FLUSH_SECONDS - write buffered output at least this often (default 1)
+"""
+import atexit
+import gzip
 import os
+import shutil
+import sys
+import threading
+import time
 from datetime import datetime
 
+
+class BufferedFileSink:
+    """Appends text to a file from a background thread, with size/age rotation"""
+    def __init__(self, path, max_bytes=None, max_age=None, backups=None, flush_bytes=None, flush_interval=None):
+        self.path = path
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.environ.get('OUTPUT_LOG_MAX_MB', '10')) * 1024 * 1024)
+        self.max_age = max_age if max_age is not None else float(os.environ.get('OUTPUT_LOG_MAX_HOURS', '24')) * 3600
+        self.backups = backups if backups is not None else int(os.environ.get('OUTPUT_LOG_BACKUPS', '5'))
+        self.flush_bytes = flush_bytes if flush_bytes is not None else int(os.environ.get('OUTPUT_LOG_FLUSH_KB', '64')) * 1024
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.environ.get('OUTPUT_LOG_FLUSH_SECONDS', '1'))
+
+        self.buffer = []
+        self.buffered = 0
+        self.condition = threading.Condition()
+        self.flush_requested = False
+        self.closed = False
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+        # Age rotation counts from when this sink opened the file - st_ctime is the
+        # last metadata change on POSIX, not the creation time
+        self.opened_at = time.time()
+
+        self.thread = threading.Thread(target=self._run, name='output-log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, text):
+        if not text:
+            return 0
+        with self.condition:
+            if self.closed:
+                return 0
+            self.buffer.append(text)
+            self.buffered += len(text)
+            if self.buffered >= self.flush_bytes:
+                self.condition.notify()
+        return len(text)
+
+    def flush(self):
+        """Ask the writer thread to write what is buffered (does not wait for it)"""
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout=10)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not (self.closed or self.flush_requested or self.buffered >= self.flush_bytes):
+                    self.condition.wait(self.flush_interval)
+                chunks, self.buffer, self.buffered = self.buffer, [], 0
+                self.flush_requested = False
+                closing = self.closed
+            try:
+                if chunks:
+                    self._write(''.join(chunks))
+                elif self._due_for_rotation():
+                    self._rotate()
+            except OSError as e:
+                # Never let a full disk take the server down - report on the real stderr
+                sys.__stderr__.write(f"[WARNING] Could not write {self.path}: {e}\n")
+            if closing:
+                self.file.close()
+                return
+
+    def _due_for_rotation(self):
+        return self.size > 0 and ((self.max_bytes and self.size >= self.max_bytes) or
+                                  (self.max_age and time.time() - self.opened_at >= self.max_age))
+
+    def _write(self, text):
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text.encode('utf-8'))
+        if self._due_for_rotation():
+            self._rotate()
+
+    def _rotate(self):
+        """server_output.log -> server_output.log.1.gz, older files shift up, the oldest is deleted"""
+        self.file.close()
+        try:
+            for n in range(self.backups, 0, -1):
+                older = f'{self.path}.{n}.gz'
+                if not os.path.exists(older):
+                    continue
+                if n == self.backups:
+                    os.remove(older)
+                else:
+                    os.replace(older, f'{self.path}.{n + 1}.gz')
+            if self.backups > 0:
+                rotated = f'{self.path}.rotating'
+                os.replace(self.path, rotated)
+                with open(rotated, 'rb') as src, gzip.open(f'{self.path}.1.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+            else:
+                os.remove(self.path)
+        finally:
+            # Keep logging even if the rotation failed half way
+            self.file = open(self.path, 'a', encoding='utf-8')
+            self.size = self.file.tell()
+            self.opened_at = time.time()
+
+
 class OutputCapture:
     def __init__(self, log_file='server_output.log'):
         self.log_file = log_file
         self.original_stdout = sys.stdout
         self.original_stderr = sys.stderr
-        
+        self.sink = None
+
     def start_capture(self):
         """Start capturing output"""
-        log_file = open(self.log_file, 'a', encoding='utf-8')
-        sys.stdout = TeeOutput(self.original_stdout, log_file)
-        sys.stderr = TeeOutput(self.original_stderr, log_file)
-        
+        self.sink = BufferedFileSink(self.log_file)
+        self.sink.write(f"\n--- Output capture started {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
+        sys.stdout = TeeOutput(self.original_stdout, self.sink)
+        sys.stderr = TeeOutput(self.original_stderr, self.sink)
+
     def stop_capture(self):
         """Stop capturing output"""
         sys.stdout = self.original_stdout
         sys.stderr = self.original_stderr
+        if self.sink:
+            self.sink.close()
 
 class TeeOutput:
-    """Write to both console and file"""
+    """Write to both console and file (the file side is buffered)"""
     def __init__(self, console, log_file):
         self.console = console
         self.log_file = log_file
-        
+
     def write(self, text):
         self.console.write(text)
         self.log_file.write(text)
-        self.log_file.flush()
-        
+        return len(text)
+
     def flush(self):
         self.console.flush()
         self.log_file.flush()
 
+    def __getattr__(self, name):
+        # encoding, isatty(), fileno() ... behave like the console stream
+        return getattr(self.console, name)
+
 if __name__ == '__main__':
     # Start capturing
     capture = OutputCapture()
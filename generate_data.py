@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Synthetic data generator for scale-testing the QR App schema
+
+Fills users, products, items, orders (with their order lines) and cart with
+production-sized data: product popularity and customer activity follow a Zipf
+distribution, every item gets a unique QR token, and items are linked to
+order lines the same way checkout and scanning leave them (reserved for
+pending orders, sold for confirmed ones).
+
+Examples:
+    python generate_data.py --products 10000 --items 5000000 --orders 1000000
+    python generate_data.py --db /tmp/scale.db --reset --products 500 --items 50000 --orders 10000
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import secrets
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+CATEGORIES = ['T-Shirt', 'Hoodie', 'Sweatshirt', 'Polo', 'Shirt', 'Jeans', 'Shorts', 'Jacket',
+              'Cap', 'Beanie', 'Socks', 'Scarf', 'Dress', 'Skirt', 'Tank Top', 'Joggers']
+SIZES = ['XS', 'S', 'M', 'L', 'XL', 'XXL', 'XXXL']
+BASE_COLORS = ['Black', 'White', 'Red', 'Blue', 'Green', 'Yellow', 'Grey', 'Navy',
+               'Pink', 'Purple', 'Orange', 'Brown', 'Beige', 'Maroon', 'Olive', 'Teal']
+SHADES = ['', 'Light ', 'Dark ', 'Pastel ', 'Neon ', 'Heather ']
+
+# Order status mix: (status, share)
+ORDER_STATUSES = [('confirmed', 0.70), ('pending', 0.10), ('cancelled', 0.15), ('approved', 0.05)]
+# Products per order (one checkout buys the whole cart)
+LINES_PER_ORDER = (1, 2, 3)
+LINES_PER_ORDER_WEIGHTS = (75, 18, 7)
+
+GENERATED_USER_PREFIX = 'loadtest_'
+GENERATED_PASSWORD = 'loadtest123'
+
+
+def zipf_cum_weights(n, skew):
+    """Cumulative Zipf weights for ranks 1..n (rank 1 is the most popular)"""
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def pick(cum_weights, rng):
+    """Index drawn from cumulative weights"""
+    return bisect.bisect_left(cum_weights, rng.random() * cum_weights[-1])
+
+
+def product_variants(count):
+    """Unique (category, size, color) combinations - categories are numbered once the base list runs out"""
+    colors = [f"{shade}{color}" for shade in SHADES for color in BASE_COLORS]
+    variants = []
+    for category_number in itertools.count():
+        for base in CATEGORIES:
+            category = base if category_number == 0 else f"{base} {category_number + 1}"
+            for color in colors:
+                for size in SIZES:
+                    variants.append((category, size, color))
+                    if len(variants) == count:
+                        return variants
+
+
+def timestamp(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Generator:
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.started = time.perf_counter()
+        self.now = datetime.now()
+
+    def log(self, message):
+        print(f"[{time.perf_counter() - self.started:7.1f}s] {message}")
+
+    def next_id(self, table):
+        return (self.conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0] or 0) + 1
+
+    def insert_batches(self, sql, rows, label, total):
+        """executemany in batches, reporting progress"""
+        done = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.args.batch_size:
+                self.conn.executemany(sql, batch)
+                done += len(batch)
+                batch = []
+                if done % (self.args.batch_size * 10) == 0:
+                    self.log(f"  {label}: {done:,}/{total:,}")
+        if batch:
+            self.conn.executemany(sql, batch)
+            done += len(batch)
+        self.log(f"  {label}: {done:,} inserted")
+
+    def reset(self):
+        self.log("Removing existing products, items, orders, cart and generated users...")
+        for table in ('cart', 'items', 'order_lines', 'orders', 'products'):
+            self.conn.execute(f'DELETE FROM {table}')
+        self.conn.execute('DELETE FROM users WHERE username LIKE ?', (GENERATED_USER_PREFIX + '%',))
+        self.conn.commit()
+
+    def generate_users(self):
+        first_id = self.next_id('users')
+        count = self.args.users
+        self.log(f"Generating {count:,} customers...")
+        rows = ((first_id + i, f"{GENERATED_USER_PREFIX}customer{first_id + i}", GENERATED_PASSWORD, 'customer',
+                 timestamp(self.now - timedelta(days=self.rng.randint(0, self.args.days))))
+                for i in range(count))
+        self.insert_batches('INSERT INTO users (id, username, password, user_type, created_at) VALUES (?, ?, ?, ?, ?)',
+                            rows, 'users', count)
+        self.user_ids = list(range(first_id, first_id + count))
+        # Customer activity is skewed too - a few customers place most orders
+        shuffled = self.user_ids[:]
+        self.rng.shuffle(shuffled)
+        self.user_ids = shuffled
+        self.user_weights = zipf_cum_weights(count, self.args.user_skew)
+
+    def generate_products(self):
+        count = self.args.products
+        first_id = self.next_id('products')
+        self.log(f"Generating {count:,} products...")
+        variants = product_variants(count)
+        rows = ((first_id + i, category, size, color, '/static/images/tshirt.png',
+                 timestamp(self.now - timedelta(days=self.args.days)))
+                for i, (category, size, color) in enumerate(variants))
+        self.insert_batches('INSERT INTO products (id, category, size, color, stock, image_url, created_at) VALUES (?, ?, ?, ?, 0, ?, ?)',
+                            rows, 'products', count)
+        # Popularity rank is independent of insertion order
+        self.product_ids = list(range(first_id, first_id + count))
+        self.rng.shuffle(self.product_ids)
+        self.product_weights = zipf_cum_weights(count, self.args.skew)
+
+    def plan_items(self):
+        """Items per product - proportional to popularity, at least one each"""
+        total = self.args.items
+        count = len(self.product_ids)
+        weights = [self.product_weights[0]] + [b - a for a, b in zip(self.product_weights, self.product_weights[1:])]
+        weight_sum = self.product_weights[-1]
+        remaining = max(total - count, 0)
+        self.items_per_product = {pid: 1 + int(remaining * w / weight_sum) for pid, w in zip(self.product_ids, weights)}
+        # Hand the rounding leftovers to the most popular products
+        leftover = total - sum(self.items_per_product.values())
+        for pid in itertools.islice(itertools.cycle(self.product_ids), max(leftover, 0)):
+            self.items_per_product[pid] += 1
+
+    def generate_orders(self):
+        count = self.args.orders
+        first_id = self.next_id('orders')
+        first_line_id = self.next_id('order_lines')
+        self.log(f"Generating {count:,} orders...")
+        statuses = [s for s, _ in ORDER_STATUSES]
+        status_weights = list(itertools.accumulate(share for _, share in ORDER_STATUSES))
+        # product_id -> list of (order_id, line_id, quantity, status); items are linked in generate_items()
+        self.order_allocations = {}
+        used = dict.fromkeys(self.product_ids, 0)
+        span = self.args.days * 86400
+        lines = []
+        lines_sql = 'INSERT INTO order_lines (id, order_id, product_id, quantity, created_at) VALUES (?, ?, ?, ?, ?)'
+
+        def rows():
+            order_id = first_id
+            line_id = first_line_id
+            for _ in range(count):
+                status = statuses[bisect.bisect_left(status_weights, self.rng.random() * status_weights[-1])]
+                created = timestamp(self.now - timedelta(seconds=self.rng.randint(0, span)))
+                line_count = self.rng.choices(LINES_PER_ORDER, weights=LINES_PER_ORDER_WEIGHTS)[0]
+                products = {self.product_ids[pick(self.product_weights, self.rng)] for _ in range(line_count)}
+                order_lines = []
+                for product_id in products:
+                    quantity = self.rng.choices((1, 2, 3, 4, 5), weights=(70, 15, 8, 4, 3))[0]
+                    # Sold-out products get smaller orders, so every order has its items
+                    quantity = min(quantity, self.items_per_product[product_id] - used[product_id])
+                    if quantity <= 0:
+                        continue
+                    if status != 'cancelled':
+                        used[product_id] += quantity
+                        self.order_allocations.setdefault(product_id, []).append((order_id, line_id, quantity, status))
+                    order_lines.append((line_id, order_id, product_id, quantity, created))
+                    line_id += 1
+                if not order_lines:
+                    continue
+                lines.extend(order_lines)
+                if len(lines) >= self.args.batch_size:
+                    self.conn.executemany(lines_sql, lines)
+                    lines.clear()
+                user_id = self.user_ids[pick(self.user_weights, self.rng)]
+                yield (order_id, user_id, status, created)
+                order_id += 1
+
+        self.insert_batches('INSERT INTO orders (id, user_id, status, created_at) VALUES (?, ?, ?, ?)',
+                            rows(), 'orders', count)
+        self.conn.executemany(lines_sql, lines)
+
+    def generate_items(self):
+        total = sum(self.items_per_product.values())
+        first_id = self.next_id('items')
+        self.log(f"Generating {total:,} items with unique QR tokens...")
+        self.available = {}
+        created_at = timestamp(self.now - timedelta(days=self.args.days))
+
+        def rows():
+            item_id = first_id
+            for product_id in sorted(self.product_ids):
+                linked = 0
+                for order_id, line_id, quantity, status in self.order_allocations.get(product_id, ()):
+                    # Pending orders hold reserved, not yet scanned items; the rest are sold
+                    item_status = 'reserved' if status == 'pending' else 'sold'
+                    validated = 0 if status == 'pending' else 1
+                    for _ in range(quantity):
+                        yield (item_id, product_id, secrets.token_urlsafe(16), item_status, validated, created_at, order_id, line_id)
+                        item_id += 1
+                    linked += quantity
+                available = self.items_per_product[product_id] - linked
+                self.available[product_id] = available
+                for _ in range(available):
+                    yield (item_id, product_id, secrets.token_urlsafe(16), 'available', 1, created_at, None, None)
+                    item_id += 1
+
+        self.insert_batches('''INSERT INTO items (id, product_id, qr_code, status, validated, validated_at, order_id, order_line_id)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows(), 'items', total)
+
+        self.log("Updating product stock counts...")
+        self.conn.executemany('UPDATE products SET stock = ? WHERE id = ?',
+                              [(available, product_id) for product_id, available in self.available.items()])
+
+    def generate_cart(self):
+        count = self.args.cart_rows
+        if not count:
+            return
+        self.log(f"Generating {count:,} cart rows...")
+        seen = set()
+        rows = []
+        attempts = 0
+        while len(rows) < count and attempts < count * 5:
+            attempts += 1
+            user_id = self.user_ids[pick(self.user_weights, self.rng)]
+            product_id = self.product_ids[pick(self.product_weights, self.rng)]
+            if (user_id, product_id) in seen or not self.available.get(product_id):
+                continue
+            seen.add((user_id, product_id))
+            rows.append((user_id, product_id, self.rng.randint(1, min(3, self.available[product_id]))))
+        self.insert_batches('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)', rows, 'cart', len(rows))
+
+    def run(self):
+        if self.args.reset:
+            self.reset()
+        elif self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]:
+            print("ERROR: The database already has products. Use --reset to replace them.")
+            sys.exit(1)
+
+        self.generate_users()
+        self.generate_products()
+        self.plan_items()
+        self.generate_orders()
+        self.generate_items()
+        self.generate_cart()
+        self.conn.commit()
+        self.log("Running ANALYZE...")
+        self.conn.execute('ANALYZE')
+        self.conn.commit()
+        self.log("Done.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Populate the QR App database with synthetic data')
+    parser.add_argument('--db', help='database file (default: the app database)')
+    parser.add_argument('--users', type=int, default=5000, help='customers to create (default 5000)')
+    parser.add_argument('--products', type=int, default=1000, help='products to create (default 1000)')
+    parser.add_argument('--items', type=int, default=100000, help='items to create (default 100000)')
+    parser.add_argument('--orders', type=int, default=20000, help='orders to create (default 20000)')
+    parser.add_argument('--cart-rows', type=int, default=2000, help='cart rows to create (default 2000)')
+    parser.add_argument('--days', type=int, default=365, help='spread order dates over this many days')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for product popularity')
+    parser.add_argument('--user-skew', type=float, default=0.8, help='Zipf exponent for customer activity')
+    parser.add_argument('--batch-size', type=int, default=20000, help='rows per executemany batch')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for repeatable datasets')
+    parser.add_argument('--reset', action='store_true', help='delete existing catalog, orders and generated users first')
+    args = parser.parse_args()
+
+    if args.items < args.products:
+        parser.error('--items must be at least --products (every product gets an item)')
+
+    # The app creates the schema, so generated data always matches it
+    import app as qr_app
+    if args.db:
+        qr_app.DATABASE = os.path.abspath(args.db)
+    qr_app.init_db()
+
+    print("=" * 70)
+    print("SYNTHETIC DATA GENERATOR")
+    print("=" * 70)
+    print(f"Database: {qr_app.DATABASE}")
+
+    # Bulk-load settings: this is a throwaway load, durability is not needed mid-way
+    conn = sqlite3.connect(qr_app.DATABASE)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -200000')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    try:
+        Generator(conn, args).run()
+    finally:
+        conn.close()
+    print("=" * 70)
+    print(f"Generated customers log in with password: {GENERATED_PASSWORD}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""Persistent background jobs stored in the app's SQLite database
+
+Heavy admin work (bulk restocks, rendering every item QR code of a product,
+deleting a product and cancelling its orders) is put in the jobs table and
+run by worker threads, so the HTTP request returns right away. Every gunicorn
+worker runs JOB_WORKERS threads; a job is claimed inside an IMMEDIATE
+transaction, so exactly one thread in one process runs it.
+
+    job_queue = JobQueue(get_db)
+
+    @job_queue.handler('restock')
+    def restock(job, payload):
+        ...
+        job.progress(done, total, 'Creating items')
+        return {'items_created': done}
+
+    job_id = job_queue.enqueue('restock', {'product_id': 1, 'stock': 500})
+
+A handler that raises is retried with exponential backoff up to max_attempts
+times. Jobs of a worker that died are picked up again once their heartbeat
+is older than JOB_STALE_SECONDS, so a handler must call job.progress() more
+often than that - a slow but live job would otherwise run twice. Every claim
+is a new attempt, and progress() raises JobLost in a run whose attempt is no
+longer the current one. Handlers that pass their connection to progress()
+and commit it with the batch are fenced that way: the old run's batch rolls
+back instead of being applied twice. Without worker threads (serverless), enqueue
+runs the job in the request instead, retrying it right away until it succeeds
+or max_attempts is used up - nothing would pick up a retry later.
+
+Environment variables:
+    JOB_WORKERS        - worker threads per process (default 1, 0 runs jobs inline)
+    JOB_POLL_SECONDS   - idle poll interval (default 1)
+    JOB_STALE_SECONDS  - requeue running jobs without progress for this long (default 300,
+                         handlers must report progress more often)
+    JOB_RETENTION_DAYS - purge() deletes finished jobs older than this (default 7)
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '1'))
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', '300'))
+JOB_RETENTION_DAYS = float(os.environ.get('JOB_RETENTION_DAYS', '7'))
+# Progress is written at most this often unless the caller passes its own connection
+PROGRESS_INTERVAL = 0.5
+
+# What _describe reads - the result blob is only selected when it is asked for
+JOB_COLUMNS = ('id, kind, payload, status, progress, total, message, error, attempts, max_attempts, '
+               'created_at, started_at, finished_at')
+
+log = logging.getLogger('qr_app.jobs')
+
+
+class JobLost(Exception):
+    """The job was requeued as stale and claimed again - this run must stop"""
+
+
+def init_schema(cursor):
+    """Create the jobs table (called from init_db)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued', 'running', 'done', 'failed')),
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NULL,
+            message TEXT NULL,
+            result TEXT NULL,
+            error TEXT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL DEFAULT 0,
+            heartbeat REAL NULL,
+            worker TEXT NULL,
+            created_by INTEGER NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME NULL,
+            finished_at DATETIME NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_after)')
+
+
+class Job:
+    """A claimed job as seen by its handler"""
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row['id']
+        self.kind = row['kind']
+        self.attempts = row['attempts']
+        # Work finished by an earlier attempt - handlers that commit in batches resume from here
+        self.done = row['progress']
+        self._last_progress = 0.0
+
+    def progress(self, done, total=None, message=None, conn=None):
+        """Report progress and send a heartbeat; with conn the update joins the caller's transaction (caller commits)
+
+        Raises JobLost when this run no longer owns the job, before the caller commits.
+        """
+        self.done = done
+        now = time.time()
+        if conn is None and now - self._last_progress < PROGRESS_INTERVAL and (total is None or done < total):
+            return
+        self._last_progress = now
+        sql = ('UPDATE jobs SET progress = ?, total = COALESCE(?, total), message = COALESCE(?, message), '
+               "heartbeat = ? WHERE id = ? AND status = 'running' AND attempts = ?")
+        args = (done, total, message, now, self.id, self.attempts)
+        if conn is not None:
+            updated = conn.execute(sql, args).rowcount
+        else:
+            updated = self.queue._execute(sql, args).rowcount
+        if not updated:
+            raise JobLost(f'Job {self.id} attempt {self.attempts} was requeued')
+
+
+class JobQueue:
+    def __init__(self, connect):
+        self.connect = connect
+        self.handlers = {}
+        self.threads = []
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.worker_name = f'{socket.gethostname()}:{os.getpid()}'
+
+    def handler(self, kind):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def _execute(self, sql, args=()):
+        conn = self.connect()
+        try:
+            cursor = conn.execute(sql, args)
+            conn.commit()
+            return cursor
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, payload, max_attempts=3, created_by=None):
+        """Queue a job and return its id (runs it right away when there are no workers)"""
+        if kind not in self.handlers:
+            raise ValueError(f'No handler for job kind {kind!r}')
+        job_id = self._execute(
+            'INSERT INTO jobs (kind, payload, max_attempts, created_by) VALUES (?, ?, ?, ?)',
+            (kind, json.dumps(payload), max_attempts, created_by)).lastrowid
+        log.info("Job queued", extra={'job_id': job_id, 'kind': kind})
+        if self.threads:
+            self.wakeup.set()
+        else:
+            # Serverless or JOB_WORKERS=0 - no thread would ever pick it up, or a retry of it.
+            # A failed attempt puts the job back in the queue, so this stops once it is
+            # done or failed for good.
+            while self.run_pending(job_id):
+                pass
+        return job_id
+
+    def get(self, job_id, include_result=False):
+        conn = self.connect()
+        try:
+            columns = JOB_COLUMNS + (', result' if include_result else '')
+            row = conn.execute(f'SELECT {columns} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._describe(row, include_result) if row else None
+
+    def find(self, kind, payload, max_age_seconds):
+        """Id of the newest job of kind with this payload that is queued, running or done in the last max_age_seconds"""
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT id FROM jobs
+                WHERE kind = ? AND payload = ?
+                  AND (status IN ('queued', 'running') OR (status = 'done' AND finished_at >= datetime('now', ?)))
+                ORDER BY id DESC LIMIT 1
+            ''', (kind, json.dumps(payload), f'-{int(max_age_seconds)} seconds')).fetchone()
+        finally:
+            conn.close()
+        return row['id'] if row else None
+
+    def purge(self, conn, days=JOB_RETENTION_DAYS):
+        """Delete done and failed jobs that finished more than days ago; returns the number deleted"""
+        cursor = conn.execute('''
+            DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < datetime('now', ?)
+        ''', (f'-{int(days * 86400)} seconds',))
+        conn.commit()
+        return cursor.rowcount
+
+    def recent(self, limit=50):
+        conn = self.connect()
+        try:
+            rows = conn.execute(f'SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        finally:
+            conn.close()
+        return [self._describe(row) for row in rows]
+
+    @staticmethod
+    def _describe(row, include_result=False):
+        job = {k: row[k] for k in ('id', 'kind', 'status', 'progress', 'total', 'message', 'error',
+                                   'attempts', 'max_attempts', 'created_at', 'started_at', 'finished_at')}
+        job['payload'] = json.loads(row['payload'])
+        job['percent'] = (round(100.0 * row['progress'] / row['total'], 1) if row['total']
+                          else (100.0 if row['status'] == 'done' else 0.0))
+        if include_result and row['result']:
+            job['result'] = json.loads(row['result'])
+        return job
+
+    def _claim(self, job_id=None):
+        """Mark the next runnable job (or job_id) as running by this worker and return it"""
+        conn = self.connect()
+        try:
+            now = time.time()
+            # Idle polls only read - the write lock is taken when there is something to claim
+            if job_id is None:
+                pending = conn.execute('''
+                    SELECT 1 FROM jobs
+                    WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND heartbeat < ?)
+                    LIMIT 1
+                ''', (now, now - JOB_STALE_SECONDS)).fetchone()
+            else:
+                pending = conn.execute("SELECT 1 FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)).fetchone()
+            if pending is None:
+                return None
+            conn.execute('BEGIN IMMEDIATE')
+            # Jobs of a crashed worker stop sending heartbeats - make them runnable again
+            conn.execute('''
+                UPDATE jobs SET status = 'queued', worker = NULL
+                WHERE status = 'running' AND heartbeat < ?
+            ''', (now - JOB_STALE_SECONDS,))
+            if job_id is None:
+                row = conn.execute('''
+                    SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY id LIMIT 1
+                ''', (now,)).fetchone()
+            else:
+                row = conn.execute("SELECT * FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute('''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, heartbeat = ?,
+                       started_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (self.worker_name, now, row['id']))
+            conn.commit()
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+            return row
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _run(self, row):
+        job = Job(self, row)
+        payload = json.loads(row['payload'])
+        handler = self.handlers.get(row['kind'])
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError(f'No handler for job kind {row["kind"]!r}')
+            result = handler(job, payload)
+        except JobLost:
+            # Another worker claimed the requeued job - it owns the outcome now
+            log.warning("Job lost to another worker", extra={'job_id': job.id, 'kind': job.kind, 'attempt': job.attempts})
+            return
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            if row['attempts'] < row['max_attempts']:
+                delay = 2 ** row['attempts']
+                log.warning("Job failed, retrying", extra={'job_id': job.id, 'kind': job.kind,
+                                                          'attempt': row['attempts'], 'retry_in': delay, 'error': error})
+                self._execute('''
+                    UPDATE jobs SET status = 'queued', error = ?, run_after = ?, worker = NULL
+                    WHERE id = ? AND status = 'running' AND attempts = ?
+                ''', (error, time.time() + delay, job.id, job.attempts))
+            else:
+                log.error("Job failed", extra={'job_id': job.id, 'kind': job.kind, 'attempts': row['attempts'],
+                                               'error': error, 'trace': traceback.format_exc(limit=5)})
+                self._execute('''
+                    UPDATE jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP, worker = NULL
+                    WHERE id = ? AND status = 'running' AND attempts = ?
+                ''', (error, job.id, job.attempts))
+            return
+        self._execute('''
+            UPDATE jobs SET status = 'done', result = ?, error = NULL, progress = COALESCE(total, progress),
+                   finished_at = CURRENT_TIMESTAMP, worker = NULL
+            WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', (json.dumps(result), job.id, job.attempts))
+        log.info("Job done", extra={'job_id': job.id, 'kind': job.kind, 'ms': round((time.perf_counter() - started) * 1000)})
+
+    def run_pending(self, job_id=None):
+        """Run one job (the given one or the next runnable); returns True if a job ran"""
+        row = self._claim(job_id)
+        if row is None:
+            return False
+        self._run(row)
+        return True
+
+    def _worker_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                ran = self.run_pending()
+            except Exception:
+                log.exception("Job worker error")
+                ran = False
+            if not ran:
+                self.wakeup.wait(JOB_POLL_SECONDS)
+                self.wakeup.clear()
+
+    def start(self, workers=JOB_WORKERS):
+        """Start the worker threads of this process"""
+        if self.threads or workers <= 0:
+            return
+        for n in range(workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{n}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log.info("Job workers started", extra={'workers': workers, 'worker': self.worker_name})
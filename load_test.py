@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Local load driver for the QR App
+
+Virtual users run scripted flows against the app over HTTP:
+    customer  - login, browse /homepage and /products, add_to_cart, cart, checkout, orders
+    approval  - approval orders list, scan_order_qr page, check_scan_status polling
+                every 2 seconds, then approve_order
+    scanner   - mobile /scan/item/<qr> hits for codes shown on the approval pages
+    admin     - admin dashboard, products and orders listings
+
+Throughput, latency percentiles and error rates are reported per step.
+
+Examples:
+    python load_test.py --start-server --concurrency 20 --duration 60
+    python load_test.py --url http://127.0.0.1:5000 --mix customer=60,approval=10,scanner=25,admin=5
+"""
+import argparse
+import os
+import queue
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+ITEM_CODE_PATTERN = re.compile(r'<p class="small"><code>([A-Za-z0-9_\-]+)</code>')
+ORDER_LINK_PATTERN = re.compile(r'/approval/scan_order_qr/(\d+)')
+CATEGORY_PATTERN = re.compile(r'products\?category=([^"&\']+)')
+PRODUCT_ID_PATTERN = re.compile(r'addToCart\(event, (\d+)\)')
+
+
+class Stats:
+    """Latencies and errors per step, shared by all virtual users"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, step, seconds, ok):
+        with self.lock:
+            self.latencies[step].append(seconds)
+            if not ok:
+                self.errors[step] += 1
+
+    def report(self, elapsed):
+        def percentile(values, pct):
+            return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+        print("\n" + "=" * 100)
+        print(f"{'step':<26}{'requests':>9}{'rps':>8}{'errors':>8}{'err %':>7}"
+              f"{'p50 ms':>9}{'p90 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        print("-" * 100)
+        total = total_errors = 0
+        for step in sorted(self.latencies):
+            values = sorted(self.latencies[step])
+            errors = self.errors[step]
+            total += len(values)
+            total_errors += errors
+            print(f"{step:<26}{len(values):>9}{len(values) / elapsed:>8.1f}{errors:>8}{errors * 100 / len(values):>7.1f}"
+                  f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 90) * 1000:>9.1f}"
+                  f"{percentile(values, 95) * 1000:>9.1f}{percentile(values, 99) * 1000:>9.1f}{values[-1] * 1000:>9.1f}")
+        print("-" * 100)
+        if total:
+            print(f"{'TOTAL':<26}{total:>9}{total / elapsed:>8.1f}{total_errors:>8}{total_errors * 100 / total:>7.1f}")
+        print("=" * 100)
+
+
+class VirtualUser:
+    def __init__(self, base_url, stats, shared, args, number):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.shared = shared
+        self.args = args
+        self.number = number
+        self.rng = random.Random(args.seed + number if args.seed is not None else None)
+        self.session = requests.Session()
+        self.logged_in_as = None
+
+    def request(self, step, method, path, expect_json=False, **kwargs):
+        kwargs.setdefault('timeout', self.args.timeout)
+        kwargs.setdefault('allow_redirects', False)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+            ok = response.status_code < 400
+            if ok and expect_json:
+                body = response.json()
+                ok = body.get('success', True) is not False
+        except (requests.RequestException, ValueError):
+            response = None
+            ok = False
+        self.stats.record(step, time.perf_counter() - start, ok)
+        return response
+
+    def login(self, username, password, user_type):
+        if self.logged_in_as == (username, user_type):
+            return True
+        self.session.cookies.clear()
+        response = self.request('login', 'POST', '/login',
+                                data={'username': username, 'password': password, 'user_type': user_type})
+        # Successful logins redirect to the dashboard, failures re-render the form
+        self.logged_in_as = (username, user_type) if response is not None and response.status_code == 302 else None
+        return self.logged_in_as is not None
+
+    def customer_flow(self):
+        customer_id = self.rng.randint(*self.args.customer_ids)
+        if not self.login(self.args.customer_pattern.format(n=customer_id), self.args.customer_password, 'customer'):
+            return
+        response = self.request('customer:homepage', 'GET', '/homepage')
+        categories = CATEGORY_PATTERN.findall(response.text) if response is not None else []
+        category = self.rng.choice(categories) if categories else 'T-Shirt'
+        response = self.request('customer:products', 'GET', f'/products?category={category}')
+        product_ids = PRODUCT_ID_PATTERN.findall(response.text) if response is not None else []
+        if not product_ids:
+            return
+        for product_id in self.rng.sample(product_ids, min(len(product_ids), self.rng.randint(1, 3))):
+            self.request('customer:add_to_cart', 'POST', '/add_to_cart', expect_json=True,
+                         data={'product_id': product_id, 'quantity': 1})
+        self.request('customer:cart', 'GET', '/cart')
+        if self.rng.random() < self.args.checkout_rate:
+            self.request('customer:checkout', 'POST', '/checkout')
+            self.request('customer:orders', 'GET', '/orders')
+
+    def approval_flow(self):
+        if not self.login(self.args.approval_user, self.args.approval_password, 'approval_admin'):
+            return
+        response = self.request('approval:orders', 'GET', '/approval/orders')
+        order_ids = ORDER_LINK_PATTERN.findall(response.text) if response is not None else []
+        if not order_ids:
+            return
+        order_id = self.rng.choice(order_ids[:20])
+        response = self.request('approval:scan_order_qr', 'GET', f'/approval/scan_order_qr/{order_id}')
+        if response is not None:
+            # The phones in the scanner flow "scan" what this page shows
+            for code in dict.fromkeys(ITEM_CODE_PATTERN.findall(response.text)):
+                try:
+                    self.shared.put_nowait(code)
+                except queue.Full:
+                    break
+        for _ in range(self.args.polls):
+            time.sleep(self.args.poll_interval)
+            response = self.request('approval:check_scan_status', 'GET', f'/approval/check_scan_status/{order_id}',
+                                    expect_json=True)
+            if response is not None and response.ok and response.json().get('order_confirmed'):
+                return
+        self.request('approval:approve_order', 'POST', f'/approval/approve_order/{order_id}', expect_json=True,
+                     headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    def scanner_flow(self):
+        try:
+            code = self.shared.get(timeout=1.0)
+        except queue.Empty:
+            return
+        self.request('scanner:scan_item', 'GET', f'/scan/item/{code}')
+
+    def admin_flow(self):
+        if not self.login(self.args.admin_user, self.args.admin_password, 'admin'):
+            return
+        self.request('admin:dashboard', 'GET', '/admin/dashboard')
+        self.request('admin:products', 'GET', '/admin/products')
+        self.request('admin:orders', 'GET', '/admin/orders')
+
+    def run(self, flows, weights, deadline):
+        while time.time() < deadline:
+            flow = self.rng.choices(flows, weights=weights)[0]
+            getattr(self, f'{flow}_flow')()
+            if self.args.think_time:
+                time.sleep(self.rng.uniform(0, self.args.think_time))
+
+
+def procfile_command(port):
+    """The web command from the Procfile with $PORT filled in"""
+    procfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Procfile')
+    with open(procfile, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('web:'):
+                return shlex.split(line[len('web:'):].strip().replace('$PORT', str(port)))
+    raise RuntimeError('No web process in Procfile')
+
+
+def start_server(port):
+    command = procfile_command(port)
+    # Bind to loopback only - this is a local test
+    command = [arg.replace('0.0.0.0', '127.0.0.1') for arg in command]
+    print(f"[INFO] Starting: {' '.join(command)}")
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(60):
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/api/status', timeout=1).ok:
+                return server
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError('Server exited during startup')
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError('Server did not become ready within 30 seconds')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('customer', 'approval', 'scanner', 'admin'):
+            raise argparse.ArgumentTypeError(f'unknown flow: {name}')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def parse_range(text):
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the QR App with customer, approval, scanner and admin traffic')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='app base URL')
+    parser.add_argument('--start-server', action='store_true', help='start the Procfile gunicorn command locally first')
+    parser.add_argument('--port', type=int, default=8000, help='port for --start-server')
+    parser.add_argument('--concurrency', type=int, default=10, help='virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='test length in seconds')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds to start all virtual users')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('customer=70,approval=10,scanner=15,admin=5'),
+                        help='flow weights, e.g. customer=70,approval=10,scanner=15,admin=5')
+    parser.add_argument('--think-time', type=float, default=0.5, help='max random pause between flows (seconds)')
+    parser.add_argument('--checkout-rate', type=float, default=0.3, help='share of customer flows that check out')
+    parser.add_argument('--polls', type=int, default=3, help='check_scan_status polls per approval flow')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='seconds between status polls')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds')
+    parser.add_argument('--customer-pattern', default='customer1',
+                        help='customer username, {n} is replaced by a number from --customer-ids '
+                             '(e.g. loadtest_customer{n} for generate_data.py users)')
+    parser.add_argument('--customer-ids', type=parse_range, default=(1, 1), help='range for {n}, e.g. 4-5003')
+    parser.add_argument('--customer-password', default='customer123')
+    parser.add_argument('--approval-user', default='approval_admin1')
+    parser.add_argument('--approval-password', default='approval123')
+    parser.add_argument('--admin-user', default='admin1')
+    parser.add_argument('--admin-password', default='admin123')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if args.start_server:
+        server = start_server(args.port)
+        base_url = f'http://127.0.0.1:{args.port}'
+
+    flows = list(args.mix)
+    weights = [args.mix[f] for f in flows]
+    stats = Stats()
+    scanned_codes = queue.Queue(maxsize=10000)
+
+    print("=" * 100)
+    print(f"LOAD TEST: {base_url} - {args.concurrency} users for {args.duration:.0f}s, mix {args.mix}")
+    print("=" * 100)
+
+    started = time.time()
+    deadline = started + args.duration
+    threads = []
+    try:
+        for number in range(args.concurrency):
+            user = VirtualUser(base_url, stats, scanned_codes, args, number)
+            thread = threading.Thread(target=user.run, args=(flows, weights, deadline), daemon=True)
+            thread.start()
+            threads.append(thread)
+            time.sleep(args.ramp_up / max(args.concurrency, 1))
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0) + args.timeout + args.poll_interval * args.polls)
+    except KeyboardInterrupt:
+        print("\n[INFO] Interrupted - reporting what was collected")
+    finally:
+        stats.report(max(time.time() - started, 0.001))
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
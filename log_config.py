@@ -0,0 +1,137 @@
+"""Leveled, structured logging for the QR App
+
+Request handlers log through loggers under "qr_app" (qr_app.checkout,
+qr_app.scan, ...). Records are put on a queue by the request thread and
+written by a background listener thread, so logging never blocks a request
+on stdout.
+
+Environment variables:
+    LOG_LEVEL        - level for all qr_app loggers (default INFO)
+    LOG_LEVELS       - per-module overrides, e.g. "qr_app.scan=DEBUG,qr_app.checkout=DEBUG"
+    LOG_FORMAT       - "text" (default) or "json" (one JSON object per line)
+    LOG_SAMPLE_RATE  - fraction of DEBUG records to keep (default 1.0)
+    LOG_QUEUE_SIZE   - max queued records before new ones are dropped (default 10000)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime
+
+ROOT_LOGGER = 'qr_app'
+
+# Attributes every LogRecord has - anything else was passed in extra={...}
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_queue_handler = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats the message plus any extra={...} fields as key=value pairs or JSON"""
+    def __init__(self, json_output=False):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = {k: v for k, v in record.__dict__.items() if k not in _STANDARD_ATTRS}
+        timestamp = datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+
+        if self.json_output:
+            payload = {
+                'ts': timestamp,
+                'level': record.levelname,
+                'logger': record.name,
+                'msg': record.getMessage()
+            }
+            payload.update(fields)
+            if exc_text:
+                payload['exc'] = exc_text
+            return json.dumps(payload, default=str, ensure_ascii=False)
+
+        line = f"{timestamp} {record.levelname} {record.name}: {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        if exc_text:
+            line += '\n' + exc_text
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of records at or below max_level (DEBUG by default)"""
+    def __init__(self, rate, max_level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        return record.levelno > self.max_level or self.rate >= 1.0 or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the message and traceback on the request thread (args may be
+        # mutated later) but keep the extra fields for the structured formatter
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_level(name, default=logging.INFO):
+    level = logging.getLevelName(str(name).strip().upper())
+    return level if isinstance(level, int) else default
+
+
+def configure_logging(stream=None):
+    """Set up the qr_app loggers once per process and start the background writer"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return logging.getLogger(ROOT_LOGGER)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(_parse_level(os.environ.get('LOG_LEVEL', 'INFO')))
+    root.propagate = False
+
+    for override in os.environ.get('LOG_LEVELS', '').split(','):
+        if '=' in override:
+            name, level = override.split('=', 1)
+            logging.getLogger(name.strip()).setLevel(_parse_level(level))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter(json_output=os.environ.get('LOG_FORMAT', 'text').lower() == 'json'))
+
+    log_queue = queue.Queue(maxsize=int(os.environ.get('LOG_QUEUE_SIZE', '10000')))
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(SamplingFilter(float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))))
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued when the worker exits
+    atexit.register(_listener.stop)
+    return root
+
+
+def dropped_records():
+    """Number of log records dropped because the queue was full"""
+    return _queue_handler.dropped if _queue_handler else 0
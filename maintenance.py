@@ -0,0 +1,289 @@
+"""Periodic SQLite maintenance: statistics, incremental vacuum and WAL checkpoints
+
+Deleting products and moving items around leaves free pages in the database
+file, the query planner works from statistics that are never refreshed and,
+in WAL mode, the -wal file grows until something checkpoints it. A scheduler
+thread in every gunicorn worker wakes up every MAINTENANCE_POLL_SECONDS and,
+when a run is due and the process has been idle for a while, runs these tasks
+within a time budget:
+
+    optimize     - PRAGMA optimize (ANALYZE with analysis_limit if there are no statistics yet)
+    vacuum       - PRAGMA incremental_vacuum in small steps until the free pages are gone
+    checkpoint   - PRAGMA wal_checkpoint(TRUNCATE)
+
+Workers coordinate through a lock row in the maintenance_lock table, taken in
+an IMMEDIATE transaction, so only one of them runs maintenance at a time and
+the interval counts from the last run of any worker. Every run is recorded in
+maintenance_runs, which the status page reads.
+
+    scheduler = MaintenanceScheduler(get_db)
+    scheduler.start()                 # background thread
+    scheduler.note_request()          # from before_request - marks the process busy
+    scheduler.run(force=True)         # run now, within the budget
+
+    @scheduler.task('purge_old_rows')  # app housekeeping, run before the vacuum
+    def purge_old_rows(conn, deadline):
+        ...
+        return {'deleted': n}
+
+Environment variables:
+    MAINTENANCE_INTERVAL_SECONDS - time between runs (default 3600, 0 disables the scheduler)
+    MAINTENANCE_BUDGET_SECONDS   - a run stops starting new work after this long (default 5)
+    MAINTENANCE_IDLE_SECONDS     - only run after this long without a request (default 30)
+    MAINTENANCE_WINDOW           - local hours to run in, e.g. "2-5" (default any hour)
+    MAINTENANCE_POLL_SECONDS     - how often the thread checks if a run is due (default 60)
+    MAINTENANCE_VACUUM_MAX_MB    - convert a database without auto_vacuum with one full VACUUM
+                                   only up to this size (default 16). VACUUM holds an exclusive
+                                   lock on the whole database while it runs, so it is also
+                                   skipped when it would not fit in the remaining budget
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+MAINTENANCE_INTERVAL_SECONDS = float(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', '3600'))
+MAINTENANCE_BUDGET_SECONDS = float(os.environ.get('MAINTENANCE_BUDGET_SECONDS', '5'))
+MAINTENANCE_IDLE_SECONDS = float(os.environ.get('MAINTENANCE_IDLE_SECONDS', '30'))
+MAINTENANCE_WINDOW = os.environ.get('MAINTENANCE_WINDOW', '')
+MAINTENANCE_POLL_SECONDS = float(os.environ.get('MAINTENANCE_POLL_SECONDS', '60'))
+MAINTENANCE_VACUUM_MAX_MB = float(os.environ.get('MAINTENANCE_VACUUM_MAX_MB', '16'))
+# Conservative full VACUUM speed used to decide if the conversion fits in the budget
+VACUUM_MB_PER_SECOND = 20
+# Rows sampled per index by ANALYZE - keeps it fast on big tables
+ANALYSIS_LIMIT = 1000
+# Pages freed per incremental_vacuum step (the budget is checked between steps)
+VACUUM_STEP_PAGES = 256
+AUTO_VACUUM_INCREMENTAL = 2
+
+log = logging.getLogger('qr_app.maintenance')
+
+
+def init_schema(cursor):
+    """Create the maintenance tables (called from init_db)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('done', 'partial', 'failed')),
+            tasks TEXT NOT NULL DEFAULT '[]',
+            duration_ms INTEGER NOT NULL DEFAULT 0,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_lock (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+def in_window(window, hour):
+    """True if hour is inside a "start-end" window of local hours (which may wrap past midnight)"""
+    if not window:
+        return True
+    start, end = (int(part) for part in window.split('-', 1))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class MaintenanceScheduler:
+    def __init__(self, connect):
+        self.connect = connect
+        self.worker_name = f'{socket.gethostname()}:{os.getpid()}'
+        self.last_request = 0.0
+        # Quiet time before the current request (used after a request on serverless)
+        self.gap_before_request = float('inf')
+        self.thread = None
+        self.tasks = []
+
+    def task(self, name):
+        """Register a housekeeping task func(conn, deadline) -> detail dict (commits its own work)"""
+        def register(func):
+            self.tasks.append((name, func))
+            return func
+        return register
+
+    def note_request(self):
+        now = time.time()
+        self.gap_before_request = now - self.last_request
+        self.last_request = now
+
+    def idle(self, after_request=False):
+        if after_request:
+            return self.gap_before_request >= MAINTENANCE_IDLE_SECONDS
+        return time.time() - self.last_request >= MAINTENANCE_IDLE_SECONDS
+
+    def _acquire(self, conn, force):
+        """Take the cross-worker lock if a run is due (or forced); returns True if this worker runs"""
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not force:
+                last = conn.execute('SELECT finished_at FROM maintenance_runs ORDER BY id DESC LIMIT 1').fetchone()
+                if last is not None and now - last['finished_at'] < MAINTENANCE_INTERVAL_SECONDS:
+                    conn.commit()
+                    return False
+            lock = conn.execute("SELECT holder, expires_at FROM maintenance_lock WHERE name = 'maintenance'").fetchone()
+            if lock is not None and lock['expires_at'] > now and lock['holder'] != self.worker_name:
+                conn.commit()
+                return False
+            # Expires on its own if this worker dies half way
+            conn.execute('''
+                INSERT INTO maintenance_lock (name, holder, expires_at) VALUES ('maintenance', ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            ''', (self.worker_name, now + MAINTENANCE_BUDGET_SECONDS * 4 + 60))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _release(self, conn):
+        conn.execute("DELETE FROM maintenance_lock WHERE name = 'maintenance' AND holder = ?", (self.worker_name,))
+        conn.commit()
+
+    def run(self, force=False):
+        """Run the maintenance tasks if due; returns the run report, or None if skipped"""
+        conn = self.connect()
+        try:
+            if not self._acquire(conn, force):
+                return None
+            try:
+                return self._run_tasks(conn)
+            finally:
+                self._release(conn)
+        finally:
+            conn.close()
+
+    def _run_tasks(self, conn):
+        started = time.perf_counter()
+        deadline = started + MAINTENANCE_BUDGET_SECONDS
+        tasks = []
+        status = 'done'
+        # Housekeeping deletes run before the vacuum, which then frees their pages
+        for name, task in [('optimize', self._optimize), *self.tasks,
+                           ('vacuum', self._vacuum), ('checkpoint', self._checkpoint)]:
+            if time.perf_counter() >= deadline:
+                tasks.append({'task': name, 'skipped': 'time budget used up'})
+                status = 'partial'
+                continue
+            task_started = time.perf_counter()
+            try:
+                detail = task(conn, deadline)
+            except sqlite3.Error as e:
+                detail = {'error': str(e)}
+                status = 'failed'
+                log.warning("Maintenance task failed", extra={'task': name, 'error': str(e)})
+            if detail.pop('partial', False) and status == 'done':
+                status = 'partial'
+            tasks.append(dict(detail, task=name, ms=round((time.perf_counter() - task_started) * 1000, 1)))
+        duration_ms = round((time.perf_counter() - started) * 1000)
+        conn.execute('''
+            INSERT INTO maintenance_runs (worker, status, tasks, duration_ms, finished_at) VALUES (?, ?, ?, ?, ?)
+        ''', (self.worker_name, status, json.dumps(tasks), duration_ms, time.time()))
+        conn.execute('DELETE FROM maintenance_runs WHERE id <= (SELECT MAX(id) FROM maintenance_runs) - 100')
+        conn.commit()
+        log.info("Maintenance run", extra={'status': status, 'ms': duration_ms, 'tasks': tasks})
+        return {'status': status, 'duration_ms': duration_ms, 'tasks': tasks}
+
+    @staticmethod
+    def _optimize(conn, deadline):
+        conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+        if has_stats:
+            # optimize only re-analyzes tables whose statistics are out of date
+            conn.execute('PRAGMA optimize')
+            return {'action': 'optimize'}
+        conn.execute('ANALYZE')
+        conn.commit()
+        return {'action': 'analyze'}
+
+    @staticmethod
+    def _vacuum(conn, deadline):
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # auto_vacuum can only be switched on by rebuilding the file once
+            size_mb = conn.execute('PRAGMA page_count').fetchone()[0] * page_size / (1024 * 1024)
+            if size_mb > MAINTENANCE_VACUUM_MAX_MB:
+                return {'skipped': f'auto_vacuum is off and the database is {size_mb:.0f} MB', 'free_pages': freelist}
+            # VACUUM locks out every writer until it is done - only start it if it fits the budget
+            if size_mb / VACUUM_MB_PER_SECOND > deadline - time.perf_counter():
+                return {'skipped': 'auto_vacuum conversion does not fit in the remaining budget',
+                        'free_pages': freelist, 'partial': True}
+            conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+            conn.execute('VACUUM')
+            return {'action': 'converted to incremental auto_vacuum', 'freed_pages': freelist}
+        freed = 0
+        while freelist and time.perf_counter() < deadline:
+            conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            freed += freelist - remaining
+            freelist = remaining
+        return {'freed_pages': freed, 'freed_kb': freed * page_size // 1024, 'free_pages': freelist,
+                'partial': bool(freelist)}
+
+    @staticmethod
+    def _checkpoint(conn, deadline):
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            return {'skipped': 'not in WAL mode'}
+        busy, wal_pages, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        # busy means a reader kept part of the WAL in use - the next run catches up
+        return {'wal_pages': wal_pages, 'checkpointed': checkpointed, 'busy': bool(busy), 'partial': bool(busy)}
+
+    def status(self):
+        """Recent runs and current database file statistics for the status page"""
+        conn = self.connect()
+        try:
+            runs = conn.execute('SELECT * FROM maintenance_runs ORDER BY id DESC LIMIT 5').fetchall()
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            database = {
+                'size_kb': conn.execute('PRAGMA page_count').fetchone()[0] * page_size // 1024,
+                'free_kb': conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size // 1024,
+                'journal_mode': conn.execute('PRAGMA journal_mode').fetchone()[0],
+                'auto_vacuum': ('none', 'full', 'incremental')[conn.execute('PRAGMA auto_vacuum').fetchone()[0]],
+            }
+        finally:
+            conn.close()
+        last = runs[0]['finished_at'] if runs else None
+        return {
+            'database': database,
+            'interval_seconds': MAINTENANCE_INTERVAL_SECONDS,
+            'next_run_after': (last + MAINTENANCE_INTERVAL_SECONDS) if last else None,
+            'runs': [{'worker': row['worker'], 'status': row['status'], 'duration_ms': row['duration_ms'],
+                      'started_at': row['started_at'], 'tasks': json.loads(row['tasks'])} for row in runs],
+        }
+
+    def run_if_due(self, after_request=False):
+        """Run when idle, inside MAINTENANCE_WINDOW and the interval has passed (any worker counts)
+
+        after_request is for callers at the end of a request (no scheduler thread):
+        idle then means no request came in for MAINTENANCE_IDLE_SECONDS before it.
+        """
+        if not self.idle(after_request) or not in_window(MAINTENANCE_WINDOW, time.localtime().tm_hour):
+            return None
+        return self.run()
+
+    def _loop(self):
+        while True:
+            time.sleep(MAINTENANCE_POLL_SECONDS)
+            try:
+                self.run_if_due()
+            except Exception as e:
+                log.warning("Maintenance run failed: %s", e)
+
+    def start(self):
+        """Start the scheduler thread of this process"""
+        if self.thread is not None or MAINTENANCE_INTERVAL_SECONDS <= 0:
+            return
+        self.thread = threading.Thread(target=self._loop, name='db-maintenance', daemon=True)
+        self.thread.start()
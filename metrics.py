@@ -0,0 +1,231 @@
+"""Request, QR rendering and DB metrics in Prometheus text format
+
+Each gunicorn worker keeps its own counters and histograms in memory and
+writes a snapshot to METRICS_DIR (at most every METRICS_FLUSH_SECONDS).
+The /metrics endpoint merges the snapshots of all workers, so the numbers
+are the same whichever worker answers the scrape.
+
+METRICS_DIR defaults to a temp directory keyed by the app's database path
+(see configure), so two deployments on one host never add up each other's
+workers. Snapshots not rewritten for METRICS_RETENTION_SECONDS belong to
+workers that are gone and are deleted.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from hashlib import blake2b
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'qr_app_metrics')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# Gauges (in-flight requests) of workers that stopped writing are dropped after this long
+GAUGE_STALE_SECONDS = 60
+# Whole snapshots of workers that stopped writing are deleted after this long
+METRICS_RETENTION_SECONDS = float(os.environ.get('METRICS_RETENTION_SECONDS', '86400'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HELP = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint'),
+    'http_response_size_bytes': ('histogram', 'HTTP response body size by endpoint'),
+    'http_requests_in_flight': ('gauge', 'HTTP requests currently being handled'),
+    'qr_render_duration_seconds': ('histogram', 'QR code image render and PNG encode time by profile'),
+    'db_query_duration_seconds': ('histogram', 'Database statement time by operation'),
+    'reservations_released_total': ('counter', 'Reserved items returned to stock by the sweeper, by reason'),
+    'reservation_orders_expired_total': ('counter', 'Open orders cancelled because their reservation expired'),
+    'reservation_sweep_duration_seconds': ('histogram', 'Reservation sweeper run time'),
+    'archived_rows_total': ('counter', 'Rows moved to the archive tables, by hot table'),
+    'archive_run_duration_seconds': ('histogram', 'Order archive run time'),
+    'snapshot_duration_seconds': ('histogram', 'Database snapshot (backup and compression) time'),
+    'snapshot_size_bytes': ('histogram', 'Compressed database snapshot size'),
+    'report_snapshot_refresh_seconds': ('histogram', 'Time to refresh the reporting database copy'),
+    'snapshot_restore_duration_seconds': ('histogram', 'Snapshot restore time at startup, by whether one was restored'),
+}
+
+
+class Registry:
+    """In-process metrics store - counters, gauges and histograms keyed by name and labels"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+        self.flush_timer = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, amount=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauge(self, name, labels, amount):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'written_at': time.time(),
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, list(labels), dict(hist, counts=list(hist['counts']))]
+                               for (name, labels), hist in self.histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """Write this worker's snapshot for the other workers (rate limited unless forced)"""
+        now = time.time()
+        if not force and now - self.last_flush < METRICS_FLUSH_SECONDS:
+            # Make sure the last requests before an idle period get written too
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(METRICS_FLUSH_SECONDS, self._deferred_flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+            return
+        self.last_flush = now
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f'worker-{os.getpid()}.json')
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass  # Metrics must never break a request
+
+    def _deferred_flush(self):
+        self.flush_timer = None
+        self.flush(force=True)
+
+
+registry = Registry()
+
+
+def configure(instance):
+    """Key the default METRICS_DIR by instance (the database path) unless METRICS_DIR is set"""
+    global METRICS_DIR
+    if not os.environ.get('METRICS_DIR'):
+        digest = blake2b(os.path.abspath(instance).encode('utf-8'), digest_size=6).hexdigest()
+        METRICS_DIR = os.path.join(tempfile.gettempdir(), f'qr_app_metrics-{digest}')
+
+
+def _load_snapshots():
+    registry.flush(force=True)
+    snapshots = []
+    now = time.time()
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            with open(path, encoding='utf-8') as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue  # Being replaced right now - picked up on the next scrape
+        if now - snap['written_at'] > METRICS_RETENTION_SECONDS:
+            # A worker that is still alive rewrites its whole snapshot on the next flush
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        snapshots.append(snap)
+    return snapshots
+
+
+def _format_labels(labels, extra=None):
+    pairs = [(k, v) for k, v in labels] + (extra or [])
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus():
+    """Metrics of all workers merged, in the Prometheus text exposition format"""
+    counters, gauges, histograms = {}, {}, {}
+    now = time.time()
+    for snap in _load_snapshots():
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        if now - snap['written_at'] <= GAUGE_STALE_SECONDS:
+            for name, labels, value in snap['gauges']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, hist in snap['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = dict(hist, counts=list(hist['counts']))
+            else:
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], hist['counts'])]
+                merged['sum'] += hist['sum']
+                merged['count'] += hist['count']
+
+    lines = []
+    seen = set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), value in sorted(gauges.items()):
+        header(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), hist in sorted(histograms.items()):
+        header(name)
+        cumulative = 0
+        for bound, count in zip(hist['buckets'], hist['counts']):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {hist["count"]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {hist["sum"]:.6f}')
+        lines.append(f'{name}_count{_format_labels(labels)} {hist["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class timed:
+    """Context manager that records the block's duration in a histogram"""
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, self.labels, time.perf_counter() - self.start)
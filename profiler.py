@@ -0,0 +1,136 @@
+"""Opt-in sampling profiler for single requests
+
+A profiled request gets a sampler thread that records the request thread's
+stack every PROFILE_INTERVAL_MS. When the request ends the samples are
+written in the collapsed stack format ("frame;frame;frame count" per line),
+which flamegraph.pl, speedscope and inferno read directly.
+
+A request is profiled when an admin sends the X-Profile-Request: 1 header,
+or at random with probability PROFILE_SAMPLE_RATE. Only the newest
+PROFILE_KEEP captures are kept in PROFILE_DIR.
+
+Environment variables:
+    PROFILE_SAMPLE_RATE  - fraction of requests to profile (default 0 - header only)
+    PROFILE_INTERVAL_MS  - sampling interval (default 5)
+    PROFILE_DIR          - capture directory (default <tmp>/qr_app_profiles)
+    PROFILE_KEEP         - captures to keep (default 50)
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'qr_app_profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+PROFILE_HEADER = 'X-Profile-Request'
+
+# <time>_<pid>_<endpoint>_<ms>ms_<samples>s.folded
+_CAPTURE_NAME = re.compile(r'^(\d{8}-\d{6}-\d{6})_(\d+)_([\w.]+)_(\d+)ms_(\d+)s\.folded$')
+
+
+class StackSampler:
+    """Samples one thread's Python stack from a background thread"""
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_MS / 1000.0):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            # Collapsed stacks are root first
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def start(thread_id=None):
+    return StackSampler(thread_id or threading.get_ident()).start()
+
+
+def save(sampler, endpoint):
+    """Write a finished capture and drop the oldest ones beyond PROFILE_KEEP; returns the file name"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    endpoint = re.sub(r'[^\w.]', '-', endpoint or 'unknown')
+    name = (f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{os.getpid()}_{endpoint}_"
+            f"{int(sampler.duration * 1000)}ms_{sampler.samples}s.folded")
+    path = os.path.join(PROFILE_DIR, name)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        f.write(sampler.collapsed())
+    os.replace(f'{path}.tmp', path)
+    _rotate()
+    return name
+
+
+def _rotate():
+    captures = sorted(n for n in os.listdir(PROFILE_DIR) if _CAPTURE_NAME.match(n))
+    for name in captures[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else captures:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass  # Another worker removed it first
+
+
+def list_captures():
+    """Captures newest first, with the metadata encoded in their file names"""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return []
+    captures = []
+    for name in sorted(names, reverse=True):
+        match = _CAPTURE_NAME.match(name)
+        if not match:
+            continue
+        try:
+            size = os.path.getsize(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            continue
+        captured, pid, endpoint, ms, samples = match.groups()
+        captures.append({
+            'name': name,
+            'captured_at': datetime.strptime(captured, '%Y%m%d-%H%M%S-%f').strftime('%Y-%m-%d %H:%M:%S'),
+            'pid': int(pid),
+            'endpoint': endpoint,
+            'duration_ms': int(ms),
+            'samples': int(samples),
+            'bytes': size,
+        })
+    return captures
+
+
+def capture_path(name):
+    """Path of a capture, or None for anything that isn't one (no path traversal)"""
+    if not _CAPTURE_NAME.match(name or ''):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.exists(path) else None
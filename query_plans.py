@@ -0,0 +1,99 @@
+"""Registry of hot SQL queries and a query plan checker
+
+Queries that run on every page view are registered where they are defined:
+
+    SQL_ITEMS_BY_ORDER = query_plans.register('items_by_order', '''
+        SELECT ... FROM items i WHERE i.order_id = ?
+    ''', sample_args=(1,))
+
+register() returns the SQL unchanged, so the route runs exactly the statement
+that gets checked. check_query_plans() runs EXPLAIN QUERY PLAN for every
+registered query and reports full table scans on the guarded tables (items
+and orders), unless the query is a listing that is meant to read the whole
+table (allow_scan).
+"""
+import re
+from collections import namedtuple
+
+GUARDED_TABLES = ('items', 'orders')
+
+HotQuery = namedtuple('HotQuery', 'name sql sample_args allow_scan')
+
+HOT_QUERIES = {}
+
+# "FROM items i", "JOIN orders AS o", "FROM cart c" - alias -> table
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_NOT_ALIAS = {'where', 'join', 'on', 'left', 'inner', 'cross', 'outer', 'group', 'order', 'limit', 'set', 'using'}
+# "SCAN items", "SCAN TABLE items" (older SQLite), "SCAN i USING INDEX ..."
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+
+
+def register(name, sql, sample_args=(), allow_scan=()):
+    """Add a query to the registry and return its SQL"""
+    HOT_QUERIES[name] = HotQuery(name, sql, tuple(sample_args), tuple(allow_scan))
+    return sql
+
+
+def _table_aliases(sql):
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in _NOT_ALIAS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def explain(conn, sql, args=()):
+    """EXPLAIN QUERY PLAN detail lines for a statement"""
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, args).fetchall()]
+
+
+def check_query(conn, query, guarded_tables=GUARDED_TABLES):
+    """Plan of one registered query and the full scans found in it"""
+    result = {'name': query.name, 'sql': ' '.join(query.sql.split()), 'plan': [], 'scans': [], 'ok': True}
+    try:
+        result['plan'] = explain(conn, query.sql, query.sample_args)
+    except Exception as e:
+        # A query that no longer prepares against the schema is schema drift too
+        result['error'] = str(e)
+        result['ok'] = False
+        return result
+
+    aliases = _table_aliases(query.sql)
+    for detail in result['plan']:
+        match = _SCAN.match(detail)
+        if not match:
+            continue
+        table = aliases.get(match.group(1).lower(), match.group(1).lower())
+        if table in guarded_tables and table not in query.allow_scan:
+            result['scans'].append({'table': table, 'detail': detail})
+    result['ok'] = not result['scans']
+    return result
+
+
+def check_query_plans(conn, queries=None, guarded_tables=GUARDED_TABLES):
+    """Check every registered query (or the given names); returns a report dict"""
+    names = queries or sorted(HOT_QUERIES)
+    results = [check_query(conn, HOT_QUERIES[name], guarded_tables) for name in names]
+    return {
+        'ok': all(r['ok'] for r in results),
+        'checked': len(results),
+        'failures': [r['name'] for r in results if not r['ok']],
+        'queries': results,
+    }
+
+
+def format_report(report):
+    """Readable text version of a check_query_plans() report"""
+    lines = []
+    for r in report['queries']:
+        lines.append(f"[{'OK' if r['ok'] else 'FAIL'}] {r['name']}")
+        if not r['ok']:
+            lines.append(f"    sql:  {r['sql']}")
+            if 'error' in r:
+                lines.append(f"    error: {r['error']}")
+            for detail in r['plan']:
+                lines.append(f"    plan: {detail}")
+    lines.append(f"{report['checked']} queries checked, {len(report['failures'])} with full scans on "
+                 f"{'/'.join(GUARDED_TABLES)}")
+    return '\n'.join(lines)
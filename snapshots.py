@@ -0,0 +1,175 @@
+"""Compressed database snapshots with the SQLite online backup API
+
+On Vercel the database lives in /tmp, so every new instance would start
+empty. Snapshots copy the live database page by page with the backup API
+(a few pages per step, so writers are never blocked for long), gzip the copy
+and put it in a snapshot store. A cold instance restores the newest snapshot
+before init_db runs, giving up after SNAPSHOT_RESTORE_BUDGET_SECONDS.
+
+    store = DirectoryStore('/mnt/snapshots')
+    info = take_snapshot('/tmp/qr_app.db', store)
+    report = restore_latest('/tmp/qr_app.db', store)
+
+DirectoryStore stands in for an object store: snapshots are whole objects
+written under a temporary name and renamed, so readers never see a partial
+one. Anything with the same put/get/list/delete methods can replace it.
+
+Environment variables:
+    SNAPSHOT_DIR                    - snapshot store directory (default unset, snapshots off)
+    SNAPSHOT_INTERVAL_SECONDS       - time between snapshots (default 300)
+    SNAPSHOT_KEEP                   - snapshots to keep (default 5)
+    SNAPSHOT_RESTORE_BUDGET_SECONDS - give up restoring after this long (default 10)
+"""
+import gzip
+import logging
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get('SNAPSHOT_INTERVAL_SECONDS', '300'))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', '5'))
+SNAPSHOT_RESTORE_BUDGET_SECONDS = float(os.environ.get('SNAPSHOT_RESTORE_BUDGET_SECONDS', '10'))
+# Pages copied per backup step; the source is unlocked between steps
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.005
+CHUNK_SIZE = 1024 * 1024
+
+_SNAPSHOT_NAME = re.compile(r'^snapshot-(\d{8}T\d{6}\d{6}Z)-[\w.-]+\.db\.gz$')
+
+log = logging.getLogger('qr_app.snapshots')
+
+
+class DirectoryStore:
+    """Snapshot objects as files in a directory"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, name, src_path):
+        tmp = os.path.join(self.path, f'.{name}.uploading')
+        shutil.copyfile(src_path, tmp)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def get(self, name):
+        """Open a snapshot object for reading"""
+        return open(os.path.join(self.path, name), 'rb')
+
+    def list(self):
+        """Snapshot names, oldest first"""
+        return sorted(name for name in os.listdir(self.path) if _SNAPSHOT_NAME.match(name))
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+def default_store():
+    """The SNAPSHOT_DIR store, or None when snapshots are off"""
+    return DirectoryStore(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+
+
+def latest_snapshot_age(store):
+    """Seconds since the newest snapshot was taken, or None if there is none"""
+    names = store.list()
+    if not names:
+        return None
+    taken = datetime.strptime(_SNAPSHOT_NAME.match(names[-1]).group(1), '%Y%m%dT%H%M%S%fZ')
+    return time.time() - taken.replace(tzinfo=timezone.utc).timestamp()
+
+
+def take_snapshot(db_path, store, keep=SNAPSHOT_KEEP):
+    """Back up db_path into store; returns {'name', 'pages', 'bytes', 'compressed_bytes', 'ms'}"""
+    started = time.perf_counter()
+    taken = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    name = f'snapshot-{taken}-{socket.gethostname()}-{os.getpid()}.db.gz'
+    fd, copy_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        src = sqlite3.connect(db_path, timeout=10.0)
+        dst = sqlite3.connect(copy_path)
+        try:
+            # Restarts on its own if another connection writes between steps
+            src.backup(dst, pages=BACKUP_STEP_PAGES, sleep=BACKUP_STEP_SLEEP)
+            pages = dst.execute('PRAGMA page_count').fetchone()[0]
+            # A single self-contained file - the restored copy switches back to WAL in init_db
+            dst.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            dst.close()
+            src.close()
+        size = os.path.getsize(copy_path)
+        compressed_path = copy_path + '.gz'
+        with open(copy_path, 'rb') as f_in, gzip.open(compressed_path, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+        compressed = os.path.getsize(compressed_path)
+        try:
+            store.put(name, compressed_path)
+        finally:
+            os.remove(compressed_path)
+    finally:
+        os.remove(copy_path)
+
+    if keep > 0:
+        for old in store.list()[:-keep]:
+            store.delete(old)
+    info = {'name': name, 'pages': pages, 'bytes': size, 'compressed_bytes': compressed,
+            'ms': round((time.perf_counter() - started) * 1000, 1)}
+    log.info("Snapshot taken", extra={'snapshot': name, **{k: v for k, v in info.items() if k != 'name'}})
+    return info
+
+
+def restore_latest(db_path, store, budget=SNAPSHOT_RESTORE_BUDGET_SECONDS):
+    """Restore the newest usable snapshot to db_path (which should not exist yet)
+
+    Returns {'restored': name or None, 'ms', 'bytes', 'reason'}. A snapshot that
+    fails the integrity check or takes longer than budget is skipped and the
+    instance starts with an empty database instead.
+    """
+    started = time.perf_counter()
+    deadline = started + budget
+    report = {'restored': None, 'bytes': 0, 'reason': 'no snapshot'}
+    tmp = db_path + '.restoring'
+    for name in reversed(store.list()):
+        try:
+            with store.get(name) as raw, gzip.open(raw, 'rb') as f_in, open(tmp, 'wb') as f_out:
+                while True:
+                    chunk = f_in.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+                    if time.perf_counter() > deadline:
+                        raise TimeoutError(f'restore took longer than {budget:g}s')
+            conn = sqlite3.connect(tmp)
+            try:
+                check = conn.execute('PRAGMA quick_check').fetchone()[0]
+            finally:
+                conn.close()
+            if check != 'ok':
+                raise sqlite3.DatabaseError(f'quick_check: {check}')
+            # A WAL left behind by an earlier database would be replayed into the restored one
+            for leftover in (db_path + '-wal', db_path + '-shm'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            os.replace(tmp, db_path)
+            report = {'restored': name, 'bytes': os.path.getsize(db_path), 'reason': None}
+            break
+        except TimeoutError as e:
+            report['reason'] = str(e)
+            break
+        except (OSError, EOFError, sqlite3.DatabaseError) as e:
+            # Corrupt or truncated - try the one before it
+            report['reason'] = f'{name}: {e}'
+            log.warning("Snapshot not usable", extra={'snapshot': name, 'error': str(e)})
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    report['ms'] = round((time.perf_counter() - started) * 1000, 1)
+    log.info("Snapshot restore", extra=report)
+    return report
@@ -0,0 +1,81 @@
+"""
+Order archive tests - closed orders move to the archive tables and stay readable
+
+Adds old and recent orders directly in the database and runs
+archive_closed_orders(). Archived orders must be gone from the hot tables
+and still show up on the customer and admin order pages.
+
+Run:
+    python -m unittest test_archive -v
+"""
+import unittest
+
+import app as qr_app
+from test_support import ADMIN_ID, CUSTOMER_ID, AppTestCase
+
+
+class ArchiveTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product_id = self.create_product('Red')
+
+    def make_order(self, status, item_status, days_old, quantity=2):
+        """An order of the default customer with one line and quantity items"""
+        created_at = self.conn.execute("SELECT datetime('now', ?)", (f'-{days_old} days',)).fetchone()[0]
+        order_id = self.conn.execute('INSERT INTO orders (user_id, status, created_at) VALUES (?, ?, ?)',
+                                     (CUSTOMER_ID, status, created_at)).lastrowid
+        line_id = self.conn.execute('INSERT INTO order_lines (order_id, product_id, quantity, created_at) VALUES (?, ?, ?, ?)',
+                                    (order_id, self.product_id, quantity, created_at)).lastrowid
+        self.conn.executemany('''
+            INSERT INTO items (product_id, qr_code, status, validated, order_id, order_line_id) VALUES (?, ?, ?, 1, ?, ?)
+        ''', [(self.product_id, f'ARCHIVE-{order_id}-{n}', item_status, order_id, line_id) for n in range(quantity)])
+        self.conn.commit()
+        return order_id
+
+    def count(self, table, order_id):
+        key = 'id' if table.endswith('orders') else 'order_id'
+        return self.conn.execute(f'SELECT COUNT(*) FROM {table} WHERE {key} = ?', (order_id,)).fetchone()[0]
+
+    def test_old_confirmed_order_is_moved(self):
+        order_id = self.make_order('confirmed', 'sold', 120)
+
+        archived = qr_app.archive_closed_orders(days=90)
+
+        self.assertEqual(archived, {'orders': 1, 'order_lines': 1, 'items': 2})
+        for table, rows in (('orders', 1), ('order_lines', 1), ('items', 2)):
+            self.assertEqual(self.count(table, order_id), 0, table)
+            self.assertEqual(self.count(f'archived_{table}', order_id), rows, table)
+        line_id = self.conn.execute('SELECT id FROM archived_order_lines WHERE order_id = ?', (order_id,)).fetchone()[0]
+        linked = self.conn.execute('SELECT COUNT(*) FROM archived_items WHERE order_line_id = ?', (line_id,)).fetchone()[0]
+        self.assertEqual(linked, 2)
+
+    def test_open_recent_and_reserved_orders_stay(self):
+        pending = self.make_order('pending', 'reserved', 120)
+        recent = self.make_order('confirmed', 'sold', 10)
+        # Cancelled, but the sweeper has not released its items yet
+        unreleased = self.make_order('cancelled', 'reserved', 120)
+
+        qr_app.archive_closed_orders(days=90)
+
+        for order_id in (pending, recent, unreleased):
+            self.assertEqual(self.count('orders', order_id), 1)
+            self.assertEqual(self.count('archived_orders', order_id), 0)
+
+    def test_archived_orders_are_still_listed(self):
+        order_id = self.make_order('confirmed', 'sold', 120)
+        qr_app.archive_closed_orders(days=90)
+
+        self.login(CUSTOMER_ID, 'customer')
+        response = self.client.get('/orders')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'<td>#{order_id}</td>'.encode(), response.data)
+        self.assertIn(f'ARCHIVE-{order_id}-0'.encode(), response.data)
+
+        self.login(ADMIN_ID, 'admin')
+        response = self.client.get('/admin/orders')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'<td>#{order_id}</td>'.encode(), response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
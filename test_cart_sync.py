@@ -0,0 +1,87 @@
+"""
+Cart sync tests - /api/cart/sync applies a batch of cart changes, all or nothing
+
+Seeds two products with validated stock, then posts change batches as the
+default customer and checks the cart rows.
+
+Run:
+    python -m unittest test_cart_sync -v
+"""
+import unittest
+
+from test_support import CUSTOMER_ID, AppTestCase
+
+
+class CartSyncTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = {'red': self.create_product('Red', 5), 'blue': self.create_product('Blue', 2)}
+        self.login(CUSTOMER_ID, 'customer')
+        self.conn.execute('DELETE FROM cart WHERE user_id = ?', (CUSTOMER_ID,))
+        self.conn.commit()
+
+    def sync(self, *changes):
+        return self.client.post('/api/cart/sync', json={'changes': list(changes)})
+
+    def cart(self):
+        return {row['product_id']: row['quantity'] for row in
+                self.conn.execute('SELECT product_id, quantity FROM cart WHERE user_id = ?', (CUSTOMER_ID,))}
+
+    def cart_ids(self):
+        return {row['product_id']: row['id'] for row in
+                self.conn.execute('SELECT product_id, id FROM cart WHERE user_id = ?', (CUSTOMER_ID,))}
+
+    def test_add_merges_into_existing_line(self):
+        red = self.products['red']
+        self.assertEqual(self.sync({'op': 'add', 'product_id': red, 'quantity': 1}).status_code, 200)
+
+        response = self.sync({'op': 'add', 'product_id': red, 'quantity': 2},
+                             {'op': 'add', 'product_id': red, 'quantity': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart(), {red: 4})
+        self.assertEqual([(line['product_id'], line['quantity']) for line in response.json['cart']], [(red, 4)])
+
+    def test_update_and_remove_in_one_request(self):
+        red, blue = self.products['red'], self.products['blue']
+        self.sync({'op': 'add', 'product_id': red, 'quantity': 1}, {'op': 'add', 'product_id': blue, 'quantity': 1})
+        ids = self.cart_ids()
+
+        response = self.sync({'op': 'update', 'cart_id': ids[red], 'quantity': 3},
+                             {'op': 'remove', 'cart_id': ids[blue]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart(), {red: 3})
+        # Updated in place, not re-inserted
+        self.assertEqual(self.cart_ids()[red], ids[red])
+
+    def test_shortage_changes_nothing(self):
+        red, blue = self.products['red'], self.products['blue']
+        self.sync({'op': 'add', 'product_id': red, 'quantity': 1})
+        ids = self.cart_ids()
+
+        response = self.sync({'op': 'update', 'cart_id': ids[red], 'quantity': 2},
+                             {'op': 'add', 'product_id': blue, 'quantity': 3})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['shortages'], [{'product_id': blue, 'requested': 3, 'available': 2}])
+        self.assertEqual(self.cart(), {red: 1})
+
+    def test_invalid_changes_are_rejected(self):
+        red = self.products['red']
+        self.sync({'op': 'add', 'product_id': red, 'quantity': 1})
+
+        self.assertEqual(self.sync({'op': 'bogus'}).status_code, 400)
+        self.assertEqual(self.sync({'op': 'update', 'cart_id': 999999, 'quantity': 1}).status_code, 400)
+        self.assertEqual(self.sync({'op': 'add', 'product_id': red, 'quantity': 0}).status_code, 400)
+        self.assertEqual(self.client.post('/api/cart/sync', json={}).status_code, 400)
+        self.assertEqual(self.cart(), {red: 1})
+
+    def test_requires_customer_login(self):
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        self.assertEqual(self.sync({'op': 'add', 'product_id': self.products['red']}).status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
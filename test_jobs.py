@@ -0,0 +1,67 @@
+"""
+Background job tests - a requeued run cannot commit, QR grids are cached
+
+Claims jobs directly from the jobs table to act out a stale requeue, and
+renders a QR grid large enough to go through the render job.
+
+Run:
+    python -m unittest test_jobs -v
+"""
+import json
+import time
+import unittest
+
+import app as qr_app
+from test_support import ADMIN_ID, AppTestCase
+
+
+class JobTest(AppTestCase):
+    def claim(self, kind, payload):
+        """Queue a job that worker threads leave alone (run_after is far off) and claim it"""
+        job_id = self.conn.execute('INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)',
+                                   (kind, json.dumps(payload), time.time() + 3600)).lastrowid
+        self.conn.commit()
+        return qr_app.job_queue._claim(job_id)
+
+    def test_requeued_run_cannot_commit(self):
+        payload = {'category': self._testMethodName, 'size': 'M', 'color': 'Red', 'stock': 3}
+        stale = self.claim('restock', payload)
+        # What _claim does to a running job whose heartbeat is older than JOB_STALE_SECONDS
+        self.conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (stale['id'],))
+        self.conn.commit()
+        current = qr_app.job_queue._claim(stale['id'])
+
+        qr_app.job_queue._run(stale)
+
+        job = qr_app.job_queue.get(stale['id'])
+        self.assertEqual((job['status'], job['attempts']), ('running', 2))
+        count_items = '''
+            SELECT COUNT(*) FROM items i JOIN products p ON i.product_id = p.id WHERE p.category = ?
+        '''
+        self.assertEqual(self.conn.execute(count_items, (self._testMethodName,)).fetchone()[0], 0)
+
+        qr_app.job_queue._run(current)
+
+        self.assertEqual(qr_app.job_queue.get(stale['id'])['status'], 'done')
+        self.assertEqual(self.conn.execute(count_items, (self._testMethodName,)).fetchone()[0], 3)
+
+    def test_qr_grid_images_are_cached_not_stored(self):
+        product_id = self.create_product('Red', qr_app.JOB_INLINE_ITEMS + 1)
+        self.login(ADMIN_ID, 'admin')
+        self.assertEqual(self.client.get(f'/admin/product_items_qr/{product_id}').status_code, 200)
+        job_id = qr_app.job_queue.find('render_item_qrs', {'product_id': product_id}, qr_app.QR_GRID_REUSE_SECONDS)
+
+        self.wait_for_job_id(job_id)
+
+        job = qr_app.job_queue.get(job_id, include_result=True)
+        items = self.conn.execute('SELECT id, qr_code FROM items WHERE product_id = ? ORDER BY id', (product_id,)).fetchall()
+        self.assertEqual(job['result'], {'product_id': product_id, 'item_ids': [item['id'] for item in items]})
+        image = qr_app.item_qr_cache.get('item_grid', items[0]['qr_code'])
+        self.assertIsNotNone(image)
+        response = self.client.get(f'/admin/product_items_qr/{product_id}?job={job_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(image.encode(), response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+"""
+Order lines tests - one order per checkout, one line per product
+
+Checks the migration of databases from before order_lines (one product per
+orders row), checkout of a multi-product cart and product deletion.
+
+Run:
+    python -m unittest test_order_lines -v
+"""
+import sqlite3
+import unittest
+
+import app as qr_app
+from test_support import ADMIN_ID, CUSTOMER_ID, AppTestCase
+
+# The tables as they were before order_lines
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        user_type TEXT NOT NULL CHECK(user_type IN ('customer', 'admin', 'approval_admin')),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category TEXT NOT NULL,
+        size TEXT NOT NULL,
+        color TEXT NOT NULL,
+        stock INTEGER NOT NULL DEFAULT 0,
+        qr_code TEXT UNIQUE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        image_url TEXT,
+        UNIQUE(category, size, color)
+    );
+    CREATE TABLE orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        qr_code TEXT UNIQUE,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'approved', 'confirmed', 'cancelled')),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    );
+    CREATE TABLE cart (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        qr_code TEXT UNIQUE NOT NULL,
+        status TEXT DEFAULT 'available' CHECK(status IN ('available', 'reserved', 'sold', 'damaged')),
+        validated BOOLEAN DEFAULT 0,
+        validated_at DATETIME NULL,
+        validated_by INTEGER NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        order_id INTEGER NULL,
+        FOREIGN KEY (product_id) REFERENCES products(id),
+        FOREIGN KEY (order_id) REFERENCES orders(id),
+        FOREIGN KEY (validated_by) REFERENCES users(id)
+    );
+    INSERT INTO users (id, username, password, user_type) VALUES (1, 'customer1', 'customer123', 'customer');
+    INSERT INTO products (id, category, size, color, stock) VALUES (1, 'Legacy', 'M', 'Red', 1), (2, 'Legacy', 'M', 'Blue', 0);
+    INSERT INTO orders (id, user_id, product_id, quantity, qr_code, status, created_at) VALUES
+        (1, 1, 1, 2, 'ORDER-1', 'pending', '2024-01-01 10:00:00'),
+        (2, 1, 2, 1, 'ORDER-2', 'confirmed', '2024-01-02 10:00:00');
+    INSERT INTO items (id, product_id, qr_code, status, validated, validated_at, order_id) VALUES
+        (1, 1, 'ITEM-1', 'reserved', 1, NULL, 1),
+        (2, 1, 'ITEM-2', 'reserved', 1, NULL, 1),
+        (3, 1, 'ITEM-3', 'available', 1, NULL, NULL),
+        (4, 2, 'ITEM-4', 'sold', 1, '2024-01-02 11:00:00', 2);
+'''
+
+
+class OrderLinesMigrationTest(AppTestCase):
+    @classmethod
+    def create_schema(cls):
+        conn = sqlite3.connect(qr_app.DATABASE)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.close()
+        cls.init_db()
+
+    def test_orders_lose_product_columns(self):
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(orders)')}
+        self.assertEqual(columns, {'id', 'user_id', 'qr_code', 'status', 'created_at'})
+        orders = self.conn.execute('SELECT id, user_id, qr_code, status, created_at FROM orders ORDER BY id').fetchall()
+        self.assertEqual([tuple(order) for order in orders],
+                         [(1, 1, 'ORDER-1', 'pending', '2024-01-01 10:00:00'),
+                          (2, 1, 'ORDER-2', 'confirmed', '2024-01-02 10:00:00')])
+
+    def test_one_line_per_old_order(self):
+        lines = self.conn.execute('SELECT order_id, product_id, quantity, created_at FROM order_lines ORDER BY order_id').fetchall()
+        self.assertEqual([tuple(line) for line in lines],
+                         [(1, 1, 2, '2024-01-01 10:00:00'), (2, 2, 1, '2024-01-02 10:00:00')])
+
+    def test_items_point_at_their_line(self):
+        items = self.conn.execute('''
+            SELECT i.id, l.order_id, l.product_id FROM items i
+            LEFT JOIN order_lines l ON l.id = i.order_line_id
+            ORDER BY i.id
+        ''').fetchall()
+        self.assertEqual([tuple(item) for item in items], [(1, 1, 1), (2, 1, 1), (3, None, None), (4, 2, 2)])
+
+    def test_second_init_does_not_migrate_again(self):
+        self.init_db()
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM order_lines').fetchone()[0], 2)
+
+    def test_orders_page_after_migration(self):
+        self.login(CUSTOMER_ID, 'customer')
+        response = self.client.get('/orders')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<td>#1</td>', response.data)
+        self.assertIn(b'<td>#2</td>', response.data)
+
+
+class MultiLineOrderTest(AppTestCase):
+    def delete_product(self, product_id):
+        self.login(ADMIN_ID, 'admin')
+        response = self.client.get(f'/admin/products/delete/{product_id}')
+        self.assertEqual(response.status_code, 302)
+        self.wait_for_job(response)
+
+    def test_checkout_creates_one_order_with_a_line_per_product(self):
+        red, blue = self.create_product('Red', 3), self.create_product('Blue', 3)
+        order_id = self.checkout((red, 2), (blue, 1))
+
+        lines = self.conn.execute('SELECT id, product_id, quantity FROM order_lines WHERE order_id = ? ORDER BY product_id',
+                                  (order_id,)).fetchall()
+        self.assertEqual([(line['product_id'], line['quantity']) for line in lines], [(red, 2), (blue, 1)])
+        for line in lines:
+            reserved = self.conn.execute("SELECT COUNT(*) FROM items WHERE order_line_id = ? AND order_id = ? AND status = 'reserved'",
+                                         (line['id'], order_id)).fetchone()[0]
+            self.assertEqual(reserved, line['quantity'])
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM cart WHERE user_id = ?', (CUSTOMER_ID,)).fetchone()[0], 0)
+
+    def test_deleting_a_product_cancels_its_orders(self):
+        product_id = self.create_product('Black', 2)
+        order_id = self.checkout((product_id, 2))
+
+        self.delete_product(product_id)
+
+        status = self.conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+        self.assertEqual(status, 'cancelled')
+        self.assertIsNone(self.conn.execute('SELECT id FROM products WHERE id = ?', (product_id,)).fetchone())
+
+
+    def test_deleting_a_product_keeps_other_lines(self):
+        keep, gone = self.create_product('Green', 2), self.create_product('Black', 3)
+        mixed = self.checkout((keep, 1), (gone, 2))
+        single = self.checkout((gone, 1))
+
+        self.delete_product(gone)
+
+        statuses = dict(self.conn.execute('SELECT id, status FROM orders WHERE id IN (?, ?)', (mixed, single)).fetchall())
+        self.assertEqual(statuses, {mixed: 'pending', single: 'cancelled'})
+        lines = self.conn.execute('SELECT product_id FROM order_lines WHERE order_id = ?', (mixed,)).fetchall()
+        self.assertEqual([line['product_id'] for line in lines], [keep])
+        # The mixed order's items of the deleted product are released and unlinked
+        released = self.conn.execute('SELECT status, order_id, order_line_id FROM items WHERE product_id = ?', (gone,)).fetchall()
+        self.assertEqual(sorted(tuple(item) for item in released if item['order_id'] is None),
+                         [('available', None, None)] * 2)
+        self.assertIsNone(self.conn.execute('SELECT id FROM products WHERE id = ?', (gone,)).fetchone())
+
+
+if __name__ == '__main__':
+    unittest.main()
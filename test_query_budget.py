@@ -0,0 +1,101 @@
+"""
+Query budget tests - catch N+1 query patterns before they ship
+
+Every test seeds a large synthetic dataset (generate_data.py), requests a
+route and counts the SQL statements the request ran through the DB layer
+(g.db_statements). A route that goes over its budget fails with the full
+query trace, so the repeated statement is easy to spot.
+
+Run:
+    python -m unittest test_query_budget -v
+"""
+import argparse
+import contextlib
+import io
+import sqlite3
+import unittest
+from collections import Counter
+
+from flask import g
+
+import app as qr_app
+import generate_data
+from test_support import AppTestCase
+
+# Large enough that one query per product/order/cart line blows every budget
+DATASET = dict(users=200, products=300, items=20000, orders=3000, cart_rows=600)
+
+
+class QueryBudgetTest(AppTestCase):
+    @classmethod
+    def create_schema(cls):
+        cls.init_db()
+        conn = sqlite3.connect(qr_app.DATABASE)
+        args = argparse.Namespace(days=90, skew=1.1, user_skew=0.8, batch_size=5000, seed=36, reset=False, **DATASET)
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_data.Generator(conn, args).run()
+        conn.row_factory = sqlite3.Row
+        cls.busiest_customer = conn.execute(
+            'SELECT user_id FROM orders GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+        cls.biggest_cart = conn.execute(
+            'SELECT user_id FROM cart GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+        cls.largest_category = conn.execute(
+            'SELECT category FROM products GROUP BY category ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+        cls.reserved_item = conn.execute(
+            "SELECT qr_code FROM items WHERE status = 'reserved' ORDER BY id LIMIT 1").fetchone()[0]
+        conn.close()
+
+    def setUp(self):
+        super().setUp()
+        # Measure the uncached path - a cache hit would hide a regression
+        qr_app.invalidate_catalog_cache('query budget test')
+
+    def assertQueryBudget(self, path, budget):
+        with self.client:
+            response = self.client.get(path)
+            statements = g.db_statements
+            trace = list(g.db_trace)
+        self.assertEqual(response.status_code, 200, f'{path} returned {response.status_code}')
+        if statements > budget:
+            repeated = Counter(sql for sql, _ in trace)
+            lines = [f'{count:>5}x  {sql}' for sql, count in repeated.most_common() if count > 1]
+            if lines:
+                lines.insert(0, 'Repeated statements (likely N+1):')
+                lines.append('Trace:')
+            lines += [f'{n:>4}. {duration * 1000:7.2f} ms  {sql}' for n, (sql, duration) in enumerate(trace, 1)]
+            if statements > len(trace):
+                lines.append(f'      ... {statements - len(trace)} more')
+            self.fail(f'{path} ran {statements} queries, budget is {budget}:\n' + '\n'.join(lines))
+        return response
+
+    def test_products(self):
+        self.login(self.busiest_customer, 'customer')
+        self.assertQueryBudget(f'/products?category={self.largest_category}', 3)
+
+    def test_customer_orders(self):
+        self.login(self.busiest_customer, 'customer')
+        self.assertQueryBudget('/orders', 2)
+
+    def test_cart(self):
+        self.login(self.biggest_cart, 'customer')
+        self.assertQueryBudget('/cart', 2)
+
+    def test_checkout_page(self):
+        self.login(self.biggest_cart, 'customer')
+        self.assertQueryBudget('/checkout', 2)
+
+    def test_admin_orders(self):
+        self.login(1, 'admin')
+        self.assertQueryBudget('/admin/orders', 2)
+
+    def test_approval_orders(self):
+        self.login(3, 'approval_admin')
+        self.assertQueryBudget('/approval/orders', 2)
+
+    def test_scan_item_mobile(self):
+        # Lookup, validation update and the order completion check
+        self.assertQueryBudget(f'/scan/item/{self.reserved_item}', 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
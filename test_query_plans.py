@@ -0,0 +1,48 @@
+"""
+Query plan guard - hot queries must not fall back to full scans of items/orders
+
+Builds the schema with init_db() and runs EXPLAIN QUERY PLAN for every query
+registered in query_plans.HOT_QUERIES. Dropping or changing an index that a
+hot query relies on fails this test with the offending plans.
+
+Run:
+    python -m unittest test_query_plans -v
+"""
+import sqlite3
+import unittest
+
+import app as qr_app
+import query_plans
+from test_support import AppTestCase
+
+
+class QueryPlanTest(AppTestCase):
+    def test_hot_queries_are_registered(self):
+        for name in ('stock_by_product', 'category_products', 'cart_items', 'order_items',
+                     'orders_by_status', 'customer_orders', 'order_scan_progress'):
+            self.assertIn(name, query_plans.HOT_QUERIES)
+
+    def test_no_full_scans(self):
+        conn = sqlite3.connect(qr_app.DATABASE)
+        try:
+            report = query_plans.check_query_plans(conn)
+        finally:
+            conn.close()
+        self.assertTrue(report['ok'], '\n' + query_plans.format_report(report))
+
+    def test_detects_dropped_index(self):
+        conn = sqlite3.connect(qr_app.DATABASE)
+        try:
+            # DDL is transactional in SQLite - rolled back so the other tests keep the index
+            conn.execute('BEGIN')
+            conn.execute('DROP INDEX idx_items_order')
+            report = query_plans.check_query_plans(conn, ['order_items'])
+            conn.rollback()
+        finally:
+            conn.close()
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['queries'][0]['scans'][0]['table'], 'items')
+
+
+if __name__ == '__main__':
+    unittest.main()
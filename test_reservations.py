@@ -0,0 +1,94 @@
+"""
+Reservation sweeper tests - stale reservations go back to stock
+
+Checks out orders through the app, ages them in the database and runs
+sweep_expired_reservations(). Released items must be sellable again and no
+longer point at their order.
+
+Run:
+    python -m unittest test_reservations -v
+"""
+import unittest
+
+import app as qr_app
+from test_support import AppTestCase
+
+
+class ReservationSweepTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # Leftovers of other tests must not show up in the counts
+        qr_app.sweep_expired_reservations()
+
+    def age(self, order_id, hours):
+        self.conn.execute("UPDATE orders SET created_at = datetime('now', ?) WHERE id = ?", (f'-{hours} hours', order_id))
+        self.conn.commit()
+
+    def items(self, product_id):
+        return self.conn.execute('SELECT status, order_id, order_line_id FROM items WHERE product_id = ?', (product_id,)).fetchall()
+
+    def assertReleased(self, product_id, count):
+        self.assertEqual([tuple(item) for item in self.items(product_id)], [('available', None, None)] * count)
+        stock = self.conn.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()[0]
+        self.assertEqual(stock, count)
+
+    def test_expired_order_is_cancelled_and_released(self):
+        product_id = self.create_product('Red', 3)
+        order_id = self.checkout((product_id, 2))
+        self.assertEqual(sum(item['status'] == 'reserved' for item in self.items(product_id)), 2)
+        self.age(order_id, qr_app.RESERVATION_TTL_HOURS + 1)
+
+        released = qr_app.sweep_expired_reservations()
+
+        self.assertEqual(released, {'expired': 2, 'cancelled': 0, 'orders_expired': 1, 'more': False})
+        status = self.conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+        self.assertEqual(status, 'cancelled')
+        self.assertReleased(product_id, 3)
+
+    def test_cancelled_order_is_released(self):
+        product_id = self.create_product('Blue', 2)
+        order_id = self.checkout((product_id, 2))
+        self.conn.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
+        self.conn.commit()
+
+        released = qr_app.sweep_expired_reservations()
+
+        self.assertEqual(released, {'expired': 0, 'cancelled': 2, 'orders_expired': 0, 'more': False})
+        self.assertReleased(product_id, 2)
+
+    def test_open_order_within_ttl_is_kept(self):
+        product_id = self.create_product('Green', 2)
+        order_id = self.checkout((product_id, 1))
+        self.age(order_id, qr_app.RESERVATION_TTL_HOURS - 1)
+
+        qr_app.sweep_expired_reservations()
+
+        reserved = [item for item in self.items(product_id) if item['status'] == 'reserved']
+        self.assertEqual([(item['status'], item['order_id']) for item in reserved], [('reserved', order_id)])
+        self.assertIsNotNone(reserved[0]['order_line_id'])
+
+    def test_batches_release_everything(self):
+        product_id = self.create_product('Black', 3)
+        for _ in range(3):
+            self.age(self.checkout((product_id, 1)), qr_app.RESERVATION_TTL_HOURS + 1)
+
+        released = qr_app.sweep_expired_reservations(batch_size=2)
+
+        self.assertEqual(released, {'expired': 3, 'cancelled': 0, 'orders_expired': 3, 'more': False})
+        self.assertReleased(product_id, 3)
+
+    def test_max_batches_stops_early(self):
+        product_id = self.create_product('White', 3)
+        for _ in range(3):
+            self.age(self.checkout((product_id, 1)), qr_app.RESERVATION_TTL_HOURS + 1)
+
+        first = qr_app.sweep_expired_reservations(batch_size=2, max_batches=1)
+        rest = qr_app.sweep_expired_reservations(batch_size=2, max_batches=1)
+
+        self.assertEqual((first['expired'], first['more']), (2, True))
+        self.assertEqual((rest['expired'], rest['more']), (1, False))
+        self.assertReleased(product_id, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Analytics rollup tests - triggers and the one-off backfill keep correct counts
+
+Item and order state changes made directly in the database must be counted
+by the rollup triggers, and rebuilding the rollup tables from history must
+give the same numbers as counting the orders, order lines and items (hot and
+archived) by hand.
+
+Run:
+    python -m unittest test_rollups -v
+"""
+import unittest
+
+import app as qr_app
+from test_support import CUSTOMER_ID, AppTestCase
+
+# Per day and product, the way the dashboard reads them
+RECOUNT = '''
+    SELECT bucket, product_id, SUM(reserved), SUM(sold), SUM(scanned), SUM(cancelled) FROM (
+        SELECT date(created_at) AS bucket, product_id, quantity AS reserved, 0 AS sold, 0 AS scanned, 0 AS cancelled
+        FROM (SELECT created_at, product_id, quantity FROM order_lines
+              UNION ALL SELECT created_at, product_id, quantity FROM archived_order_lines)
+        UNION ALL
+        SELECT date(o.created_at), l.product_id, 0, CASE WHEN o.status = 'confirmed' THEN l.quantity ELSE 0 END,
+               0, CASE WHEN o.status = 'cancelled' THEN l.quantity ELSE 0 END
+        FROM (SELECT id, status, created_at FROM orders UNION ALL SELECT id, status, created_at FROM archived_orders) o
+        JOIN (SELECT order_id, product_id, quantity FROM order_lines
+              UNION ALL SELECT order_id, product_id, quantity FROM archived_order_lines) l ON l.order_id = o.id
+        UNION ALL
+        SELECT date(validated_at), product_id, 0, 0, 1, 0
+        FROM (SELECT validated_at, product_id, order_id, validated FROM items
+              UNION ALL SELECT validated_at, product_id, order_id, validated FROM archived_items)
+        WHERE order_id IS NOT NULL AND validated = 1
+    )
+    WHERE product_id IN ({products})
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+'''
+
+
+class RollupTest(AppTestCase):
+    def make_order(self, product_id, quantity, status, created_at, item_status, validated=0, validated_at=None):
+        order_id = self.conn.execute('INSERT INTO orders (user_id, status, created_at) VALUES (?, ?, ?)',
+                                     (CUSTOMER_ID, status, created_at)).lastrowid
+        line_id = self.conn.execute('INSERT INTO order_lines (order_id, product_id, quantity, created_at) VALUES (?, ?, ?, ?)',
+                                    (order_id, product_id, quantity, created_at)).lastrowid
+        self.conn.executemany('''
+            INSERT INTO items (product_id, qr_code, status, validated, validated_at, order_id, order_line_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(product_id, f'ROLLUP-{order_id}-{n}', item_status, validated, validated_at, order_id, line_id)
+              for n in range(quantity)])
+        self.conn.commit()
+        return order_id
+
+    def rows(self, sql, args=()):
+        return [tuple(row) for row in self.conn.execute(sql, args)]
+
+    def today(self, product_id):
+        rows = self.rows('''
+            SELECT reserved, sold, scanned, cancelled FROM rollup_daily
+            WHERE bucket = date('now') AND product_id = ?
+        ''', (product_id,))
+        return rows[0] if rows else (0, 0, 0, 0)
+
+    def test_triggers_count_state_changes(self):
+        product_id = self.create_product('Red')
+        self.conn.executemany("INSERT INTO items (product_id, qr_code, status, validated) VALUES (?, ?, 'available', 1)",
+                              [(product_id, f'ROLLUP-T-{n}') for n in range(3)])
+        order_id = self.conn.execute("INSERT INTO orders (user_id, status) VALUES (?, 'pending')", (CUSTOMER_ID,)).lastrowid
+        self.conn.execute('INSERT INTO order_lines (order_id, product_id, quantity) VALUES (?, ?, 3)', (order_id, product_id))
+        self.conn.commit()
+
+        self.conn.execute("UPDATE items SET status = 'reserved', validated = 0, order_id = ? WHERE product_id = ?",
+                          (order_id, product_id))
+        self.conn.commit()
+        self.assertEqual(self.today(product_id), (3, 0, 0, 0))
+
+        # One item is scanned and sold, then the order is cancelled
+        item_id = self.conn.execute('SELECT MIN(id) FROM items WHERE product_id = ?', (product_id,)).fetchone()[0]
+        self.conn.execute("UPDATE items SET validated = 1, validated_at = CURRENT_TIMESTAMP WHERE id = ?", (item_id,))
+        self.conn.execute("UPDATE items SET status = 'sold' WHERE id = ?", (item_id,))
+        self.conn.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
+        self.conn.commit()
+        self.assertEqual(self.today(product_id), (3, 1, 1, 3))
+
+        # Cancelling again or validating stock that is not ordered does not count
+        self.conn.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
+        self.conn.execute("INSERT INTO items (product_id, qr_code, validated) VALUES (?, 'ROLLUP-T-stock', 0)", (product_id,))
+        self.conn.execute("UPDATE items SET validated = 1 WHERE qr_code = 'ROLLUP-T-stock'")
+        self.conn.commit()
+        self.assertEqual(self.today(product_id), (3, 1, 1, 3))
+
+        hourly = self.rows('''
+            SELECT SUM(reserved), SUM(sold), SUM(scanned), SUM(cancelled) FROM rollup_hourly
+            WHERE product_id = ? AND bucket >= strftime('%Y-%m-%d 00:00', 'now')
+        ''', (product_id,))
+        self.assertEqual(hourly, [(3, 1, 1, 3)])
+
+    def test_backfill_matches_recount(self):
+        red, blue = self.create_product('Red'), self.create_product('Blue')
+        self.make_order(red, 2, 'confirmed', '2024-03-01 09:30:00', 'sold', 1, '2024-03-02 10:00:00')
+        self.make_order(red, 1, 'cancelled', '2024-03-01 15:00:00', 'available')
+        self.make_order(blue, 3, 'pending', '2024-03-02 11:00:00', 'reserved', 1, '2024-03-02 12:00:00')
+        archived = self.make_order(blue, 1, 'confirmed', '2023-11-20 08:00:00', 'sold', 1, '2023-11-20 09:00:00')
+        for table, archive_table, columns, key in qr_app.ARCHIVE_TABLES:
+            self.conn.execute(f'INSERT INTO {archive_table} ({columns}) SELECT {columns} FROM {table} WHERE {key} = ?', (archived,))
+        for table, _, _, key in reversed(qr_app.ARCHIVE_TABLES):
+            self.conn.execute(f'DELETE FROM {table} WHERE {key} = ?', (archived,))
+        self.conn.execute('DROP TABLE rollup_daily')
+        self.conn.execute('DROP TABLE rollup_hourly')
+        self.conn.commit()
+
+        self.init_db()
+
+        products = f'{red}, {blue}'
+        rollups = self.rows(f'''
+            SELECT bucket, product_id, reserved, sold, scanned, cancelled FROM rollup_daily
+            WHERE product_id IN ({products}) ORDER BY 1, 2
+        ''')
+        self.assertEqual(rollups, self.rows(RECOUNT.format(products=products)))
+        self.assertIn(('2023-11-20', blue, 1, 1, 1, 0), rollups)
+
+        hourly = self.rows(f'''
+            SELECT date(bucket), product_id, SUM(reserved), SUM(sold), SUM(scanned), SUM(cancelled) FROM rollup_hourly
+            WHERE product_id IN ({products}) GROUP BY 1, 2 ORDER BY 1, 2
+        ''')
+        self.assertEqual(hourly, rollups)
+
+
+if __name__ == '__main__':
+    unittest.main()
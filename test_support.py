@@ -0,0 +1,99 @@
+"""
+Shared setup for the behaviour tests
+
+AppTestCase points the app at a fresh database in a temporary directory for
+the duration of a test class and has helpers to log in, seed products with
+validated stock, check out a cart and wait for background jobs.
+"""
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from urllib.parse import parse_qs, urlparse
+
+import app as qr_app
+
+# Default users created by init_db
+CUSTOMER_ID = 1
+ADMIN_ID = 2
+
+
+class AppTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix=f'qr_app_{cls.__name__}_')
+        cls.original_database = qr_app.DATABASE
+        qr_app.DATABASE = os.path.join(cls.tmpdir, 'qr_app.db')
+        # Sweeps run by request teardown would change reservations under the tests
+        cls.original_sweep_seconds = qr_app.RESERVATION_SWEEP_SECONDS
+        qr_app.RESERVATION_SWEEP_SECONDS = 0
+        qr_app.app.config['TESTING'] = True
+        cls.create_schema()
+
+    @classmethod
+    def tearDownClass(cls):
+        qr_app.DATABASE = cls.original_database
+        qr_app.RESERVATION_SWEEP_SECONDS = cls.original_sweep_seconds
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    @classmethod
+    def create_schema(cls):
+        """Build the database - override to start from another schema"""
+        cls.init_db()
+
+    @staticmethod
+    def init_db():
+        with contextlib.redirect_stdout(io.StringIO()):
+            qr_app.init_db()
+
+    def setUp(self):
+        self.client = qr_app.app.test_client()
+        self.conn = sqlite3.connect(qr_app.DATABASE)
+        self.conn.row_factory = sqlite3.Row
+
+    def tearDown(self):
+        self.conn.close()
+
+    def login(self, user_id, user_type):
+        with self.client.session_transaction() as sess:
+            sess['loggedin'] = True
+            sess['id'] = user_id
+            sess['username'] = f'user{user_id}'
+            sess['user_type'] = user_type
+
+    def create_product(self, color, stock=0):
+        """A product with stock validated, available items; returns its id
+
+        The category is the test's name, so tests never share a product.
+        """
+        product_id = self.conn.execute('INSERT INTO products (category, size, color, stock) VALUES (?, ?, ?, ?)',
+                                       (self._testMethodName, 'M', color, stock)).lastrowid
+        self.conn.executemany("INSERT INTO items (product_id, qr_code, status, validated) VALUES (?, ?, 'available', 1)",
+                              [(product_id, f'TEST-{product_id}-{n}') for n in range(stock)])
+        self.conn.commit()
+        return product_id
+
+    def checkout(self, *cart):
+        """Check out (product_id, quantity) pairs as the default customer; returns the newest order id"""
+        self.login(CUSTOMER_ID, 'customer')
+        for product_id, quantity in cart:
+            response = self.client.post('/add_to_cart', data=dict(product_id=product_id, quantity=quantity))
+            self.assertTrue(response.json['success'], response.json)
+        self.assertEqual(self.client.post('/checkout').status_code, 302)
+        return self.conn.execute('SELECT MAX(id) FROM orders WHERE user_id = ?', (CUSTOMER_ID,)).fetchone()[0]
+
+    def wait_for_job(self, response, timeout=10):
+        """Wait for the job a redirect points at (?job=) - with worker threads it runs in the background"""
+        for job_id in parse_qs(urlparse(response.headers['Location']).query).get('job', []):
+            self.wait_for_job_id(int(job_id), timeout)
+
+    def wait_for_job_id(self, job_id, timeout=10):
+        """Wait until a job is done or failed and return it"""
+        deadline = time.time() + timeout
+        while (job := qr_app.job_queue.get(job_id))['status'] not in ('done', 'failed') and time.time() < deadline:
+            time.sleep(0.02)
+        return job
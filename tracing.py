@@ -0,0 +1,248 @@
+"""Lightweight request tracing with a local NDJSON exporter
+
+Each traced request gets a trace id (taken from an incoming traceparent or
+X-Trace-Id header, otherwise generated) that is sent back in the response
+headers. Code inside the request opens spans:
+
+    with tracing.span('qr.make_image', profile='scan_url'):
+        img = qr.make_image(...)
+
+Finished spans are appended to TRACE_FILE by a background thread, one JSON
+object per line in the Chrome trace event format ("ph": "X" complete events).
+Convert a file for chrome://tracing, Perfetto or speedscope with:
+
+    python tracing.py chrome [--trace TRACE_ID] > trace.json
+
+Outside a traced request span() does nothing, so the instrumentation can stay
+in place with tracing off.
+
+Environment variables:
+    TRACING             - "1" to trace requests (default off)
+    TRACE_SAMPLE_RATE   - fraction of requests to trace (default 1.0); requests
+                          with an incoming trace id are always traced
+    TRACE_FILE          - output file (default <tmp>/qr_app_traces.ndjson)
+    TRACE_FILE_MAX_MB   - rotate to TRACE_FILE.1 beyond this size (default 50)
+"""
+import argparse
+import atexit
+import contextvars
+import json
+import os
+import queue
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+
+TRACING = os.environ.get('TRACING', '').lower() in ('1', 'true', 'yes')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_FILE = os.environ.get('TRACE_FILE') or os.path.join(tempfile.gettempdir(), 'qr_app_traces.ndjson')
+TRACE_FILE_MAX_BYTES = int(float(os.environ.get('TRACE_FILE_MAX_MB', '50')) * 1024 * 1024)
+
+_TRACEPARENT = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+_current = contextvars.ContextVar('qr_app_trace', default=None)
+
+
+class Trace:
+    def __init__(self, trace_id, parent_id=None):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.stack = []
+        self.events = []
+
+
+class _Span:
+    __slots__ = ('name', 'span_id', 'parent_id', 'attrs', 'start_us', 'start_ns')
+
+    def __init__(self, name, parent_id, attrs):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start_us = time.time_ns() // 1000
+        self.start_ns = time.perf_counter_ns()
+
+
+def parse_trace_header(headers):
+    """(trace_id, parent_span_id) from traceparent / X-Trace-Id headers, or (None, None)"""
+    match = _TRACEPARENT.match(headers.get('traceparent', '').strip().lower())
+    if match:
+        return match.group(1), match.group(2)
+    trace_id = headers.get('X-Trace-Id', '').strip().lower()
+    if re.fullmatch(r'[0-9a-f]{16,32}', trace_id):
+        return trace_id, None
+    return None, None
+
+
+def start_trace(trace_id=None, parent_id=None):
+    trace = Trace(trace_id or secrets.token_hex(16), parent_id)
+    _current.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current.get()
+
+
+def start_span(name, **attrs):
+    trace = _current.get()
+    if trace is None:
+        return None
+    parent = trace.stack[-1].span_id if trace.stack else trace.parent_id
+    span = _Span(name, parent, attrs)
+    trace.stack.append(span)
+    return span
+
+
+def end_span(**attrs):
+    trace = _current.get()
+    if trace is None or not trace.stack:
+        return
+    span = trace.stack.pop()
+    span.attrs.update(attrs)
+    _add_event(trace, span.name, span.span_id, span.parent_id, span.start_us,
+               (time.perf_counter_ns() - span.start_ns) // 1000, span.attrs)
+
+
+class span:
+    """Context manager for a span - a no-op outside a traced request"""
+    __slots__ = ('name', 'attrs', 'active')
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.active = start_span(self.name, **self.attrs) is not None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.active:
+            end_span(**({'error': exc_type.__name__} if exc_type else {}))
+
+
+def record_span(name, duration, **attrs):
+    """Add a span that just ended and took duration seconds (for code that times itself)"""
+    trace = _current.get()
+    if trace is None:
+        return
+    duration_us = int(duration * 1000000)
+    parent = trace.stack[-1].span_id if trace.stack else trace.parent_id
+    _add_event(trace, name, secrets.token_hex(8), parent, time.time_ns() // 1000 - duration_us, duration_us, attrs)
+
+
+def _add_event(trace, name, span_id, parent_id, start_us, duration_us, attrs):
+    args = {'trace_id': trace.trace_id, 'span_id': span_id}
+    if parent_id:
+        args['parent_id'] = parent_id
+    args.update(attrs)
+    trace.events.append({
+        'name': name,
+        'cat': name.split('.', 1)[0],
+        'ph': 'X',
+        'ts': start_us,
+        'dur': duration_us,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': args,
+    })
+
+
+def finish_trace(**attrs):
+    """Close any spans left open (a view raised), export the trace and detach it"""
+    trace = _current.get()
+    if trace is None:
+        return None
+    while trace.stack:
+        # attrs (e.g. the error) belong to the root span
+        end_span(**(attrs if len(trace.stack) == 1 else {}))
+    _current.set(None)
+    _exporter.export(trace.events)
+    return trace
+
+
+class NDJSONExporter:
+    """Appends span events to a file from a background thread"""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, events):
+        if not events:
+            return
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+        try:
+            self.queue.put_nowait(events)
+        except queue.Full:
+            self.dropped += len(events)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Write everything that queued up meanwhile in one go
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = ''.join(json.dumps(event, default=str, separators=(',', ':')) + '\n'
+                            for events in batch if events for event in events)
+            if lines:
+                self._write(lines)
+            if stop:
+                return
+
+    def _write(self, lines):
+        try:
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        except OSError:
+            pass  # Tracing must never break the app
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+
+_exporter = NDJSONExporter(TRACE_FILE, TRACE_FILE_MAX_BYTES)
+
+
+def to_chrome(path, trace_id=None):
+    """Span events of an NDJSON file as a Chrome trace JSON array"""
+    events = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # Partially written last line
+            if trace_id is None or event.get('args', {}).get('trace_id') == trace_id:
+                events.append(event)
+    return events
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tools for the QR App trace file')
+    sub = parser.add_subparsers(dest='command', required=True)
+    chrome = sub.add_parser('chrome', help='convert the NDJSON trace file to a Chrome trace JSON array')
+    chrome.add_argument('--file', default=TRACE_FILE)
+    chrome.add_argument('--trace', help='only this trace id')
+    args = parser.parse_args()
+    json.dump(to_chrome(args.file, args.trace), sys.stdout)
+    sys.stdout.write('\n')